@@ -3,43 +3,37 @@ Air Quality Analytics Module
 Provides endpoints for air quality data analysis and visualization.
 """
 
+import asyncio
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import List, Optional
 from . import crud
-from .database import db
+from .database import get_collection
+from core.config import settings
+from core.metrics import track_pipeline
 
 # Get hardware locations collection
-hardware_location_collection = db.get_collection("hardware_locations")
+hardware_location_collection = get_collection("hardware_locations")
 
+ZONE_LIMIT = 500
+TREND_LIMIT = 500
+EMPTY_STATS = {
+    "avg_pm25": 0,
+    "avg_pm10": 0,
+    "max_pm25": 0,
+    "min_pm25": 0,
+    "avg_temp": 0,
+    "avg_hum": 0,
+    "total_readings": 0
+}
 
-async def get_zone_heatmap_data(hours: int = 24, grid_size: float = 0.001, bus_mac: Optional[str] = None):
-    """
-    Get air quality data grouped by geographic zones for heatmap visualization.
-    
-    Args:
-        hours: Number of hours of historical data to include
-        grid_size: Size of grid cells in degrees (0.001 ≈ 111 meters)
-    
-    Returns:
-        List of zone objects with lat, lon, avg_pm25, avg_pm10, count
-    """
-    cutoff_time = datetime.utcnow() - timedelta(hours=hours)
-    
-    match_stage = {
-        "timestamp": {"$gte": cutoff_time},
-        "lat": {"$ne": None},
-        "lon": {"$ne": None},
-        "pm2_5": {"$gt": 0}  # Filter out 0 values (artifacts/missing data)
-    }
 
-    if bus_mac:
-        match_stage["bus_mac"] = bus_mac
+# Pipeline stages after the time-window $match, shared by the single-metric
+# functions below and the $facet branches of get_summary
 
-    # Aggregation pipeline to group by grid cells
-    pipeline = [
-        {
-            "$match": match_stage
-        },
+def _zone_stages(grid_size: float) -> list:
+    return [
         {
             "$project": {
                 "grid_lat": {
@@ -88,42 +82,10 @@ async def get_zone_heatmap_data(hours: int = 24, grid_size: float = 0.001, bus_m
         },
         {"$sort": {"avg_pm25": 1}}  # Sort by air quality (best first)
     ]
-    
-    try:
-        zones = await hardware_location_collection.aggregate(pipeline).to_list(length=500)
-        return zones
-    except Exception as e:
-        print(f"Error in get_zone_heatmap_data: {e}")
-        return []
 
 
-async def get_time_series_data(hours: int = 24, interval_minutes: int = 60, bus_mac: Optional[str] = None):
-    """
-    Get air quality time series data for trend visualization.
-    
-    Args:
-        hours: Number of hours of data to include
-        hours: Number of hours of data to include
-        interval_minutes: Aggregation interval in minutes
-        bus_mac: Optional MAC address to filter by specific bus
-    
-    Returns:
-        List of time-bucketed averages with timestamp, avg_pm25, avg_pm10
-    """
-    cutoff_time = datetime.utcnow() - timedelta(hours=hours)
-    
-    match_stage = {
-        "timestamp": {"$gte": cutoff_time},
-        "pm2_5": {"$gt": 0}  # Filter out 0 values
-    }
-    
-    if bus_mac:
-        match_stage["bus_mac"] = bus_mac
-
-    pipeline = [
-        {
-            "$match": match_stage
-        },
+def _trend_stages(interval_minutes: int) -> list:
+    return [
         {
             "$group": {
                 "_id": {
@@ -153,33 +115,10 @@ async def get_time_series_data(hours: int = 24, interval_minutes: int = 60, bus_
         },
         {"$sort": {"timestamp": 1}}
     ]
-    
-    try:
-        series = await hardware_location_collection.aggregate(pipeline).to_list(length=500)
-        return series
-    except Exception as e:
-        print(f"Error in get_time_series_data: {e}")
-        return []
-
-
-async def get_overall_stats(hours: int = 24, bus_mac: Optional[str] = None):
-    """
-    Get overall air quality statistics for the dashboard summary.
-    """
-    cutoff_time = datetime.utcnow() - timedelta(hours=hours)
-    
-    match_stage = {
-        "timestamp": {"$gte": cutoff_time},
-        "pm2_5": {"$gt": 0}  # Filter out 0 values
-    }
 
-    if bus_mac:
-        match_stage["bus_mac"] = bus_mac
 
-    pipeline = [
-        {
-            "$match": match_stage
-        },
+def _stats_stages() -> list:
+    return [
         {
             "$group": {
                 "_id": None,
@@ -205,20 +144,241 @@ async def get_overall_stats(hours: int = 24, bus_mac: Optional[str] = None):
             }
         }
     ]
+
+
+@track_pipeline
+async def get_zone_heatmap_data(hours: int = 24, grid_size: float = 0.001, bus_mac: Optional[str] = None):
+    """
+    Get air quality data grouped by geographic zones for heatmap visualization.
+    
+    Args:
+        hours: Number of hours of historical data to include
+        grid_size: Size of grid cells in degrees (0.001 ≈ 111 meters)
+    
+    Returns:
+        List of zone objects with lat, lon, avg_pm25, avg_pm10, count
+    """
+    cutoff_time = datetime.utcnow() - timedelta(hours=hours)
+    
+    match_stage = {
+        "timestamp": {"$gte": cutoff_time},
+        "lat": {"$ne": None},
+        "lon": {"$ne": None},
+        "pm2_5": {"$gt": 0},  # Filter out 0 values (artifacts/missing data)
+        "anomaly": None  # Flagged outliers (app/anomaly.py) stay out of averages
+    }
+
+    if bus_mac:
+        match_stage["bus_mac"] = bus_mac
+
+    pipeline = [{"$match": match_stage}] + _zone_stages(grid_size)
+    
+    try:
+        zones = await hardware_location_collection.aggregate(pipeline).to_list(length=ZONE_LIMIT)
+        return zones
+    except Exception as e:
+        print(f"Error in get_zone_heatmap_data: {e}")
+        return []
+
+
+@track_pipeline
+async def get_zone_bucket_sums(start_bucket: Optional[int], end_bucket: int, bucket_seconds: int,
+                               grid_size: float = 0.001, bus_mac: Optional[str] = None):
+    """
+    The readings behind get_zone_heatmap_data, grouped by zone *and* time
+    bucket (bucket = floor(epoch seconds / bucket_seconds)), as sums so
+    buckets can be cached and merged into any window later.
+
+    Args:
+        start_bucket: First bucket to include (None = all history)
+        end_bucket: Last bucket to include
+    
+    Returns:
+        List of { bucket, lat, lon, pm25_sum, count } (lat/lon = zone centre)
+    """
+    timestamp = {"$lt": datetime.utcfromtimestamp((end_bucket + 1) * bucket_seconds)}
+    if start_bucket is not None:
+        timestamp["$gte"] = datetime.utcfromtimestamp(start_bucket * bucket_seconds)
+    match_stage = {
+        "timestamp": timestamp,
+        "lat": {"$ne": None},
+        "lon": {"$ne": None},
+        "pm2_5": {"$gt": 0},
+        "anomaly": None
+    }
+    if bus_mac:
+        match_stage["bus_mac"] = bus_mac
+
+    pipeline = [
+        {"$match": match_stage},
+        {
+            "$group": {
+                "_id": {
+                    "lat": {"$floor": {"$divide": ["$lat", grid_size]}},
+                    "lon": {"$floor": {"$divide": ["$lon", grid_size]}},
+                    "bucket": {"$floor": {"$divide": [{"$toLong": "$timestamp"}, bucket_seconds * 1000]}},
+                },
+                "pm25_sum": {"$sum": "$pm2_5"},
+                "count": {"$sum": 1}
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "bucket": {"$toLong": "$_id.bucket"},
+                "lat": {"$add": [{"$multiply": ["$_id.lat", grid_size]}, grid_size / 2]},
+                "lon": {"$add": [{"$multiply": ["$_id.lon", grid_size]}, grid_size / 2]},
+                "pm25_sum": 1,
+                "count": 1
+            }
+        }
+    ]
+    return await hardware_location_collection.aggregate(pipeline).to_list(length=None)
+
+
+@track_pipeline
+async def get_time_series_data(hours: int = 24, interval_minutes: int = 60, bus_mac: Optional[str] = None):
+    """
+    Get air quality time series data for trend visualization.
+    
+    Args:
+        hours: Number of hours of data to include
+        hours: Number of hours of data to include
+        interval_minutes: Aggregation interval in minutes
+        bus_mac: Optional MAC address to filter by specific bus
+    
+    Returns:
+        List of time-bucketed averages with timestamp, avg_pm25, avg_pm10
+    """
+    cutoff_time = datetime.utcnow() - timedelta(hours=hours)
+    
+    match_stage = {
+        "timestamp": {"$gte": cutoff_time},
+        "pm2_5": {"$gt": 0},  # Filter out 0 values
+        "anomaly": None
+    }
+    
+    if bus_mac:
+        match_stage["bus_mac"] = bus_mac
+
+    pipeline = [{"$match": match_stage}] + _trend_stages(interval_minutes)
+    
+    try:
+        series = await hardware_location_collection.aggregate(pipeline).to_list(length=TREND_LIMIT)
+        return series
+    except Exception as e:
+        print(f"Error in get_time_series_data: {e}")
+        return []
+
+
+@track_pipeline
+async def get_overall_stats(hours: int = 24, bus_mac: Optional[str] = None):
+    """
+    Get overall air quality statistics for the dashboard summary.
+    """
+    cutoff_time = datetime.utcnow() - timedelta(hours=hours)
+    
+    match_stage = {
+        "timestamp": {"$gte": cutoff_time},
+        "pm2_5": {"$gt": 0},  # Filter out 0 values
+        "anomaly": None
+    }
+
+    if bus_mac:
+        match_stage["bus_mac"] = bus_mac
+
+    pipeline = [{"$match": match_stage}] + _stats_stages()
     
     try:
         result = await hardware_location_collection.aggregate(pipeline).to_list(length=1)
         if result:
             return result[0]
-        return {
-            "avg_pm25": 0,
-            "avg_pm10": 0,
-            "max_pm25": 0,
-            "min_pm25": 0,
-            "avg_temp": 0,
-            "avg_hum": 0,
-            "total_readings": 0
-        }
+        return dict(EMPTY_STATS)
     except Exception as e:
         print(f"Error in get_overall_stats: {e}")
         return {"error": str(e)}
+
+
+@track_pipeline
+async def get_summary(hours: int = 24, grid_size: float = 0.001, interval_minutes: int = 60,
+                      bus_mac: Optional[str] = None, now: Optional[datetime] = None):
+    """
+    Zones, trends and stats for one time window in a single aggregation.
+    The window is matched once (one pass over the timestamp index) and a
+    $facet feeds the same documents to the zone, trend and stats stages.
+    
+    Returns:
+        { zones, series, stats } as returned by get_zone_heatmap_data,
+        get_time_series_data and get_overall_stats
+    """
+    cutoff_time = (now or datetime.utcnow()) - timedelta(hours=hours)
+    match_stage = {
+        "timestamp": {"$gte": cutoff_time},
+        "pm2_5": {"$gt": 0},
+        "anomaly": None
+    }
+    if bus_mac:
+        match_stage["bus_mac"] = bus_mac
+
+    pipeline = [
+        {"$match": match_stage},
+        # Only the fields the facets read travel into $facet
+        {"$project": {"_id": 0, "lat": 1, "lon": 1, "pm2_5": 1, "pm10": 1, "temp": 1, "hum": 1, "timestamp": 1}},
+        {
+            "$facet": {
+                "zones": [{"$match": {"lat": {"$ne": None}, "lon": {"$ne": None}}}]
+                         + _zone_stages(grid_size) + [{"$limit": ZONE_LIMIT}],
+                "series": _trend_stages(interval_minutes) + [{"$limit": TREND_LIMIT}],
+                "stats": _stats_stages(),
+            }
+        }
+    ]
+    result = await hardware_location_collection.aggregate(pipeline).to_list(length=1)
+    facets = result[0] if result else {"zones": [], "series": [], "stats": []}
+    return {
+        "zones": facets["zones"],
+        "series": facets["series"],
+        "stats": facets["stats"][0] if facets["stats"] else dict(EMPTY_STATS),
+    }
+
+
+class SummaryCache:
+    """
+    Summaries per (parameters, period of `period_seconds`): every dashboard
+    asking within the same period gets the same result, computed once. Only
+    the cache key is aligned; the window itself ends at the first request
+    of the period, so readings of the period in progress are included and
+    a result is at most `period_seconds` old. Entries hold the aggregation
+    task itself, so concurrent misses await a single query; failures are
+    not cached.
+    """
+
+    def __init__(self, period_seconds: int, max_entries: int = 128):
+        self.period_seconds = period_seconds
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[tuple, asyncio.Task]" = OrderedDict()
+
+    async def get(self, hours: int, grid_size: float, interval_minutes: int, bus_mac: Optional[str] = None):
+        if self.period_seconds <= 0:
+            return await get_summary(hours, grid_size, interval_minutes, bus_mac)
+
+        period = int(time.time() // self.period_seconds)
+        key = (hours, grid_size, interval_minutes, bus_mac, period)
+        task = self.entries.get(key)
+        if task is None:
+            task = asyncio.ensure_future(get_summary(hours, grid_size, interval_minutes, bus_mac))
+            self.entries[key] = task
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            if self.entries.get(key) is task:
+                del self.entries[key]
+            raise
+
+
+summary_cache = SummaryCache(settings.ANALYTICS_CACHE_SECONDS)
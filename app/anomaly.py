@@ -0,0 +1,160 @@
+"""
+PM Anomaly Detection Module
+Streaming outlier check on incoming PM2.5 readings, per bus.
+
+Each bus keeps an exponentially weighted mean and variance (EWMA/EWMV),
+updated in O(1) time and memory per reading:
+
+    diff = x - mean
+    mean += alpha * diff
+    var = (1 - alpha) * (var + alpha * diff^2)
+
+After a short warm-up a reading is an outlier when it is further than
+max(threshold * std, min_delta) from the mean. Outliers do not update the
+statistics (a spike cannot drag the baseline towards itself); a run of
+`shift_after` consecutive outliers is taken as a genuine level change and
+re-seeds the baseline instead. Readings at the sensor ceiling are reported
+as "saturated" regardless of history, and a reading collapsing to near
+zero from a high baseline as a "drop".
+
+Anomalies produce alert events (kept in `recent_events` and passed to
+listeners); what happens to the reading itself (flag or quarantine) is
+decided by the ingest path, see ANOMALY_MODE.
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from core.config import settings
+from core.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MAX_RECENT_EVENTS = 200
+SATURATION_PM25 = 1000.0  # Ingest clamps PM2.5 to [0, 1000]
+DROPOUT_RATIO = 0.1       # Below this fraction of the baseline = sensor dropout...
+DROPOUT_MIN_BASELINE = 10.0  # ...if the baseline is at least this (ug/m3); clean air rarely reads ~0 from here
+
+ANOMALIES = REGISTRY.counter("pm_anomalies_total", "PM2.5 readings flagged as anomalous", ["kind"])
+
+
+class BusBaseline:
+    __slots__ = ("mean", "var", "count", "outlier_run")
+
+    def __init__(self, value: float):
+        self.mean = value
+        self.var = 0.0
+        self.count = 1
+        self.outlier_run = 0
+
+    def update(self, value: float, alpha: float):
+        diff = value - self.mean
+        increment = alpha * diff
+        self.mean += increment
+        self.var = (1 - alpha) * (self.var + diff * increment)
+        self.count += 1
+
+
+class AnomalyDetector:
+    """
+    Args:
+        alpha: EWMA weight of a new reading (0.1 ~ the last 10-20 readings)
+        threshold: Outlier distance in standard deviations
+        min_delta: Minimum outlier distance in ug/m3 (quiet sensors have a tiny std)
+        warmup: Readings per bus before anything is flagged
+        shift_after: Consecutive outliers accepted as a new level
+    """
+
+    def __init__(self, alpha: float = 0.1, threshold: float = 4.0, min_delta: float = 25.0,
+                 warmup: int = 10, shift_after: int = 5):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_delta = min_delta
+        self.warmup = warmup
+        self.shift_after = shift_after
+        self.baselines: Dict[str, BusBaseline] = {}
+        self._lock = threading.Lock()
+        self.recent_events: Deque[dict] = deque(maxlen=MAX_RECENT_EVENTS)
+        self.listeners: List[Callable[[dict], None]] = []
+
+    def _classify(self, baseline: BusBaseline, value: float) -> Optional[str]:
+        if value >= SATURATION_PM25:
+            return "saturated"
+        if baseline.count < self.warmup:
+            baseline.update(value, self.alpha)
+            return None
+
+        deviation = value - baseline.mean
+        limit = max(self.threshold * math.sqrt(baseline.var), self.min_delta)
+        # A reading collapsing to ~0 from a polluted baseline is a dropout even inside the band
+        dropout = baseline.mean >= DROPOUT_MIN_BASELINE and value < baseline.mean * DROPOUT_RATIO
+        if abs(deviation) <= limit and not dropout:
+            baseline.outlier_run = 0
+            baseline.update(value, self.alpha)
+            return None
+
+        baseline.outlier_run += 1
+        if baseline.outlier_run >= self.shift_after:
+            # Sustained change (bus entered a polluted area, sensor swapped): re-seed
+            baseline.mean = value
+            baseline.var = (deviation / self.threshold) ** 2
+            baseline.outlier_run = 0
+            return None
+        return "spike" if deviation > 0 else "drop"
+
+    def check(self, bus_mac: str, pm2_5: float) -> Optional[str]:
+        """
+        Score one reading; returns the anomaly kind ("spike", "drop",
+        "saturated") or None. Safe to call from the MQTT thread; listeners
+        run on the calling thread.
+        """
+        with self._lock:
+            baseline = self.baselines.get(bus_mac)
+            if baseline is None:
+                if pm2_5 < SATURATION_PM25:
+                    self.baselines[bus_mac] = BusBaseline(pm2_5)
+                    return None
+                kind = "saturated"
+            else:
+                expected = baseline.mean
+                kind = self._classify(baseline, pm2_5)
+                if kind is None:
+                    return None
+            event = {
+                "event": "pm_anomaly",
+                "kind": kind,
+                "bus_mac": bus_mac,
+                "pm2_5": pm2_5,
+                "expected_pm2_5": round(expected, 1) if baseline else None,
+                "std": round(math.sqrt(baseline.var), 1) if baseline else None,
+                "timestamp": time.time(),
+            }
+            self.recent_events.append(event)
+
+        ANOMALIES.inc(labels=(kind,))
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.error("Error in anomaly listener: %s", e)
+        return kind
+
+    def baseline(self, bus_mac: str) -> Optional[dict]:
+        with self._lock:
+            b = self.baselines.get(bus_mac)
+            if b is None:
+                return None
+            return {"bus_mac": bus_mac, "mean": round(b.mean, 2), "std": round(math.sqrt(b.var), 2),
+                    "readings": b.count, "outlier_run": b.outlier_run}
+
+
+# Shared detector (fed from the MQTT thread)
+detector = AnomalyDetector(
+    alpha=settings.ANOMALY_ALPHA,
+    threshold=settings.ANOMALY_THRESHOLD,
+    min_delta=settings.ANOMALY_MIN_DELTA,
+)
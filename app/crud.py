@@ -1,36 +1,70 @@
-from typing import List
+import logging
+import math
+from typing import List, Optional
 from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from . import models, schemas
 from datetime import datetime
-from .database import db
+from .database import get_collection
+from .pagination import keyset_query
+from .tiles import tile_cache
+from core.logger import SampledLogger
+from core.metrics import track_mongo
+
+logger = logging.getLogger(__name__)
+write_logger = SampledLogger(__name__)  # Per-message lines, 1 in LOG_SAMPLE_EVERY
 
 # Get collections
-bus_collection = db.get_collection("buses")
-route_collection = db.get_collection("routes")
-stop_collection = db.get_collection("stops")
-feedback_collection = db.get_collection("feedback")
-hardware_location_collection = db.get_collection("hardware_locations")
-blocked_mac_collection = db.get_collection("blocked_macs")
+bus_collection = get_collection("buses")
+route_collection = get_collection("routes")
+stop_collection = get_collection("stops")
+feedback_collection = get_collection("feedback")
+hardware_location_collection = get_collection("hardware_locations")
+blocked_mac_collection = get_collection("blocked_macs")
+pm_zone_collection = get_collection("pm_zones")
+quarantine_collection = get_collection("quarantined_readings")  # Anomalous readings (ANOMALY_MODE=quarantine)
+
+# Sort orders for keyset pagination (see app/pagination.py); `after` arguments
+# are the decoded cursor values for these keys
+BUS_SORT = [("_id", 1)]
+ROUTE_SORT = [("_id", 1)]
+STOP_SORT = [("_id", 1)]
+FEEDBACK_SORT = [("created_at", -1), ("_id", -1)]
+HARDWARE_LOCATION_SORT = [("timestamp", -1), ("_id", -1)]
+
+
+def _page(collection, sort, skip: int, limit: int, after: Optional[tuple], query: dict = None):
+    # skip is kept for old clients; a cursor (after) takes precedence
+    cursor = collection.find(keyset_query(query or {}, sort, after)).sort(sort)
+    if skip and after is None:
+        cursor = cursor.skip(skip)
+    return cursor.limit(limit).to_list(limit)
 
 
+@track_mongo
 async def get_bus(bus_id: str):
     return await bus_collection.find_one({"_id": ObjectId(bus_id)})
 
+@track_mongo
 async def get_bus_by_mac(mac_address: str):
     return await bus_collection.find_one({"mac_address": mac_address})
 
-async def get_buses(skip: int = 0, limit: int = 100):
-    buses = await bus_collection.find().skip(skip).limit(limit).to_list(limit)
-    print(f"DEBUG: get_buses returning {len(buses)} buses")
+@track_mongo
+async def get_buses(skip: int = 0, limit: int = 100, after: Optional[tuple] = None):
+    buses = await _page(bus_collection, BUS_SORT, skip, limit, after)
+    logger.debug("get_buses returning %d buses", len(buses))
     return buses
 
+@track_mongo
 async def create_bus(bus: models.Bus):
     bus_dict = bus.model_dump(by_alias=True, exclude=["id"])
     result = await bus_collection.insert_one(bus_dict)
     new_bus = await bus_collection.find_one({"_id": result.inserted_id})
     return new_bus
 
-async def update_bus_location(mac_address: str, lat: float | None, lon: float | None, seats_available: int, pm2_5: float, pm10: float, bus_name: str = None, temp: float = 0.0, hum: float = 0.0):
+@track_mongo
+async def update_bus_location(mac_address: str, lat: float | None, lon: float | None, seats_available: int, pm2_5: float, pm10: float, bus_name: str = None, temp: float = 0.0, hum: float = 0.0, speed_mps: float = None, heading_deg: float = None):
     # This is an 'upsert' operation: it updates a bus if it exists, or creates it if it doesn't.
     # This is useful for when a bus device comes online for the first time.
     update_data = {
@@ -47,6 +81,9 @@ async def update_bus_location(mac_address: str, lat: float | None, lon: float |
         update_data["current_lat"] = lat
     if lon is not None:
         update_data["current_lon"] = lon
+    if speed_mps is not None:
+        update_data["speed_mps"] = speed_mps
+        update_data["heading_deg"] = heading_deg
         
     if bus_name:
         # Prevent overwriting a good name with a default "Bus-MAC" name
@@ -65,39 +102,57 @@ async def update_bus_location(mac_address: str, lat: float | None, lon: float |
         {"$set": update_data},
         upsert=True
     )
-    print(f"DEBUG: update_bus_location result matched={result.matched_count}, upserted={result.upserted_id}, modified={result.modified_count}")
+    write_logger.debug("update_bus_location %s matched=%s upserted=%s modified=%s",
+                       mac_address, result.matched_count, result.upserted_id, result.modified_count)
     if result.matched_count == 1 or result.upserted_id:
         return await get_bus_by_mac(mac_address)
     return None
 
+@track_mongo
+async def update_bus_position(mac_address: str, lat: float, lon: float, speed_mps: float = None, heading_deg: float = None):
+    """Live position only (fast GPS fixes), leaving the last sensor readings in place."""
+    update_data = {"current_lat": lat, "current_lon": lon, "last_updated": datetime.utcnow()}
+    if speed_mps is not None:
+        update_data["speed_mps"] = speed_mps
+        update_data["heading_deg"] = heading_deg
+    await bus_collection.update_one({"mac_address": mac_address}, {"$set": update_data}, upsert=True)
+
+@track_mongo
 async def delete_bus(mac_address: str):
     result = await bus_collection.delete_one({"mac_address": mac_address})
     return result.deleted_count > 0
 
+@track_mongo
 async def get_route(route_id: str):
     return await route_collection.find_one({"_id": ObjectId(route_id)})
 
-async def get_routes(skip: int = 0, limit: int = 100):
-    return await route_collection.find().skip(skip).limit(limit).to_list(limit)
+@track_mongo
+async def get_routes(skip: int = 0, limit: int = 100, after: Optional[tuple] = None):
+    return await _page(route_collection, ROUTE_SORT, skip, limit, after)
 
+@track_mongo
 async def create_route(route: models.Route):
     route_dict = route.model_dump(by_alias=True, exclude=["id"])
     result = await route_collection.insert_one(route_dict)
     new_route = await route_collection.find_one({"_id": result.inserted_id})
     return new_route
 
+@track_mongo
 async def get_stop(stop_id: str):
     return await stop_collection.find_one({"_id": ObjectId(stop_id)})
 
-async def get_stops(skip: int = 0, limit: int = 100):
-    return await stop_collection.find().skip(skip).limit(limit).to_list(limit)
+@track_mongo
+async def get_stops(skip: int = 0, limit: int = 100, after: Optional[tuple] = None):
+    return await _page(stop_collection, STOP_SORT, skip, limit, after)
 
+@track_mongo
 async def create_stop(stop: models.Stop):
     stop_dict = stop.model_dump(by_alias=True, exclude=["id"])
     result = await stop_collection.insert_one(stop_dict)
     new_stop = await stop_collection.find_one({"_id": result.inserted_id})
     return new_stop
 
+@track_mongo
 async def get_stops_for_route(route_id: str):
     route = await get_route(route_id)
     if route and "stops" in route:
@@ -105,25 +160,77 @@ async def get_stops_for_route(route_id: str):
         return await stop_collection.find({"_id": {"$in": stop_ids}}).to_list(length=None)
     return []
 
+@track_mongo
 async def create_feedback(feedback: models.Feedback):
     feedback_dict = feedback.model_dump(by_alias=True, exclude=["id"])
     result = await feedback_collection.insert_one(feedback_dict)
     new_feedback = await feedback_collection.find_one({"_id": result.inserted_id})
     return new_feedback
 
-async def get_feedback(skip: int = 0, limit: int = 100):
-    return await feedback_collection.find().sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+@track_mongo
+async def get_feedback(skip: int = 0, limit: int = 100, after: Optional[tuple] = None):
+    return await _page(feedback_collection, FEEDBACK_SORT, skip, limit, after)
 
+@track_mongo
 async def create_hardware_location(location: models.HardwareLocation):
     location_dict = location.model_dump(by_alias=True, exclude=["id"])
     result = await hardware_location_collection.insert_one(location_dict)
+    if location.lat is not None and location.lon is not None:
+        tile_cache.invalidate_point(location.lat, location.lon)
     new_location = await hardware_location_collection.find_one({"_id": result.inserted_id})
     return new_location
 
-async def get_hardware_locations(skip: int = 0, limit: int = 100):
-    return await hardware_location_collection.find().sort("timestamp", -1).skip(skip).limit(limit).to_list(limit)
+@track_mongo
+async def insert_readings(collection_name: str, docs: list):
+    """
+    Ingest insert (app/spill.py) into hardware_locations or quarantined_readings
+    (anomalous readings kept out of analytics and heatmaps). Documents carry
+    their _id, so ones already stored are skipped as duplicate keys.
+    """
+    collection = quarantine_collection if collection_name == "quarantined_readings" else hardware_location_collection
+    try:
+        await collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if e.details.get("writeConcernErrors") or any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+    if collection is hardware_location_collection:
+        for doc in docs:
+            if doc.get("lat") is not None and doc.get("lon") is not None:
+                tile_cache.invalidate_point(doc["lat"], doc["lon"])
+
+@track_mongo
+async def get_hardware_locations(skip: int = 0, limit: int = 100, after: Optional[tuple] = None, bus_mac: Optional[str] = None):
+    query = {"bus_mac": bus_mac} if bus_mac else {}
+    return await _page(hardware_location_collection, HARDWARE_LOCATION_SORT, skip, limit, after, query)
+
+@track_mongo
+async def get_hardware_location_page(query: dict, after: tuple = None, limit: int = 1000, projection: dict = None):
+    """
+    One page of hardware_locations in (timestamp, _id) order, starting after
+    the `after` = (timestamp, _id) key. Keyset pagination: each page is an
+    index range scan, unlike skip() which re-reads every skipped document.
+    """
+    sort = [("timestamp", 1), ("_id", 1)]
+    cursor = hardware_location_collection.find(keyset_query(query, sort, after), projection).sort(sort).limit(limit)
+    return await cursor.to_list(limit)
+
+# --- PM Zones ---
+@track_mongo
+async def get_pm_zones():
+    return await pm_zone_collection.find({}).to_list(length=None)
+
+@track_mongo
+async def update_pm_zone_stats(updates: dict):
+    """Batch update from app/zones.py: {zone _id: fields to $set}, one round trip."""
+    if not updates:
+        return
+    await pm_zone_collection.bulk_write(
+        [UpdateOne({"_id": zone_id}, {"$set": fields}) for zone_id, fields in updates.items()],
+        ordered=False
+    )
 
 # --- MAC Address Blocking ---
+@track_mongo
 async def block_mac_address(mac: models.BlockedMAC):
     mac_dict = mac.model_dump(by_alias=True, exclude=["id"])
     await blocked_mac_collection.update_one(
@@ -133,20 +240,24 @@ async def block_mac_address(mac: models.BlockedMAC):
     )
     return await blocked_mac_collection.find_one({"mac_address": mac.mac_address})
 
+@track_mongo
 async def is_mac_blocked(mac_address: str) -> bool:
     return await blocked_mac_collection.find_one({"mac_address": mac_address}) is not None
 
 
 # --- Heatmap Data ---
+@track_mongo
 async def get_heatmap_data(limit: int = 2000, start_time: datetime = None):
     # Fetch recent hardware locations for heatmap
     # We only need lat, lon, and pm2_5
-    query = {"lat": {"$ne": None}, "lon": {"$ne": None}, "pm2_5": {"$gt": 0}}
+    # Flagged outliers (app/anomaly.py, ANOMALY_MODE=flag) stay off the heatmaps
+    query = {"lat": {"$ne": None}, "lon": {"$ne": None}, "pm2_5": {"$gt": 0}, "anomaly": None}
     
     if start_time:
         query["timestamp"] = {"$gte": start_time}
         
-    cursor = hardware_location_collection.find(query).sort("timestamp", -1).limit(limit)
+    projection = {"_id": 0, "lat": 1, "lon": 1, "pm2_5": 1}
+    cursor = hardware_location_collection.find(query, projection).sort("timestamp", -1).limit(limit)
     
     points = []
     async for doc in cursor:
@@ -157,13 +268,119 @@ async def get_heatmap_data(limit: int = 2000, start_time: datetime = None):
         })
     return points
 
+@track_mongo
+async def get_heatmap_lod_data(cell_degrees: float, limit: int = 50000, start_time: datetime = None,
+                               bbox: tuple = None):
+    """
+    Level-of-detail heatmap: readings binned into square cells of
+    `cell_degrees` (a few screen pixels at the client's zoom) inside Mongo.
+    Each cell becomes one point at the readings' centroid, weighted by their
+    mean PM2.5, so the rendered map keeps its shape while only one point per
+    visible cell crosses the wire.
+    bbox: (min_lon, min_lat, max_lon, max_lat)
+    Returns: [{ latitude, longitude, weight, count }]
+    """
+    match_stage = {"lat": {"$ne": None}, "lon": {"$ne": None}, "pm2_5": {"$gt": 0}, "anomaly": None}
+    if start_time:
+        match_stage["timestamp"] = {"$gte": start_time}
+    if bbox:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        match_stage["lat"] = {"$gte": min_lat, "$lte": max_lat}
+        match_stage["lon"] = {"$gte": min_lon, "$lte": max_lon}
+
+    pipeline = [
+        {"$match": match_stage},
+        {"$sort": {"timestamp": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "lat": 1, "lon": 1, "pm2_5": 1}},
+        {
+            "$group": {
+                "_id": {
+                    "x": {"$floor": {"$divide": ["$lon", cell_degrees]}},
+                    "y": {"$floor": {"$divide": ["$lat", cell_degrees]}},
+                },
+                "lat": {"$avg": "$lat"},
+                "lon": {"$avg": "$lon"},
+                "weight": {"$avg": "$pm2_5"},
+                "count": {"$sum": 1},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "latitude": {"$round": ["$lat", 6]},
+                "longitude": {"$round": ["$lon", 6]},
+                "weight": {"$round": ["$weight", 2]},
+                "count": 1,
+            }
+        }
+    ]
+    return await hardware_location_collection.aggregate(pipeline).to_list(length=None)
+
+@track_mongo
+async def get_tile_cells(zoom: int, x: int, y: int, bounds: tuple, grid: int,
+                         start_time: datetime = None, end_time: datetime = None, limit: int = 200000):
+    """
+    Mean PM2.5 per cell of slippy-map tile (zoom, x, y), split into
+    grid x grid cells. Cell indices are computed in Web Mercator inside the
+    aggregation (the same projection the map tiles use), so rows stay in
+    Mongo and only occupied cells are returned.
+    bounds: (min_lon, min_lat, max_lon, max_lat) of the tile
+    Returns: [{ x, y, pm2_5, count }] with 0 <= x, y < grid
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    match_stage = {
+        "lat": {"$gte": min_lat, "$lt": max_lat},
+        "lon": {"$gte": min_lon, "$lt": max_lon},
+        "pm2_5": {"$gt": 0},
+        "anomaly": None,
+    }
+    if start_time or end_time:
+        match_stage["timestamp"] = {}
+        if start_time:
+            match_stage["timestamp"]["$gte"] = start_time
+        if end_time:
+            match_stage["timestamp"]["$lt"] = end_time
+
+    cells_across = grid * (2 ** zoom)  # Cells across the whole world at this zoom
+    lat_rad = {"$degreesToRadians": "$lat"}
+    mercator_y = {"$divide": [
+        {"$ln": {"$add": [{"$tan": lat_rad}, {"$divide": [1, {"$cos": lat_rad}]}]}},
+        math.pi,
+    ]}
+    pipeline = [
+        {"$match": match_stage},
+        {"$sort": {"timestamp": -1}},
+        {"$limit": limit},
+        {
+            "$group": {
+                "_id": {
+                    "x": {"$subtract": [
+                        {"$floor": {"$multiply": [{"$divide": [{"$add": ["$lon", 180]}, 360]}, cells_across]}},
+                        x * grid,
+                    ]},
+                    "y": {"$subtract": [
+                        {"$floor": {"$multiply": [{"$divide": [{"$subtract": [1, mercator_y]}, 2]}, cells_across]}},
+                        y * grid,
+                    ]},
+                },
+                "pm2_5": {"$avg": "$pm2_5"},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$project": {"_id": 0, "x": {"$toInt": "$_id.x"}, "y": {"$toInt": "$_id.y"},
+                      "pm2_5": {"$round": ["$pm2_5", 1]}, "count": 1}},
+    ]
+    return await hardware_location_collection.aggregate(pipeline).to_list(length=None)
+
+@track_mongo
 async def get_pm_grid_data(limit: int = 10000, start_time: datetime = None, grid_size_degrees: float = 0.001):
     """
     Fetch PM data aggregated into grid cells using MongoDB aggregation pipeline.
     Grid size in degrees (0.001° ≈ 111m at equator)
     Returns: [{ latitude, longitude, avg_pm2_5, count, last_updated }]
     """
-    match_stage = {"lat": {"$ne": None}, "lon": {"$ne": None}, "pm2_5": {"$gt": 0}}
+    match_stage = {"lat": {"$ne": None}, "lon": {"$ne": None}, "pm2_5": {"$gt": 0}, "anomaly": None}
     if start_time:
         match_stage["timestamp"] = {"$gte": start_time}
     
@@ -223,6 +440,7 @@ async def get_pm_grid_data(limit: int = 10000, start_time: datetime = None, grid
         
     return result
     
+@track_mongo
 async def delete_hardware_locations_by_mac(mac_address: str):
     """Delete all location history for a specific device (used for debug cleanup)"""
     result = await hardware_location_collection.delete_many({"bus_mac": mac_address})
@@ -1,11 +1,11 @@
-from motor.motor_asyncio import AsyncIOMotorClient
-from core.config import settings
+from core.mongo import get_client, get_collection, get_database
 
-# Create a single client instance
-client = AsyncIOMotorClient(str(settings.MONGODB_URL))
+# Shared client (pool size, timeouts and write concerns from settings, see
+# core/mongo.py); it connects lazily on the first operation
+client = get_client()
 
 # Get a reference to the database
-db = client.get_database()
+db = get_database()
 
-# You can also access collections directly, e.g., db.buses
-# This setup allows us to import 'db' from this module in other parts of the app.
+# Collections with a per-collection write concern should come from
+# get_collection(name) rather than db[name].
@@ -0,0 +1,275 @@
+"""
+Firmware Delta Module
+Binary patches between firmware versions so devices only download changes.
+
+Patch format (little-endian), modelled on bsdiff's control/diff/extra split:
+
+    header  "SUTD" | u8 format version | u32 base size | u32 target size
+            | 32B base SHA-256 | 32B target SHA-256
+    body    zlib stream of ops:
+            0x01 ADD    u32 base offset | u32 length | <length> diff bytes
+                        target[i] = (base[off + i] + diff[i]) & 0xFF
+            0x02 INSERT u32 length | <length> literal bytes
+
+Matching is rsync-style: base blocks are indexed by content, every target
+offset is probed, and matches are extended forward through "mostly equal"
+windows. Relocated code differs only in a few address bytes, so the diff
+bytes are mostly zero and compress very well.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+from typing import Dict, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from .firmware import FirmwareStore, TEMP_PREFIX, firmware_filename, version_key
+
+MAGIC = b"SUTD"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sBII32s32s")
+
+OP_ADD = 0x01
+OP_INSERT = 0x02
+
+BLOCK_SIZE = 32          # Bytes per indexed base block
+APPROX_WINDOW = 32       # Window used to extend matches through small changes
+APPROX_MIN_EQUAL = 16    # Equal bytes per window needed to keep extending
+COMPARE_CHUNK = 4096
+
+# Deltas larger than this fraction of the full image aren't worth serving
+MAX_DELTA_RATIO = 0.8
+
+
+class DeltaError(Exception):
+    """Raised when a patch is malformed or doesn't match the base image."""
+
+
+def _exact_prefix(a: bytes, a_off: int, b: bytes, b_off: int) -> int:
+    """Length of the common run a[a_off:] == b[b_off:]."""
+    limit = min(len(a) - a_off, len(b) - b_off)
+    n = 0
+    # Compare big chunks first, then narrow down on the mismatching chunk
+    while n + COMPARE_CHUNK <= limit and a[a_off + n:a_off + n + COMPARE_CHUNK] == b[b_off + n:b_off + n + COMPARE_CHUNK]:
+        n += COMPARE_CHUNK
+    while n < limit and a[a_off + n] == b[b_off + n]:
+        n += 1
+    return n
+
+
+def _window_equal(a: bytes, a_off: int, b: bytes, b_off: int, size: int) -> int:
+    return sum(1 for x, y in zip(a[a_off:a_off + size], b[b_off:b_off + size]) if x == y)
+
+
+def _diff_bytes(target: bytes, t_off: int, base: bytes, b_off: int, length: int) -> bytes:
+    t = target[t_off:t_off + length]
+    b = base[b_off:b_off + length]
+    if t == b:
+        return bytes(length)
+    return bytes((x - y) & 0xFF for x, y in zip(t, b))
+
+
+def make_patch(base: bytes, target: bytes) -> bytes:
+    """Build a patch that turns `base` into `target`."""
+    index: Dict[bytes, int] = {}
+    for off in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(base[off:off + BLOCK_SIZE], off)
+
+    ops: List[bytes] = []
+
+    def emit_insert(start: int, end: int):
+        if end > start:
+            ops.append(struct.pack("<BI", OP_INSERT, end - start))
+            ops.append(target[start:end])
+
+    n = len(target)
+    literal_start = 0
+    i = 0
+    while i <= n - BLOCK_SIZE:
+        j = index.get(target[i:i + BLOCK_SIZE])
+        if j is None:
+            i += 1
+            continue
+
+        # Extend backwards into the pending literal run
+        back = 0
+        while back < i - literal_start and back < j and target[i - back - 1] == base[j - back - 1]:
+            back += 1
+        start_t, start_b = i - back, j - back
+
+        # Extend forwards: exact runs joined by mostly-equal windows
+        end_t = i + BLOCK_SIZE
+        end_b = j + BLOCK_SIZE
+        while True:
+            run = _exact_prefix(target, end_t, base, end_b)
+            end_t += run
+            end_b += run
+            if end_t + APPROX_WINDOW > n or end_b + APPROX_WINDOW > len(base):
+                break
+            if _window_equal(target, end_t, base, end_b, APPROX_WINDOW) < APPROX_MIN_EQUAL:
+                break
+            end_t += APPROX_WINDOW
+            end_b += APPROX_WINDOW
+
+        emit_insert(literal_start, start_t)
+        length = end_t - start_t
+        ops.append(struct.pack("<BII", OP_ADD, start_b, length))
+        ops.append(_diff_bytes(target, start_t, base, start_b, length))
+
+        literal_start = i = end_t
+
+    emit_insert(literal_start, n)
+
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, len(base), len(target),
+        hashlib.sha256(base).digest(), hashlib.sha256(target).digest()
+    )
+    return header + zlib.compress(b"".join(ops), 9)
+
+
+def apply_patch(base: bytes, patch: bytes) -> bytes:
+    """Reference implementation of the device-side patcher."""
+    if len(patch) < HEADER.size:
+        raise DeltaError("Patch too short")
+    magic, fmt, base_size, target_size, base_sha, target_sha = HEADER.unpack_from(patch)
+    if magic != MAGIC or fmt != FORMAT_VERSION:
+        raise DeltaError("Unknown patch format")
+    if len(base) != base_size or hashlib.sha256(base).digest() != base_sha:
+        raise DeltaError("Base image does not match patch")
+
+    body = zlib.decompress(patch[HEADER.size:])
+    out = bytearray()
+    pos = 0
+    while pos < len(body):
+        op = body[pos]
+        if op == OP_ADD:
+            off, length = struct.unpack_from("<II", body, pos + 1)
+            pos += 9
+            diff = body[pos:pos + length]
+            pos += length
+            out.extend((x + y) & 0xFF for x, y in zip(base[off:off + length], diff))
+        elif op == OP_INSERT:
+            (length,) = struct.unpack_from("<I", body, pos + 1)
+            pos += 5
+            out.extend(body[pos:pos + length])
+            pos += length
+        else:
+            raise DeltaError(f"Unknown op {op}")
+
+    if len(out) != target_size or hashlib.sha256(out).digest() != target_sha:
+        raise DeltaError("Patched image does not match target")
+    return bytes(out)
+
+
+def delta_filename(device_type: str, from_version: str, to_version: str) -> str:
+    return f"{device_type}_{from_version}_to_{to_version}.delta"
+
+
+class DeltaCache:
+    """
+    Generates patches between stored firmware versions on demand and caches
+    them under <FIRMWARE_DIR>/deltas, keyed by the base/target hashes so a
+    re-uploaded version invalidates its stale patches.
+    """
+
+    def __init__(self, store: FirmwareStore):
+        self.store = store
+        self.directory = os.path.join(store.directory, "deltas")
+        self._locks: Dict[str, asyncio.Lock] = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path_for(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    async def previous_version(self, device_type: str, version: str) -> Optional[str]:
+        versions = sorted(
+            (e["version"] for e in await self.store.list_entries() if e["device_type"] == device_type),
+            key=version_key
+        )
+        older = [v for v in versions if version_key(v) < version_key(version)]
+        return older[-1] if older else None
+
+    async def get_delta(self, device_type: str, from_version: str, to_version: str) -> Optional[dict]:
+        """
+        Metadata of the (possibly freshly generated) patch, or None when either
+        image is unknown. `beneficial` is False when the patch isn't small
+        enough to be worth serving instead of the full image.
+        """
+        base_entry = await self.store.get_entry(firmware_filename(device_type, from_version))
+        target_entry = await self.store.get_entry(firmware_filename(device_type, to_version))
+        if not base_entry or not target_entry or base_entry["sha256"] == target_entry["sha256"]:
+            return None
+
+        filename = delta_filename(device_type, from_version, to_version)
+        lock = self._locks.setdefault(filename, asyncio.Lock())
+        async with lock:
+            meta = await run_in_threadpool(self._load_meta, filename)
+            if (meta and meta["base_sha256"] == base_entry["sha256"]
+                    and meta["target_sha256"] == target_entry["sha256"]):
+                return meta
+            return await run_in_threadpool(self._generate, filename, base_entry, target_entry)
+
+    async def precompute_for(self, device_type: str, version: str):
+        """Build the patch from the previous version (run after an upload)."""
+        try:
+            previous = await self.previous_version(device_type, version)
+            if previous:
+                meta = await self.get_delta(device_type, previous, version)
+                if meta:
+                    print(f"🧩 Firmware delta {meta['filename']}: {meta['size_bytes']} bytes "
+                          f"({meta['ratio']:.1%} of full image, {meta['generation_ms']} ms)")
+        except Exception as e:
+            print(f"⚠️ Could not precompute firmware delta for {device_type} v{version}: {e}")
+
+    def _load_meta(self, filename: str) -> Optional[dict]:
+        try:
+            with open(self.path_for(filename) + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta if os.path.exists(self.path_for(filename)) else None
+
+    def _generate(self, filename: str, base_entry: dict, target_entry: dict) -> dict:
+        with open(self.store.path_for(base_entry["filename"]), "rb") as f:
+            base = f.read()
+        with open(self.store.path_for(target_entry["filename"]), "rb") as f:
+            target = f.read()
+
+        started = time.perf_counter()
+        patch = make_patch(base, target)
+        generation_ms = int((time.perf_counter() - started) * 1000)
+
+        meta = {
+            "filename": filename,
+            "device_type": target_entry["device_type"],
+            "from_version": base_entry["version"],
+            "to_version": target_entry["version"],
+            "base_sha256": base_entry["sha256"],
+            "target_sha256": target_entry["sha256"],
+            "target_size_bytes": len(target),
+            "size_bytes": len(patch),
+            "sha256": hashlib.sha256(patch).hexdigest(),
+            "ratio": len(patch) / max(1, len(target)),
+            "beneficial": len(patch) < len(target) * MAX_DELTA_RATIO,
+            "generation_ms": generation_ms,
+        }
+        self._write_atomic(filename, patch)
+        self._write_atomic(filename + ".json", json.dumps(meta, indent=2).encode("utf-8"))
+        return meta
+
+    def _write_atomic(self, filename: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path_for(filename))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
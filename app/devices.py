@@ -0,0 +1,251 @@
+"""
+Device Registry Module
+In-memory fleet registry with heartbeat tracking and online/offline detection.
+
+Every MQTT message from a device refreshes its entry (last heartbeat,
+firmware version, message rate). Expiry uses a timing wheel: a device sits
+in the slot of the tick at which it goes stale, a heartbeat moves it to a
+new slot (O(1) set remove/add), and each tick only looks at the slot under
+the cursor, so detecting offline devices never scans the whole fleet or
+MongoDB.
+
+Online/offline transitions are queued and dispatched from the ticker task
+on the event loop, so listeners never run on the MQTT thread.
+
+Any MQTT client can make up device MACs, so entries do not live forever:
+offline devices are kept in the order they went offline and forgotten
+after `forget_after` seconds, or sooner (longest offline first) while the
+registry holds more than `max_devices`. A forgotten device that sends
+again is registered anew.
+"""
+
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+RATE_WINDOW_SECONDS = 60.0  # Time constant of the decayed message rate
+MAX_RECENT_EVENTS = 200
+
+
+class DeviceState:
+    __slots__ = (
+        "mac", "device_type", "firmware_version", "first_seen", "last_seen",
+        "last_seen_mono", "last_topic", "messages", "rate", "online", "slot", "deadline",
+    )
+
+    def __init__(self, mac: str, now_wall: float, now_mono: float):
+        self.mac = mac
+        self.device_type: Optional[str] = None
+        self.firmware_version: Optional[str] = None
+        self.first_seen = now_wall
+        self.last_seen = now_wall
+        self.last_seen_mono = now_mono
+        self.last_topic: Optional[str] = None
+        self.messages = 0
+        self.rate = 0.0
+        self.online = False
+        self.slot = -1
+        self.deadline = 0
+
+    def to_dict(self, now_mono: float) -> dict:
+        # Decay the rate to "now" so idle devices don't report a stale rate
+        idle = now_mono - self.last_seen_mono
+        return {
+            "mac_address": self.mac,
+            "device_type": self.device_type,
+            "firmware_version": self.firmware_version,
+            "online": self.online,
+            "last_seen": self.last_seen,
+            "seconds_since_seen": round(idle, 1),
+            "first_seen": self.first_seen,
+            "last_topic": self.last_topic,
+            "messages": self.messages,
+            "messages_per_minute": round(self.rate * math.exp(-idle / RATE_WINDOW_SECONDS) * 60, 2),
+        }
+
+
+class DeviceRegistry:
+    """
+    Args:
+        stale_after: Seconds without a message before a device is offline
+        tick: Timing wheel resolution in seconds
+        forget_after: Seconds offline before a device is dropped from the registry
+        max_devices: Devices kept before offline ones are dropped early
+    """
+
+    def __init__(self, stale_after: float = 60.0, tick: float = 1.0, forget_after: float = 86400.0,
+                 max_devices: int = 10000):
+        self.stale_after = stale_after
+        self.forget_after = forget_after
+        self.max_devices = max_devices
+        self.tick_seconds = tick
+        self.stale_ticks = max(1, math.ceil(stale_after / tick))
+        # One revolution covers the whole stale window, so every device in
+        # the slot under the cursor is due
+        self.wheel: List[set] = [set() for _ in range(self.stale_ticks + 1)]
+        self.current_tick = 0
+        self.started_mono = time.monotonic()
+
+        self.devices: Dict[str, DeviceState] = {}
+        self.offline: "OrderedDict[str, float]" = OrderedDict()  # mac -> went offline (monotonic), oldest first
+        self._lock = threading.Lock()
+        self._pending_events: Deque[dict] = deque()
+        self.recent_events: Deque[dict] = deque(maxlen=MAX_RECENT_EVENTS)
+        self.listeners: List[Callable[[dict], None]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def _tick_for(self, now_mono: float) -> int:
+        return int((now_mono - self.started_mono) / self.tick_seconds)
+
+    # --- Updates (any thread) ---
+
+    def record(self, mac: str, topic: Optional[str] = None, firmware_version: Optional[str] = None,
+               device_type: Optional[str] = None):
+        """Register a message from `mac`; safe to call from the MQTT thread."""
+        now_wall = time.time()
+        now_mono = time.monotonic()
+        with self._lock:
+            device = self.devices.get(mac)
+            if device is None:
+                device = self.devices[mac] = DeviceState(mac, now_wall, now_mono)
+                if len(self.devices) > self.max_devices:
+                    self._forget(now_mono)
+            else:
+                dt = now_mono - device.last_seen_mono
+                device.rate *= math.exp(-dt / RATE_WINDOW_SECONDS)
+
+            device.rate += 1.0 / RATE_WINDOW_SECONDS
+            device.messages += 1
+            device.last_seen = now_wall
+            device.last_seen_mono = now_mono
+            device.last_topic = topic
+            if firmware_version:
+                device.firmware_version = str(firmware_version)[:32]
+            if device_type:
+                device.device_type = str(device_type)[:32]
+
+            # Move to the slot of the new deadline
+            deadline = max(self._tick_for(now_mono), self.current_tick) + self.stale_ticks
+            slot = deadline % len(self.wheel)
+            if device.slot != slot:
+                if device.slot >= 0:
+                    self.wheel[device.slot].discard(mac)
+                self.wheel[slot].add(mac)
+                device.slot = slot
+            device.deadline = deadline
+
+            if not device.online:
+                self.offline.pop(mac, None)
+                device.online = True
+                self._pending_events.append({"event": "online", "mac_address": mac, "timestamp": now_wall})
+
+    # --- Expiry (event loop) ---
+
+    def advance(self, now_mono: Optional[float] = None) -> List[dict]:
+        """Advance the wheel to `now` and return the events produced."""
+        now_mono = time.monotonic() if now_mono is None else now_mono
+        target = self._tick_for(now_mono)
+        with self._lock:
+            while self.current_tick < target:
+                self.current_tick += 1
+                slot = self.current_tick % len(self.wheel)
+                bucket = self.wheel[slot]
+                for mac in list(bucket):
+                    device = self.devices[mac]
+                    if device.deadline <= self.current_tick:
+                        bucket.discard(mac)
+                        device.slot = -1
+                        device.online = False
+                        self.offline[mac] = now_mono
+                        self._pending_events.append({"event": "offline", "mac_address": mac, "timestamp": time.time()})
+            self._forget(now_mono)
+
+            events = list(self._pending_events)
+            self._pending_events.clear()
+        return events
+
+    def _forget(self, now_mono: float):
+        """Drop devices offline for forget_after, then longest offline first while over max_devices (lock held)."""
+        offline = self.offline
+        while offline:
+            mac, since = next(iter(offline.items()))
+            if now_mono - since < self.forget_after and len(self.devices) <= self.max_devices:
+                break
+            offline.popitem(last=False)
+            del self.devices[mac]
+
+    def _dispatch(self, events: List[dict]):
+        for event in events:
+            self.recent_events.append(event)
+            logger.info("%s Device %s %s", '🟢' if event['event'] == 'online' else '🔴', event['mac_address'], event['event'])
+            for listener in self.listeners:
+                try:
+                    listener(event)
+                except Exception as e:
+                    logger.error("Error in device event listener: %s", e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick_seconds)
+            try:
+                self._dispatch(self.advance())
+            except Exception as e:
+                logger.error("Error advancing device registry: %s", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # --- Queries ---
+
+    def snapshot(self, online: Optional[bool] = None, device_type: Optional[str] = None) -> List[dict]:
+        now_mono = time.monotonic()
+        with self._lock:
+            devices = [
+                d.to_dict(now_mono) for d in self.devices.values()
+                if (online is None or d.online == online)
+                and (device_type is None or d.device_type == device_type)
+            ]
+        return sorted(devices, key=lambda d: d["mac_address"])
+
+    def get(self, mac: str) -> Optional[dict]:
+        with self._lock:
+            device = self.devices.get(mac)
+            return device.to_dict(time.monotonic()) if device else None
+
+    def online_macs(self, device_type: Optional[str] = None) -> List[str]:
+        with self._lock:
+            return [
+                mac for mac, d in self.devices.items()
+                if d.online and (device_type is None or d.device_type == device_type)
+            ]
+
+    def counts(self) -> dict:
+        with self._lock:
+            online = sum(1 for d in self.devices.values() if d.online)
+            return {"total": len(self.devices), "online": online, "offline": len(self.devices) - online}
+
+
+# Shared registry (updated from the MQTT thread, expired on the main loop)
+registry = DeviceRegistry(
+    stale_after=settings.DEVICE_STALE_SECONDS,
+    forget_after=settings.DEVICE_FORGET_SECONDS,
+    max_devices=settings.DEVICE_MAX_TRACKED,
+)
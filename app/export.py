@@ -0,0 +1,169 @@
+"""
+History Export Module
+Streams hardware_locations as NDJSON, CSV or Arrow IPC.
+
+Rows are read in (timestamp, _id) keyset pages of EXPORT_BATCH_SIZE and
+each page is serialized and sent before the next is fetched, so memory is
+bounded by one page regardless of the time range. Every row carries its
+`id` and `timestamp`; an interrupted export resumes with
+after=<timestamp>_<id> from the last row received.
+
+Arrow IPC needs the optional `pyarrow` package (not in requirements.txt).
+"""
+
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, Optional, Tuple
+
+from bson import ObjectId
+
+from app import crud
+
+try:
+    import pyarrow as pa
+except ImportError:  # Optional: only needed for format=arrow
+    pa = None
+
+EXPORT_BATCH_SIZE = 2000
+EXPORT_FIELDS = ["id", "timestamp", "bus_mac", "lat", "lon", "pm2_5", "pm10"]
+PROJECTION = {"_id": 1, "timestamp": 1, "bus_mac": 1, "lat": 1, "lon": 1, "pm2_5": 1, "pm10": 1}
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def build_query(start: Optional[datetime] = None, end: Optional[datetime] = None,
+                bus_mac: Optional[str] = None) -> dict:
+    query: dict = {}
+    if start or end:
+        query["timestamp"] = {}
+        if start:
+            query["timestamp"]["$gte"] = start
+        if end:
+            query["timestamp"]["$lt"] = end
+    if bus_mac:
+        query["bus_mac"] = bus_mac
+    return query
+
+
+def parse_cursor(value: str) -> Tuple[datetime, ObjectId]:
+    """"2025-01-31T08:00:00.123000_65b9..." -> (timestamp, ObjectId)"""
+    timestamp, sep, oid = value.rpartition("_")
+    if not sep or not ObjectId.is_valid(oid):
+        raise ExportError("Invalid cursor, expected <timestamp>_<id> from the last exported row")
+    try:
+        return datetime.fromisoformat(timestamp), ObjectId(oid)
+    except ValueError:
+        raise ExportError("Invalid cursor timestamp")
+
+
+def _row(doc: dict) -> dict:
+    timestamp = doc.get("timestamp")
+    return {
+        "id": str(doc["_id"]),
+        "timestamp": timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp,
+        "bus_mac": doc.get("bus_mac"),
+        "lat": doc.get("lat"),
+        "lon": doc.get("lon"),
+        "pm2_5": doc.get("pm2_5"),
+        "pm10": doc.get("pm10"),
+    }
+
+
+async def iter_pages(query: dict, after: Optional[Tuple] = None, limit: Optional[int] = None,
+                     batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[list]:
+    """Yield pages of rows until the query (or `limit` rows) is exhausted."""
+    sent = 0
+    while limit is None or sent < limit:
+        size = batch_size if limit is None else min(batch_size, limit - sent)
+        docs = await crud.get_hardware_location_page(query, after=after, limit=size, projection=PROJECTION)
+        if not docs:
+            return
+        last = docs[-1]
+        after = (last.get("timestamp"), last["_id"])
+        sent += len(docs)
+        yield [_row(doc) for doc in docs]
+        if len(docs) < size:
+            return
+
+
+async def _ndjson(pages) -> AsyncIterator[bytes]:
+    async for rows in pages:
+        yield ("\n".join(json.dumps(row, separators=(",", ":")) for row in rows) + "\n").encode()
+
+
+async def _csv(pages) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, lineterminator="\n")
+    writer.writeheader()
+    async for rows in pages:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _arrow_schema():
+    return pa.schema([
+        ("id", pa.string()),
+        ("timestamp", pa.timestamp("ms")),
+        ("bus_mac", pa.string()),
+        ("lat", pa.float64()),
+        ("lon", pa.float64()),
+        ("pm2_5", pa.float64()),
+        ("pm10", pa.float64()),
+    ])
+
+
+async def _arrow(pages) -> AsyncIterator[bytes]:
+    schema = _arrow_schema()
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+
+    def drain() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    async for rows in pages:
+        for row in rows:
+            row["timestamp"] = datetime.fromisoformat(row["timestamp"]) if row["timestamp"] else None
+        writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+        yield drain()
+    writer.close()
+    yield drain()
+
+
+async def _gzip(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(fmt: str, query: dict, after: Optional[Tuple] = None, limit: Optional[int] = None,
+                  gzip: bool = False) -> AsyncIterator[bytes]:
+    """Byte stream for `fmt` (ndjson, csv or arrow); raises ExportError up front."""
+    if fmt not in FORMATS:
+        raise ExportError(f"Invalid format. Must be one of: {list(FORMATS)}")
+    if fmt == "arrow" and pa is None:
+        raise ExportError("Arrow export requires the pyarrow package on the server")
+
+    pages = iter_pages(query, after=after, limit=limit)
+    stream = {"ndjson": _ndjson, "csv": _csv, "arrow": _arrow}[fmt](pages)
+    return _gzip(stream) if gzip else stream
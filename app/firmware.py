@@ -0,0 +1,451 @@
+"""
+Firmware Storage Module
+Streams OTA firmware uploads to disk, keeps a manifest of stored images and
+serves them to devices.
+
+Uploads are written chunk by chunk to a temporary file in the firmware
+directory (so the final rename is atomic), the size limit is enforced while
+streaming, and SHA-256/MD5 digests are computed on the fly. The manifest
+(manifest.json) caches size, mtime and hashes so listings don't have to
+stat or re-hash every binary.
+
+Downloads support single-range requests (resumable OTA), ETag/If-None-Match
+from the manifest hash, zero-copy sends when the ASGI server offers them,
+and a cap on concurrent downloads.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import anyio
+from fastapi import Request, UploadFile
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Receive, Scope, Send
+
+CHUNK_SIZE = 64 * 1024  # 64KB per read/write
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+MANIFEST_FILENAME = "manifest.json"
+TEMP_PREFIX = ".upload-"
+
+VALID_DEVICE_TYPES = ["esp32_cam", "pm"]
+
+# Versions end up in filenames, so keep them to a safe character set
+VERSION_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,31}$")
+
+
+class FirmwareTooLarge(Exception):
+    """Raised when an upload exceeds the configured size limit."""
+
+
+def firmware_filename(device_type: str, version: str) -> str:
+    return f"{device_type}_{version}.bin"
+
+
+def is_valid_version(version: str) -> bool:
+    return bool(VERSION_PATTERN.match(version or ""))
+
+
+def version_key(version: str):
+    """Sort key for versions like "1.0.10" (numeric parts compare numerically)."""
+    parts = re.split(r"[._-]", version)
+    return tuple((0, int(p), "") if p.isdigit() else (1, 0, p) for p in parts)
+
+
+def parse_firmware_filename(filename: str):
+    """Split "<device_type>_<version>.bin" into (device_type, version)."""
+    stem = filename[:-4] if filename.endswith(".bin") else filename
+    for device_type in VALID_DEVICE_TYPES:
+        if stem.startswith(device_type + "_"):
+            return device_type, stem[len(device_type) + 1:]
+    # Legacy behaviour: split on the first underscore
+    parts = stem.split("_")
+    device_type = parts[0] if parts else "unknown"
+    version = "_".join(parts[1:]) if len(parts) > 1 else "unknown"
+    return device_type, version
+
+
+def _hash_file(filepath: str):
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+class FirmwareStore:
+    """
+    Firmware binaries on disk plus an in-memory/JSON manifest of their hashes.
+
+    Manifest mutations happen from the thread pool, so they are guarded by
+    a lock and persisted with write-to-temp + os.replace.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, dict]] = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST_FILENAME)
+
+    def path_for(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    # --- Manifest persistence ---
+
+    def _load_manifest(self) -> Dict[str, dict]:
+        if self._entries is None:
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f).get("files", {})
+            except FileNotFoundError:
+                self._entries = {}
+            except Exception as e:
+                print(f"⚠️ Firmware manifest unreadable, rebuilding: {e}")
+                self._entries = {}
+        return self._entries
+
+    def _save_manifest(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=TEMP_PREFIX, suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"updated": time.time(), "files": self._entries}, f, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _build_entry(self, filename: str, size: int, sha256: str, md5: str, modified: float) -> dict:
+        device_type, version = parse_firmware_filename(filename)
+        return {
+            "filename": filename,
+            "device_type": device_type,
+            "version": version,
+            "size_bytes": size,
+            "modified": modified,
+            "sha256": sha256,
+            "md5": md5,
+        }
+
+    def _sync_manifest(self) -> Dict[str, dict]:
+        """
+        Reconcile the manifest with the directory listing.
+        Only files missing from the manifest (e.g. copied in by hand) are
+        stat'ed and hashed; known files are served from the manifest.
+        """
+        with self._lock:
+            entries = self._load_manifest()
+            on_disk = {
+                name for name in os.listdir(self.directory)
+                if name.endswith(".bin") and not name.startswith(TEMP_PREFIX)
+            }
+            changed = False
+
+            for name in list(entries):
+                if name not in on_disk:
+                    del entries[name]
+                    changed = True
+
+            for name in on_disk - entries.keys():
+                filepath = self.path_for(name)
+                try:
+                    stat = os.stat(filepath)
+                    sha256, md5 = _hash_file(filepath)
+                except OSError as e:
+                    print(f"⚠️ Could not index firmware {name}: {e}")
+                    continue
+                entries[name] = self._build_entry(name, stat.st_size, sha256, md5, stat.st_mtime)
+                changed = True
+
+            if changed:
+                self._save_manifest()
+            return dict(entries)
+
+    # --- Public API ---
+
+    async def list_entries(self) -> List[dict]:
+        entries = await run_in_threadpool(self._sync_manifest)
+        return sorted(entries.values(), key=lambda e: e["filename"])
+
+    async def get_entry(self, filename: str) -> Optional[dict]:
+        entries = self._entries
+        if entries is None or filename not in entries:
+            entries = await run_in_threadpool(self._sync_manifest)
+        return entries.get(filename)
+
+    async def save_upload(self, upload: UploadFile, filename: str) -> dict:
+        """
+        Stream an UploadFile to disk and register it in the manifest.
+
+        Raises:
+            FirmwareTooLarge: if the upload exceeds max_size (nothing is kept)
+        """
+        # Reject early when the multipart parser already knows the size
+        if getattr(upload, "size", None) and upload.size > self.max_size:
+            raise FirmwareTooLarge(filename)
+
+        fd, tmp_path = await run_in_threadpool(
+            tempfile.mkstemp, dir=self.directory, prefix=TEMP_PREFIX, suffix=".part"
+        )
+        f = os.fdopen(fd, "wb")
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        size = 0
+
+        try:
+            while True:
+                chunk = await upload.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > self.max_size:
+                    raise FirmwareTooLarge(filename)
+                sha256.update(chunk)
+                md5.update(chunk)
+                await run_in_threadpool(f.write, chunk)
+
+            await run_in_threadpool(self._commit, f, tmp_path, filename)
+        except BaseException:
+            f.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        entry = self._build_entry(filename, size, sha256.hexdigest(), md5.hexdigest(), time.time())
+        await run_in_threadpool(self._register, entry)
+        return entry
+
+    def _commit(self, f, tmp_path: str, filename: str):
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(tmp_path, self.path_for(filename))
+
+    def _register(self, entry: dict):
+        with self._lock:
+            entries = self._load_manifest()
+            entries[entry["filename"]] = entry
+            self._save_manifest()
+
+
+# =============================================================================
+# Downloads
+# =============================================================================
+
+class DownloadTracker:
+    """
+    Counts in-flight firmware downloads and rejects new ones above the cap.
+    Only touched from the event loop, so plain integers are enough.
+    """
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.peak = 0
+        self.started = 0
+        self.completed = 0
+        self.aborted = 0
+        self.rejected = 0
+        self.partial = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+
+    def try_acquire(self) -> bool:
+        if self.max_concurrent > 0 and self.active >= self.max_concurrent:
+            self.rejected += 1
+            return False
+        self.active += 1
+        self.started += 1
+        self.peak = max(self.peak, self.active)
+        return True
+
+    def release(self, bytes_sent: int, completed: bool):
+        self.active -= 1
+        self.bytes_sent += bytes_sent
+        if completed:
+            self.completed += 1
+        else:
+            self.aborted += 1
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "peak": self.peak,
+            "started": self.started,
+            "completed": self.completed,
+            "aborted": self.aborted,
+            "rejected": self.rejected,
+            "partial": self.partial,
+            "not_modified": self.not_modified,
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+def parse_range_header(value: str, size: int):
+    """
+    Parse a single "bytes=" range against a file of `size` bytes.
+
+    Returns:
+        (start, end) inclusive, None if the header should be ignored
+        (malformed or multi-range), or "unsatisfiable".
+    """
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    spec = value[len("bytes="):].strip()
+    start_str, sep, end_str = spec.partition("-")
+    if not sep:
+        return None
+    try:
+        if start_str == "":
+            # Suffix range: last N bytes
+            length = int(end_str)
+            if length <= 0:
+                return "unsatisfiable"
+            return max(0, size - length), size - 1
+        start = int(start_str)
+        end = int(end_str) if end_str else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return "unsatisfiable"
+    if start < 0 or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    # Weak comparison, as required for If-None-Match
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+class FirmwareFileResponse(Response):
+    """
+    Sends bytes [start, end] of a firmware file.
+    Uses the ASGI zero-copy extension when the server supports it,
+    otherwise streams fixed-size chunks read in a worker thread.
+    """
+
+    def __init__(self, path: str, start: int, end: int, status_code: int,
+                 headers: dict, tracker: DownloadTracker):
+        super().__init__(status_code=status_code, headers=headers, media_type="application/octet-stream")
+        self.path = path
+        self.start = start
+        self.end = end
+        self.tracker = tracker
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        length = self.end - self.start + 1
+        remaining = length
+        sent = 0
+        completed = False
+        # Everything that can raise (a client gone before the headers) is inside
+        # the try: the download slot is always released
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            })
+
+            if scope.get("method") == "HEAD":
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                completed = True
+                return
+
+            if ZEROCOPY_EXTENSION in scope.get("extensions", {}):
+                with open(self.path, "rb") as f:
+                    await send({
+                        "type": ZEROCOPY_EXTENSION,
+                        "file": f,
+                        "offset": self.start,
+                        "count": remaining,
+                        "more_body": False,
+                    })
+                sent = remaining
+            else:
+                async with await anyio.open_file(self.path, mode="rb") as f:
+                    await f.seek(self.start)
+                    while remaining > 0:
+                        chunk = await f.read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        sent += len(chunk)
+                        await send({
+                            "type": "http.response.body",
+                            "body": chunk,
+                            "more_body": remaining > 0,
+                        })
+                    if remaining > 0 or sent == 0:
+                        # File shrank underneath us, or it is empty: terminate the body
+                        await send({"type": "http.response.body", "body": b"", "more_body": False})
+            completed = sent == length
+        finally:
+            self.tracker.release(sent, completed=completed)
+
+
+def build_download_response(request: Request, entry: dict, filepath: str,
+                            tracker: DownloadTracker, extra_headers: Optional[dict] = None) -> Response:
+    """
+    Build the response for a firmware download, honouring
+    If-None-Match, Range/If-Range and the concurrent download cap.
+    """
+    size = os.stat(filepath).st_size
+    etag = f'"{entry["sha256"]}"'
+    headers = {
+        "etag": etag,
+        "accept-ranges": "bytes",
+        "cache-control": "no-cache",
+        "content-disposition": f'attachment; filename="{entry["filename"]}"',
+        **(extra_headers or {}),
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        tracker.not_modified += 1
+        return Response(status_code=304, headers=headers)
+
+    start, end, status_code = 0, size - 1, 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        parsed = parse_range_header(range_header, size)
+        if parsed == "unsatisfiable":
+            headers["content-range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        if parsed is not None:
+            start, end = parsed
+            status_code = 206
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+
+    if not tracker.try_acquire():
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Too many concurrent firmware downloads, retry later"},
+            headers={"retry-after": "5"},
+        )
+
+    if status_code == 206:
+        tracker.partial += 1
+    headers["content-length"] = str(end - start + 1)
+    return FirmwareFileResponse(filepath, start, end, status_code, headers, tracker)
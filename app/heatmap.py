@@ -0,0 +1,41 @@
+"""
+Heatmap Module
+Helpers for sizing heatmap queries to what the client can actually show.
+
+Web maps use 256px tiles: at zoom z the world is 256 * 2^z pixels wide, so
+one pixel spans 360 / (256 * 2^z) degrees of longitude. Binning readings
+into cells of a few pixels gives at most one point per visible cell, which
+looks the same once the client applies its heatmap blur radius.
+"""
+
+from typing import Optional, Tuple
+
+TILE_SIZE = 256
+LOD_CELL_PIXELS = 4      # Cell edge in screen pixels
+MIN_ZOOM = 0
+MAX_ZOOM = 22
+
+BBox = Tuple[float, float, float, float]  # (min_lon, min_lat, max_lon, max_lat)
+
+
+def degrees_per_pixel(zoom: int) -> float:
+    return 360.0 / (TILE_SIZE * (2 ** zoom))
+
+
+def lod_cell_degrees(zoom: int, cell_pixels: int = LOD_CELL_PIXELS) -> float:
+    """Cell edge in degrees for `cell_pixels` screen pixels at `zoom`."""
+    zoom = max(MIN_ZOOM, min(MAX_ZOOM, zoom))
+    return degrees_per_pixel(zoom) * cell_pixels
+
+
+def parse_bbox(value: Optional[str]) -> Optional[BBox]:
+    """"min_lon,min_lat,max_lon,max_lat" -> tuple; raises ValueError if malformed."""
+    if not value:
+        return None
+    parts = [float(p) for p in value.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    min_lon, min_lat, max_lon, max_lat = parts
+    if not (-180 <= min_lon < max_lon <= 180 and -90 <= min_lat < max_lat <= 90):
+        raise ValueError("bbox out of range or empty")
+    return min_lon, min_lat, max_lon, max_lat
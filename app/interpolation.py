@@ -0,0 +1,290 @@
+"""
+Spatial Interpolation Module
+Smooth PM2.5 surfaces between bus routes (/api/heatmap?mode=interpolated).
+
+Input is the zone averages behind analytics.get_zone_heatmap_data (one
+point per ~111m zone, weighted by its reading count). Each cell of a
+regular grid takes the K nearest zones within `radius_m` from a KD-tree
+and combines them with either:
+
+    idw:      w = count / d^power           (inverse-distance weighting)
+    gaussian: w = count * exp(-d^2 / 2s^2)  (kernel smoothing, s = radius / 3)
+
+Cells with no zone inside the radius stay empty, so the surface does not
+invent air quality far from any bus. Distances are metres on a local
+equirectangular projection, which is exact enough at city scale.
+
+Zone sums are fetched per time bucket (the same buckets and windows as the
+heatmap tiles) and closed buckets never change, so a request only queries
+MongoDB for buckets closed since the last one. The bucket still open is
+part of the window too (a day-long bucket would otherwise hide a day of
+readings); it is re-read at most every OPEN_BUCKET_TTL_SECONDS, and
+finished surfaces are cached until then.
+"""
+
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from app import analytics
+from app.heatmap import BBox
+from app.tiles import TILE_RANGES
+from core.config import settings
+from core.metrics import REGISTRY
+
+METHODS = ("idw", "gaussian")
+MAX_RESOLUTION = 1000        # Grid cells along the longer side
+DEFAULT_RADIUS_M = 300.0
+DEFAULT_NEIGHBORS = 8
+IDW_POWER = 2.0
+MIN_DISTANCE_M = 1.0         # Keeps IDW finite on top of a zone centre
+QUERY_CHUNK = 250000         # Grid cells per KD-tree query (bounds memory)
+OPEN_BUCKET_TTL_SECONDS = 60  # The bucket still filling is re-read at most this often
+METERS_PER_DEG_LAT = 110540.0
+METERS_PER_DEG_LON = 111320.0  # At the equator; scaled by cos(latitude)
+
+SURFACE_CACHE_HITS = REGISTRY.counter("interpolation_cache_hits_total", "Interpolated surfaces served from cache")
+SURFACE_SECONDS = REGISTRY.histogram(
+    "interpolation_seconds", "Time to interpolate a PM2.5 surface",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+
+
+def interpolate_grid(lats: np.ndarray, lons: np.ndarray, values: np.ndarray, weights: np.ndarray,
+                     bounds: BBox, width: int, height: int, method: str = "idw",
+                     radius_m: float = DEFAULT_RADIUS_M, neighbors: int = DEFAULT_NEIGHBORS) -> np.ndarray:
+    """
+    (height, width) grid of interpolated values over bounds
+    (min_lon, min_lat, max_lon, max_lat); row 0 is the northern edge,
+    NaN where no sample lies within radius_m.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown interpolation method: {method}")
+    grid = np.full((height, width), np.nan)
+    if len(values) == 0:
+        return grid
+
+    min_lon, min_lat, max_lon, max_lat = bounds
+    lat0 = math.radians((min_lat + max_lat) / 2)
+    scale = np.array([METERS_PER_DEG_LON * math.cos(lat0), METERS_PER_DEG_LAT])
+    tree = cKDTree(np.column_stack([lons, lats]) * scale)
+
+    # Cell centres, row-major from the north-west corner
+    cell_lons = min_lon + (np.arange(width) + 0.5) * (max_lon - min_lon) / width
+    cell_lats = max_lat - (np.arange(height) + 0.5) * (max_lat - min_lat) / height
+    k = min(neighbors, len(values))
+    sigma = radius_m / 3.0
+    flat = grid.reshape(-1)
+
+    for start in range(0, width * height, QUERY_CHUNK):
+        index = np.arange(start, min(start + QUERY_CHUNK, width * height))
+        points = np.column_stack([cell_lons[index % width], cell_lats[index // width]]) * scale
+        dist, idx = tree.query(points, k=k, distance_upper_bound=radius_m)
+        if k == 1:
+            dist, idx = dist[:, None], idx[:, None]
+
+        found = np.isfinite(dist)
+        idx = np.where(found, idx, 0)  # Missing neighbours come back as idx == n
+        if method == "idw":
+            w = weights[idx] / np.maximum(dist, MIN_DISTANCE_M) ** IDW_POWER
+        else:
+            w = weights[idx] * np.exp(-0.5 * (np.where(found, dist, 0.0) / sigma) ** 2)
+        w = np.where(found, w, 0.0)
+
+        total = w.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            flat[index] = np.where(total > 0, (w * values[idx]).sum(axis=1) / total, np.nan)
+    return grid
+
+
+def grid_shape(bounds: BBox, resolution: int) -> Tuple[int, int]:
+    """(width, height) with `resolution` cells on the longer side and square cells on the ground."""
+    min_lon, min_lat, max_lon, max_lat = bounds
+    lat0 = math.radians((min_lat + max_lat) / 2)
+    w_m = (max_lon - min_lon) * METERS_PER_DEG_LON * math.cos(lat0)
+    h_m = (max_lat - min_lat) * METERS_PER_DEG_LAT
+    if w_m >= h_m:
+        return resolution, max(1, round(resolution * h_m / w_m))
+    return max(1, round(resolution * w_m / h_m)), resolution
+
+
+def data_bounds(lats: np.ndarray, lons: np.ndarray, radius_m: float) -> Optional[BBox]:
+    """Extent of the samples padded by the radius (the area the surface can cover)."""
+    if len(lats) == 0:
+        return None
+    pad_lat = radius_m / METERS_PER_DEG_LAT
+    pad_lon = radius_m / (METERS_PER_DEG_LON * max(0.01, math.cos(math.radians(float(lats.mean())))))
+    return (float(lons.min()) - pad_lon, float(lats.min()) - pad_lat,
+            float(lons.max()) + pad_lon, float(lats.max()) + pad_lat)
+
+
+def grid_to_points(grid: np.ndarray, bounds: BBox) -> List[dict]:
+    """Non-empty cells as heatmap points at the cell centres."""
+    height, width = grid.shape
+    min_lon, min_lat, max_lon, max_lat = bounds
+    rows, cols = np.nonzero(~np.isnan(grid))
+    lats = np.round(max_lat - (rows + 0.5) * (max_lat - min_lat) / height, 6)
+    lons = np.round(min_lon + (cols + 0.5) * (max_lon - min_lon) / width, 6)
+    weights = np.round(grid[rows, cols], 2)
+    return [{"latitude": lat, "longitude": lon, "weight": w}
+            for lat, lon, w in zip(lats.tolist(), lons.tolist(), weights.tolist())]
+
+
+class _Series:
+    """Time buckets of zone sums for one (grid_size, bus_mac, bucket_seconds)."""
+
+    def __init__(self):
+        self.buckets: Dict[int, Dict[Tuple[float, float], List[float]]] = {}  # Closed buckets
+        self.first: Optional[int] = None   # Loaded range [first, last]; first None = from the start
+        self.last: Optional[int] = None
+        self.from_start = False
+        self.open_key: Optional[Tuple[int, int]] = None  # (open bucket, refresh slot) of open_zones
+        self.open_zones: Dict[Tuple[float, float], List[float]] = {}
+
+
+class InterpolationEngine:
+    """
+    Incremental surfaces: bucket sums are fetched once with
+    `fetch_buckets` (analytics.get_zone_bucket_sums) and merged per window,
+    plus the open bucket re-read every OPEN_BUCKET_TTL_SECONDS; interpolation
+    runs in a worker thread and its result is cached per (parameters, open
+    bucket, refresh slot).
+    """
+
+    def __init__(self, fetch_buckets, cache_size: int = 64, max_series: int = 32):
+        self.fetch_buckets = fetch_buckets
+        self.cache_size = cache_size
+        self.max_series = max_series
+        self.series: "OrderedDict[tuple, _Series]" = OrderedDict()
+        self.surfaces: "OrderedDict[tuple, List[dict]]" = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    async def _load(self, key: tuple, first: Optional[int], last: int) -> _Series:
+        """Make sure buckets [first, last] of a series are loaded (first None = all history)."""
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = _Series()
+            while len(self.series) > self.max_series:
+                self.series.popitem(last=False)
+        self.series.move_to_end(key)
+
+        grid_size, bus_mac, bucket_seconds = key
+        if series.last is None:
+            missing = [(first, last)]
+        else:
+            missing = []
+            if not series.from_start and (first is None or first < series.first):
+                missing.append((first, min(series.first - 1, last)))
+            if last > series.last:
+                # A from-start series must stay contiguous; otherwise skip the gap
+                start = series.last + 1 if series.from_start or first is None else max(series.last + 1, first)
+                missing.append((start, last))
+
+        for start, end in missing:
+            rows = await self.fetch_buckets(start, end, bucket_seconds, grid_size=grid_size, bus_mac=bus_mac)
+            fetched: Dict[int, dict] = {}
+            for row in rows:
+                zone = fetched.setdefault(int(row["bucket"]), {})
+                zone[(row["lat"], row["lon"])] = [row["pm25_sum"], row["count"]]
+            series.buckets.update(fetched)
+
+        if series.last is None:
+            series.first, series.last, series.from_start = first, last, first is None
+        else:
+            series.from_start = series.from_start or first is None
+            series.first = first if first is not None and first < series.first else series.first
+            series.last = max(series.last, last)
+
+        # Buckets older than the window are only kept for a from-start series
+        if first is not None and not series.from_start:
+            for bucket in [b for b in series.buckets if b < first]:
+                del series.buckets[bucket]
+            series.first = first
+        return series
+
+    async def _load_open(self, key: tuple, series: _Series, bucket: int, refresh: int):
+        """Zone sums of the open `bucket`, fetched once per refresh slot."""
+        if series.open_key != (bucket, refresh):
+            grid_size, bus_mac, bucket_seconds = key
+            rows = await self.fetch_buckets(bucket, bucket, bucket_seconds, grid_size=grid_size, bus_mac=bus_mac)
+            series.open_zones = {(row["lat"], row["lon"]): [row["pm25_sum"], row["count"]] for row in rows}
+            series.open_key = (bucket, refresh)
+
+    @staticmethod
+    def _merge(series: _Series, first: Optional[int], last: int):
+        """Zones of the closed buckets [first, last] and of the open bucket."""
+        zones: Dict[Tuple[float, float], List[float]] = {}
+        selected = [bucket_zones for bucket, bucket_zones in series.buckets.items()
+                    if bucket <= last and (first is None or bucket >= first)]
+        for bucket_zones in selected + [series.open_zones]:
+            for zone, (pm_sum, count) in bucket_zones.items():
+                acc = zones.get(zone)
+                if acc is None:
+                    zones[zone] = [pm_sum, count]
+                else:
+                    acc[0] += pm_sum
+                    acc[1] += count
+        if not zones:
+            empty = np.empty(0)
+            return empty, empty, empty, empty
+        coords = np.array(list(zones.keys()), dtype=float)
+        sums = np.array(list(zones.values()), dtype=float)
+        return coords[:, 0], coords[:, 1], sums[:, 0] / sums[:, 1], sums[:, 1]
+
+    async def surface(self, range_key: str = "1d", method: str = "idw", resolution: int = 200,
+                      radius_m: float = DEFAULT_RADIUS_M, bbox: Optional[BBox] = None,
+                      grid_size: float = 0.001, bus_mac: Optional[str] = None,
+                      now: Optional[float] = None) -> List[dict]:
+        """Interpolated heatmap points for the window of `range_key` up to now."""
+        if method not in METHODS:
+            raise ValueError(f"Invalid interpolation method. Must be one of: {list(METHODS)}")
+        if range_key not in TILE_RANGES:
+            raise ValueError(f"Invalid range. Must be one of: {list(TILE_RANGES)}")
+        if not 1 <= resolution <= MAX_RESOLUTION:
+            raise ValueError(f"resolution must be between 1 and {MAX_RESOLUTION}")
+        if radius_m <= 0:
+            raise ValueError("radius must be positive")
+
+        window, bucket_seconds = TILE_RANGES[range_key]
+        now = time.time() if now is None else now
+        current = int(now // bucket_seconds)  # Open bucket; closed ones end at current - 1
+        first = current - math.ceil(window / bucket_seconds) + 1 if window else None
+        refresh = int(now // OPEN_BUCKET_TTL_SECONDS)
+
+        cache_key = (range_key, method, resolution, radius_m, bbox, grid_size, bus_mac, current, refresh)
+        cached = self.surfaces.get(cache_key)
+        if cached is not None:
+            self.surfaces.move_to_end(cache_key)
+            SURFACE_CACHE_HITS.inc()
+            return cached
+
+        async with self._lock:
+            series_key = (grid_size, bus_mac, bucket_seconds)
+            series = await self._load(series_key, first, current - 1)
+            await self._load_open(series_key, series, current, refresh)
+            lats, lons, values, weights = self._merge(series, first, current - 1)
+
+        bounds = bbox or data_bounds(lats, lons, radius_m)
+        if bounds is None:
+            points: List[dict] = []
+        else:
+            width, height = grid_shape(bounds, resolution)
+            started = time.perf_counter()
+            grid = await asyncio.to_thread(
+                interpolate_grid, lats, lons, values, weights, bounds, width, height, method, radius_m
+            )
+            points = await asyncio.to_thread(grid_to_points, grid, bounds)
+            SURFACE_SECONDS.observe(time.perf_counter() - started)
+
+        self.surfaces[cache_key] = points
+        while len(self.surfaces) > self.cache_size:
+            self.surfaces.popitem(last=False)
+        return points
+
+
+engine = InterpolationEngine(analytics.get_zone_bucket_sums, cache_size=settings.INTERPOLATION_CACHE_SIZE)
@@ -1,12 +1,15 @@
+# First import: startup timings include the imports below (see core/startup.py)
+from core.startup import Lazy, lazy_module, startup
 from fastapi import Depends, FastAPI, HTTPException, WebSocket, WebSocketDisconnect, File, UploadFile, BackgroundTasks, Body, Response, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import asyncio
 from datetime import datetime, timedelta
 import json
+import logging
 import os
 import time
 import sqlite3
@@ -15,12 +18,45 @@ from contextlib import asynccontextmanager
 from app import crud, models, schemas
 from app.schemas import BusLocation
 from core.config import settings
-from core.auth import APIKeyMiddleware
-from core.auth import APIKeyMiddleware
-from app.mqtt import client as mqtt_client, connect_mqtt, start_mqtt_loop, stop_mqtt_loop, set_main_loop, on_message as mqtt_on_message, TOPIC_APP_LOCATION, TOPIC_IR_TRIGGER, TOPIC_BUS_DOOR_COUNT
+from core.auth import APIKeyMiddleware, key_summary, load_api_keys
+from core.logger import SampledLogger, setup_logging, shutdown_logging
+from core.metrics import REGISTRY, MQTT_MESSAGES, MetricsMiddleware, monitor_event_loop_lag
+from core.mongo import ping as mongo_ping, pool_stats
+from core.profiling import MAX_SAMPLER_SECONDS, ProfilingMiddleware, profiler
+from core.ratelimit import MemoryBucketStore, MongoBucketStore, RateLimitMiddleware
+from app.firmware import FirmwareStore, FirmwareTooLarge, DownloadTracker, VALID_DEVICE_TYPES, build_download_response, firmware_filename, is_valid_version, version_key
+from app.mqtt import client as mqtt_client, ingest_executor, connect_mqtt, start_mqtt_loop, stop_mqtt_loop, set_main_loop, set_ota_ack_handler, on_message as mqtt_on_message, TOPIC_APP_LOCATION, TOPIC_IR_TRIGGER, TOPIC_BUS_DOOR_COUNT
+from app.delta import DeltaCache
+from app.heatmap import lod_cell_degrees, parse_bbox
+from app.tiles import ENCODERS as TILE_ENCODERS, TILE_MAX_AGE_SECONDS, TILE_RANGES, is_valid_tile, render_tile, tile_cache, time_window
+from app.pagination import InvalidCursor, decode_cursor, next_cursor
+from app.export import FORMATS as EXPORT_FORMATS, ExportError, build_query as build_export_query, export_stream, parse_cursor
+from app.devices import registry as device_registry
+from app.anomaly import detector as anomaly_detector
+from app.zones import zone_stats
+from app.spill import ingest_writer
+from app.tracking import tracker as gps_tracker
+from app.ota import Rollout, RolloutManager, firmware_url
+from app.route_catalog import RouteCatalog, is_valid_route_id
+
+# Optional subsystems, imported on first use (interpolation pulls in numpy/scipy)
+analytics = lazy_module("analytics", "app.analytics")
+interpolation_engine = lazy_module("interpolation", "app.interpolation", "engine")
+
+# Queue-based logging: hot paths never block on stdout
+setup_logging(
+    level=settings.LOG_LEVEL,
+    module_levels=settings.LOG_LEVELS,
+    fmt=settings.LOG_FORMAT,
+    sample_every=settings.LOG_SAMPLE_EVERY,
+    queue_size=settings.LOG_QUEUE_SIZE,
+)
+logger = logging.getLogger(__name__)
+count_logger = SampledLogger(__name__, every=1)  # Door counts are low-rate: log all
 
-TOPIC_BUS_STATUS = "sut/bus/+/status"
 DB_FILE = "bus_passengers.db"
+TOPIC_DEVICE_EVENTS = "sut/devices/events"
+TOPIC_PM_ALERTS = "sut/alerts/pm"
 
 # Initialize SQLite
 def init_db():
@@ -38,7 +74,6 @@ TOTAL_SEATS = 33
 async def lifespan(app: FastAPI):
     # Startup
     print("Starting application services...")
-    init_db()
     
     # Initialize state variables
     app.state.loop = asyncio.get_running_loop()
@@ -46,15 +81,20 @@ async def lifespan(app: FastAPI):
     # Pass the main loop to MQTT module for thread-safe DB operations
     set_main_loop(app.state.loop)
     
-    # Create DB indexes (optional - app will work without MongoDB)
-    try:
-        await crud.bus_collection.create_index("mac_address", unique=True)
-        await crud.blocked_mac_collection.create_index("mac_address", unique=True)
-        print("[OK] Successfully created database indexes.")
-    except Exception as e:
-        print(f"[WARN] Could not create database indexes: {e}")
-        print("The server will continue without MongoDB functionality")
-
+    # Device liveness: expire stale devices and publish online/offline events
+    device_registry.listeners.append(
+        lambda event: mqtt_client.publish(TOPIC_DEVICE_EVENTS, json.dumps(event))
+    )
+    device_registry.start()
+    
+    # PM anomaly alerts (published from the MQTT thread as readings arrive)
+    anomaly_detector.listeners.append(
+        lambda event: mqtt_client.publish(TOPIC_PM_ALERTS, json.dumps(event))
+    )
+    
+    # Event loop lag sampling for /metrics
+    app.state.loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+    
     # Define the MQTT on_message callback
     def on_message_handler(client, userdata, msg):
         try:
@@ -63,6 +103,7 @@ async def lifespan(app: FastAPI):
             # Handle Bus Door Count (New ESP32)
             if msg.topic == TOPIC_BUS_DOOR_COUNT:
                 global current_passengers
+                MQTT_MESSAGES.inc(labels=(msg.topic,))
                 try:
                     data = json.loads(payload)
                     timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
@@ -75,7 +116,7 @@ async def lifespan(app: FastAPI):
                     
                     # Update global count
                     current_passengers = data.get('count', current_passengers)
-                    print(f"[{timestamp}] {data.get('dir', 'unknown').upper()} - Total: {current_passengers}")
+                    count_logger.info("[%s] %s - Total: %s", timestamp, str(data.get('dir', 'unknown')).upper(), current_passengers)
                     
                     # --- SYNC WITH SEATS ---
                     seats_available = max(0, TOTAL_SEATS - current_passengers)
@@ -95,8 +136,7 @@ async def lifespan(app: FastAPI):
                              app_payload = updated_bus.dict()
                              client.publish(TOPIC_APP_LOCATION, json.dumps(app_payload))
                              
-                    loop = app.state.loop
-                    asyncio.run_coroutine_threadsafe(update_seats(), loop)
+                    ingest_executor.submit(update_seats, key=("seats", bus_mac), name="update_seats")
 
                     # --- APP COMPATIBILITY (Testing Screen) ---
                     # Publish dummy payloads to keep Testing Tab alive (showing stats only)
@@ -110,40 +150,86 @@ async def lifespan(app: FastAPI):
                     client.publish("sut/person-detection", json.dumps(detection_payload))
 
                 except Exception as e:
-                    print(f"Error processing bus count: {e}")
+                    logger.error("Error processing bus count: %s", e)
                 return
 
         except Exception as e:
-            print(f"Error in MQTT on_message_handler: {e}")
+            logger.error("Error in MQTT on_message_handler: %s", e)
             
         # Delegate other topics to the main mqtt module handler
         if msg.topic != TOPIC_BUS_DOOR_COUNT:
             mqtt_on_message(client, userdata, msg)
 
-    # Assign the handler and connect the MQTT client
+    # Assign the handler (the client connects in the "mqtt" startup phase)
     mqtt_client.on_message = on_message_handler
-    
-    print(f"Attempting to connect to MQTT Broker at {settings.MQTT_BROKER_HOST}:{settings.MQTT_BROKER_PORT}")
 
-    try:
-        connect_mqtt()
-        mqtt_client.subscribe(TOPIC_BUS_DOOR_COUNT)
-        # We don't subscribe to GPS/Status here anymore, the telemetry service handles it.
-        start_mqtt_loop()
-        print("[OK] MQTT client connected successfully")
-    except Exception as e:
-        print(f"[WARN] Could not connect to MQTT broker: {e}")
+    # One cheap round trip first: while MongoDB is down, index builds would each
+    # wait out the server selection timeout on Motor's small thread pool
+    async def check_mongo():
+        if not await mongo_ping():
+            raise ConnectionError("MongoDB unreachable")
+
+    # Create DB indexes (optional - app will work without MongoDB)
+    async def create_indexes():
+        indexes = [
+            crud.bus_collection.create_index("mac_address", unique=True),
+            crud.blocked_mac_collection.create_index("mac_address", unique=True),
+            # Keyset pagination (history export and cursor-paged list endpoints)
+            crud.hardware_location_collection.create_index([("timestamp", 1), ("_id", 1)]),
+            crud.hardware_location_collection.create_index([("bus_mac", 1), ("timestamp", 1), ("_id", 1)]),
+            crud.feedback_collection.create_index([("created_at", -1), ("_id", -1)]),
+        ]
+        if isinstance(rate_limit_store, MongoBucketStore):
+            indexes.append(rate_limit_store.ensure_indexes())
+        await asyncio.gather(*indexes)
+
+    # Readings spill to local disk while MongoDB is down and replay when it's back
+    async def start_spill_buffer():
+        await ingest_writer.start()
+        print(f"[OK] Ingest spill buffer: {ingest_writer.buffer.rows} readings pending replay")
+
+    # PM zone statistics: zones cached in memory, aggregates flushed in batches
+    async def start_zone_stats():
+        await zone_stats.start()
+        print(f"[OK] PM zone statistics: {len(zone_stats.zones)} zones")
+
+    # Readings are stored (or spilled) from the first message
+    async def start_mqtt():
+        print(f"Attempting to connect to MQTT Broker at {settings.MQTT_BROKER_HOST}:{settings.MQTT_BROKER_PORT}")
+        connected = await asyncio.to_thread(connect_mqtt)
+        # Topics (door counts included) are subscribed by on_connect in app/mqtt.py,
+        # on the first connect and on every reconnect
+        start_mqtt_loop()  # Keeps retrying the broker if the first connect failed
+        if not connected:
+            raise ConnectionError("MQTT broker unreachable, retrying in the background")
+
+    # Startup phases run concurrently in the background: /health answers at once,
+    # /health/ready once the required (local) ones are done (core/startup.py)
+    startup.add("sqlite", lambda: asyncio.to_thread(init_db))
+    startup.add("spill_buffer", start_spill_buffer)
+    startup.add("mongo", check_mongo, required=False)
+    startup.add("mongo_indexes", create_indexes, after=("mongo",), required=False)
+    startup.add("zone_stats", start_zone_stats, required=False)  # Retries its load if MongoDB is down
+    startup.add("mqtt", start_mqtt, after=("spill_buffer",), required=False)
+    startup.start()
 
     yield
 
     # Shutdown
     print("Shutting down application services...")
+    await startup.stop()
+    await device_registry.stop()
+    await zone_stats.stop()
+    await ingest_executor.drain()  # Queued readings still reach MongoDB or the spill buffer
+    await ingest_writer.stop()
+    app.state.loop_lag_task.cancel()
     try:
         stop_mqtt_loop()
     except Exception as e:
         print(f"Error stopping MQTT: {e}")
     
     print("Disconnected from services.")
+    shutdown_logging()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -151,13 +237,33 @@ app = FastAPI(lifespan=lifespan)
 # Mount static for dashboard or generic assets
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
-# Mount firmware directory for OTA updates
-if not os.path.exists(settings.FIRMWARE_DIR):
-    os.makedirs(settings.FIRMWARE_DIR)
-app.mount("/firmware", StaticFiles(directory=settings.FIRMWARE_DIR), name="firmware")
+# Rate limiting (token buckets per API key / client IP; runs inside auth so the key is known)
+rate_limit_store = None
+if settings.RATE_LIMIT_PER_MINUTE > 0:
+    _rate = settings.RATE_LIMIT_PER_MINUTE / 60.0
+    _burst = float(settings.RATE_LIMIT_BURST or settings.RATE_LIMIT_PER_MINUTE)
+    if settings.RATE_LIMIT_BACKEND == "mongo":
+        from app.database import get_collection
+        rate_limit_store = MongoBucketStore(get_collection("rate_limits"), _rate, _burst)
+    else:
+        rate_limit_store = MemoryBucketStore(_rate, _burst)
+    app.add_middleware(
+        RateLimitMiddleware,
+        store=rate_limit_store,
+        limit_per_minute=settings.RATE_LIMIT_PER_MINUTE,
+        trust_proxy=settings.RATE_LIMIT_TRUST_PROXY,
+    )
+    REGISTRY.gauge("rate_limit_buckets", "Active in-process rate limit buckets", lambda: len(rate_limit_store))
+
+# API Key Authentication middleware (only active if API_SECRET_KEY or API_KEYS is set)
+api_keys = load_api_keys()
+app.add_middleware(APIKeyMiddleware, keys=api_keys)
 
-# API Key Authentication middleware (only active if API_SECRET_KEY is set)
-app.add_middleware(APIKeyMiddleware)
+# Sampled per-stage request traces (off unless enabled via /api/admin/profiling)
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
+# Per-route latency histograms for /metrics
+app.add_middleware(MetricsMiddleware)
 
 # CORS middleware - use origins from config
 cors_origins = settings.CORS_ORIGINS.split(",") if settings.CORS_ORIGINS != "*" else ["*"]
@@ -167,21 +273,47 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Log auth status on startup
-if settings.API_SECRET_KEY:
-    print("[SECURE] API Key Authentication: ENABLED")
+if api_keys:
+    print(f"[SECURE] API Key Authentication: ENABLED ({len(api_keys)} key(s))")
 else:
     print("[OPEN] API Key Authentication: DISABLED (open access)")
 
 @app.get("/health")
 async def health_check():
+    """Liveness: the process and its event loop answer. Readiness is /health/ready."""
     return {"status": "healthy", "service": "sut-bus-server"}
 
+@app.get("/health/ready")
+async def readiness_check(response: Response):
+    """
+    Readiness: 200 once the required startup phases have succeeded, else 503.
+    Reports per-phase startup timings, optional subsystems that failed
+    (MongoDB, MQTT: degraded, still ready) and lazily built subsystems.
+    """
+    report = startup.report()
+    if not report["ready"]:
+        response.status_code = 503
+    return report
+
+REGISTRY.gauge("ready", "1 once the required startup phases have succeeded", lambda: int(startup.ready))
+REGISTRY.gauge(
+    "startup_phase_seconds", "Duration of each startup phase",
+    lambda: {(name,): phase.seconds for name, phase in startup.phases.items() if phase.seconds is not None},
+    ["phase"]
+)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text exposition of server metrics."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/")
 async def root():
-    return {"message": "SUT Smart Bus API (Lite)", "status": "running", "auth": "enabled" if settings.API_SECRET_KEY else "disabled"}
+    return {"message": "SUT Smart Bus API (Lite)", "status": "running", "auth": "enabled" if api_keys else "disabled"}
 
 
 @app.get("/dashboard", response_class=HTMLResponse)
@@ -237,17 +369,56 @@ async def get_count():
     return {"passengers": current_passengers}
 
 # CRUD Endpoints (Proxies to MongoDB for App)
+# List endpoints page with opaque cursors: pass the X-Next-Cursor response
+# header back as ?cursor= (skip still works for old clients, but is O(skip))
+MAX_PAGE_SIZE = 1000
+
+def _decode_cursor_or_400(sort, cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(sort, cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _set_next_cursor(response: Response, sort, docs: list, limit: int):
+    token = next_cursor(sort, docs, limit)
+    if token:
+        response.headers["X-Next-Cursor"] = token
+
+async def _list_page(response: Response, fetch, sort, skip: int, limit: int, cursor: Optional[str], **filters):
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    docs = await fetch(skip=skip, limit=limit, after=_decode_cursor_or_400(sort, cursor), **filters)
+    _set_next_cursor(response, sort, docs, limit)
+    return docs
+
 @app.get("/api/buses", response_model=List[models.Bus])
-async def list_buses(skip: int = 0, limit: int = 100):
-    return await crud.get_buses(skip=skip, limit=limit)
+async def list_buses(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None):
+    """Buses, up to `limit` (1-1000) per page. Page with the X-Next-Cursor header."""
+    return await _list_page(response, crud.get_buses, crud.BUS_SORT, skip, limit, cursor)
     
 @app.get("/api/routes", response_model=List[models.Route])
-async def list_routes(skip: int = 0, limit: int = 100):
-    return await crud.get_routes(skip=skip, limit=limit)
+async def list_routes(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None):
+    """Routes, up to `limit` (1-1000) per page. Page with the X-Next-Cursor header."""
+    return await _list_page(response, crud.get_routes, crud.ROUTE_SORT, skip, limit, cursor)
 
 @app.get("/api/stops", response_model=List[models.Stop])
-async def list_stops(skip: int = 0, limit: int = 100):
-    return await crud.get_stops(skip=skip, limit=limit)
+async def list_stops(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None):
+    """Stops, up to `limit` (1-1000) per page. Page with the X-Next-Cursor header."""
+    return await _list_page(response, crud.get_stops, crud.STOP_SORT, skip, limit, cursor)
+
+@app.get("/api/feedback", response_model=List[models.Feedback])
+async def list_feedback(response: Response, limit: int = 100, cursor: Optional[str] = None):
+    """Feedback, newest first. Page with the X-Next-Cursor header."""
+    return await _list_page(response, crud.get_feedback, crud.FEEDBACK_SORT, 0, limit, cursor)
+
+@app.get("/api/hardware-locations", response_model=List[models.HardwareLocation])
+async def list_hardware_locations(response: Response, limit: int = 100, cursor: Optional[str] = None,
+                                  bus_mac: Optional[str] = None):
+    """Location/PM history, newest first. Page with the X-Next-Cursor header."""
+    return await _list_page(response, crud.get_hardware_locations, crud.HARDWARE_LOCATION_SORT, 0, limit, cursor,
+                            bus_mac=bus_mac)
 
 # Bus CRUD endpoints (for admin management)
 @app.post("/api/buses", response_model=models.Bus)
@@ -275,6 +446,73 @@ async def delete_bus(mac_address: str):
     return {"message": "Bus deleted successfully"}
 
 
+# Device fleet (live registry fed by MQTT, no database scan)
+@app.get("/api/devices")
+async def list_devices(online: Optional[bool] = None, device_type: Optional[str] = None):
+    """
+    List devices seen over MQTT with liveness, firmware version and message rate.
+    
+    - **online**: Optional filter (true = online only, false = offline only)
+    - **device_type**: Optional filter by reported device type
+    """
+    devices = device_registry.snapshot(online=online, device_type=device_type)
+    return {"devices": devices, "count": len(devices), "summary": device_registry.counts()}
+
+@app.get("/api/devices/events")
+async def list_device_events(limit: int = 50):
+    """Most recent online/offline transitions (newest first)."""
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    events = list(device_registry.recent_events)[-limit:][::-1]
+    return {"events": events, "count": len(events)}
+
+@app.get("/api/pm-zones/stats")
+async def get_pm_zone_stats():
+    """
+    Live per-zone PM statistics: reading count, EWMA, min/max and PM2.5
+    percentiles (t-digest). Served from memory; pm_zones documents are
+    updated every ZONE_STATS_FLUSH_SECONDS.
+    """
+    zones = zone_stats.snapshot()
+    return {"zones": zones, "count": len(zones)}
+
+@app.get("/api/anomalies/events")
+async def list_anomaly_events(limit: int = 50, bus_mac: Optional[str] = None):
+    """
+    Most recent PM2.5 anomalies detected on ingest (newest first).
+    
+    - **bus_mac**: Optional filter for specific bus
+    """
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    events = [e for e in anomaly_detector.recent_events if bus_mac is None or e["bus_mac"] == bus_mac]
+    events = events[-limit:][::-1]
+    return {"events": events, "count": len(events), "mode": settings.ANOMALY_MODE}
+
+@app.get("/api/anomalies/baseline/{bus_mac}")
+async def get_anomaly_baseline(bus_mac: str):
+    """Current PM2.5 baseline (EWMA mean and std) the detector compares a bus against."""
+    baseline = anomaly_detector.baseline(bus_mac)
+    if not baseline:
+        raise HTTPException(status_code=404, detail="No readings from this bus yet")
+    return baseline
+
+@app.get("/api/buses/{mac_address}/motion")
+async def get_bus_motion(mac_address: str):
+    """Smoothed position, speed and heading from the bus's GPS filter (fast and full fixes)."""
+    state = gps_tracker.state(mac_address)
+    if not state:
+        raise HTTPException(status_code=404, detail="No GPS fixes from this bus yet")
+    return state
+
+@app.get("/api/devices/{mac_address}")
+async def get_device(mac_address: str):
+    device = device_registry.get(mac_address)
+    if not device:
+        raise HTTPException(status_code=404, detail="Device not found")
+    return device
+
+
 # Ring Bell Endpoint - Publishes to MQTT to trigger ESP32 buzzer
 class RingRequest(BaseModel):
     bus_mac: str = "ESP32-CAM-01"
@@ -340,7 +578,9 @@ async def get_bus_route_mapping(version: int = 0):
 # =============================================================================
 
 ROUTES_DIR = "routes"
-os.makedirs(ROUTES_DIR, exist_ok=True)
+
+# Directory created and listing cached on first use (app/route_catalog.py)
+route_catalog = Lazy("route_catalog", lambda: RouteCatalog(ROUTES_DIR))
 
 class RouteData(BaseModel):
     routeId: str
@@ -360,22 +600,7 @@ async def list_route_files():
     """
     routes = []
     try:
-        for filename in os.listdir(ROUTES_DIR):
-            if filename.endswith('.json'):
-                filepath = os.path.join(ROUTES_DIR, filename)
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        route_data = json.load(f)
-                        routes.append({
-                            "routeId": route_data.get("routeId", filename.replace('.json', '')),
-                            "routeName": route_data.get("routeName", "Unnamed Route"),
-                            "routeColor": route_data.get("routeColor", "#2563eb"),
-                            "waypointCount": len(route_data.get("waypoints", [])),
-                            "stopCount": sum(1 for wp in route_data.get("waypoints", []) if wp.get("isStop")),
-                            "updatedAt": route_data.get("updatedAt"),
-                        })
-                except Exception as e:
-                    print(f"Error reading route file {filename}: {e}")
+        routes = route_catalog.list()
     except Exception as e:
         print(f"Error listing routes: {e}")
     
@@ -389,19 +614,16 @@ async def get_route_file(route_id: str):
     Returns complete route including all waypoints.
     """
     # Security: Prevent path traversal
-    if ".." in route_id or "/" in route_id or "\\" in route_id:
+    if not is_valid_route_id(route_id):
         raise HTTPException(status_code=400, detail="Invalid route ID")
     
-    filepath = os.path.join(ROUTES_DIR, f"{route_id}.json")
-    
-    if not os.path.exists(filepath):
-        raise HTTPException(status_code=404, detail="Route not found")
-    
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        route = route_catalog.get(route_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error reading route: {str(e)}")
+    if route is None:
+        raise HTTPException(status_code=404, detail="Route not found")
+    return route
 
 
 @app.post("/api/routes")
@@ -420,14 +642,11 @@ async def save_route_file(route: RouteData):
     
     # Security: Validate route ID format
     route_id = route_dict.get("routeId", "")
-    if not route_id or ".." in route_id or "/" in route_id or "\\" in route_id:
+    if not is_valid_route_id(route_id):
         raise HTTPException(status_code=400, detail="Invalid route ID")
     
-    filepath = os.path.join(ROUTES_DIR, f"{route_id}.json")
-    
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(route_dict, f, ensure_ascii=False, indent=2)
+        route_catalog.save(route_dict)
         
         print(f"📍 Route saved: {route_dict.get('routeName')} ({route_id})")
         return {
@@ -445,28 +664,59 @@ async def delete_route_file(route_id: str):
     Delete a route by ID.
     """
     # Security: Prevent path traversal
-    if ".." in route_id or "/" in route_id or "\\" in route_id:
+    if not is_valid_route_id(route_id):
         raise HTTPException(status_code=400, detail="Invalid route ID")
     
-    filepath = os.path.join(ROUTES_DIR, f"{route_id}.json")
-    
-    if not os.path.exists(filepath):
-        raise HTTPException(status_code=404, detail="Route not found")
-    
     try:
-        os.remove(filepath)
-        print(f"🗑️ Route deleted: {route_id}")
-        return {"success": True, "message": f"Route {route_id} deleted"}
+        deleted = route_catalog.delete(route_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting route: {str(e)}")
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Route not found")
+    print(f"🗑️ Route deleted: {route_id}")
+    return {"success": True, "message": f"Route {route_id} deleted"}
 
 
 # =============================================================================
 # OTA (Over-The-Air) Update Endpoints
 # =============================================================================
 
-# Ensure firmware directory exists
-os.makedirs(settings.FIRMWARE_DIR, exist_ok=True)
+# Firmware storage and delta cache (directories created and the hash manifest
+# loaded on first use)
+firmware_store = Lazy("firmware_store", lambda: FirmwareStore(settings.FIRMWARE_DIR, settings.MAX_UPLOAD_SIZE))
+download_tracker = DownloadTracker(settings.OTA_MAX_CONCURRENT_DOWNLOADS)
+delta_cache = Lazy("delta_cache", lambda: DeltaCache(firmware_store.instance()))
+
+# Staged OTA rollouts (per-device commands, acks on sut/ota/ack). Created by the
+# first rollout request; until then there is nothing to ack and acks are ignored.
+def _create_rollout_manager() -> RolloutManager:
+    manager = RolloutManager(mqtt_client.publish)
+    manager.set_loop(app.state.loop)
+    set_ota_ack_handler(manager.handle_ack_threadsafe)
+    return manager
+
+rollout_manager = Lazy("ota_rollouts", _create_rollout_manager)
+
+def _count_by(values) -> dict:
+    counts = {}
+    for value in values:
+        counts[(value,)] = counts.get((value,), 0) + 1
+    return counts
+
+REGISTRY.gauge("heatmap_tile_cache_entries", "Rendered heatmap tiles in the cache", lambda: len(tile_cache.entries))
+REGISTRY.gauge("firmware_downloads_active", "Firmware downloads in progress", lambda: download_tracker.active)
+REGISTRY.gauge("firmware_download_bytes_sent", "Firmware bytes sent since start", lambda: download_tracker.bytes_sent)
+REGISTRY.gauge("firmware_downloads_rejected", "Downloads rejected by the concurrency cap", lambda: download_tracker.rejected)
+REGISTRY.gauge(
+    "devices", "Devices known to the registry by state",
+    lambda: {("online",): device_registry.counts()["online"], ("offline",): device_registry.counts()["offline"]},
+    ["state"]
+)
+REGISTRY.gauge(
+    "ota_rollouts", "OTA rollouts by status",
+    lambda: _count_by(r.status for r in rollout_manager.rollouts.values()) if rollout_manager.is_loaded else {},
+    ["status"]
+)
 
 # OTA Topics
 TOPIC_OTA_ESP32_CAM = "sut/ota/esp32_cam"
@@ -479,6 +729,8 @@ class FirmwareUploadResponse(BaseModel):
     version: str
     size_bytes: int
     download_url: str
+    sha256: Optional[str] = None
+    md5: Optional[str] = None
 
 class OTATriggerRequest(BaseModel):
     device_type: str  # "esp32_cam" or "pm"
@@ -491,9 +743,30 @@ class OTATriggerResponse(BaseModel):
     topic: str
     payload: dict
 
+class OTARolloutRequest(BaseModel):
+    device_type: str                     # "esp32_cam" or "pm"
+    version: str                         # e.g., "1.0.1"
+    devices: Optional[List[str]] = None  # Device MACs (default: online devices of the type, else all known ones)
+    force: bool = False
+    wave_size: int = Field(5, ge=1)                    # Commands sent per wave
+    max_concurrent: int = Field(10, ge=1)              # Max devices downloading at once
+    wave_interval: float = Field(10.0, gt=0)           # Seconds between waves
+    failure_threshold: float = Field(0.2, ge=0, le=1)  # Pause when failed/finished exceeds this
+    min_samples: int = Field(5, ge=1)                  # Finished devices before the threshold applies
+    device_timeout: float = Field(300.0, gt=0)         # Seconds without an ack before an in-flight device counts as failed
+
+class ProfilingConfigRequest(BaseModel):
+    http_sample_rate: Optional[float] = None  # Fraction of HTTP requests traced (0.0 - 1.0)
+    mqtt_sample_rate: Optional[float] = None  # Fraction of MQTT messages traced (0.0 - 1.0)
+
+class SamplerRequest(BaseModel):
+    seconds: float = 30.0      # Sampling window
+    interval_ms: float = 10.0  # Time between stack snapshots
+
 
 @app.post("/api/firmware/upload", response_model=FirmwareUploadResponse)
 async def upload_firmware(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     device_type: str = Body(..., embed=True),
     version: str = Body(..., embed=True)
@@ -506,13 +779,16 @@ async def upload_firmware(
     - **version**: Semantic version string, e.g., "1.0.1"
     """
     # Validate device type
-    valid_devices = ["esp32_cam", "pm"]
-    if device_type not in valid_devices:
+    if device_type not in VALID_DEVICE_TYPES:
         raise HTTPException(
             status_code=400, 
-            detail=f"Invalid device_type. Must be one of: {valid_devices}"
+            detail=f"Invalid device_type. Must be one of: {VALID_DEVICE_TYPES}"
         )
     
+    # Security: version becomes part of the filename
+    if not is_valid_version(version):
+        raise HTTPException(status_code=400, detail="Invalid version string")
+    
     # Validate file extension
     if not file.filename.endswith('.bin'):
         raise HTTPException(
@@ -521,33 +797,31 @@ async def upload_firmware(
         )
     
     # Create filename
-    filename = f"{device_type}_{version}.bin"
-    filepath = os.path.join(settings.FIRMWARE_DIR, filename)
+    filename = firmware_filename(device_type, version)
     
-    # Save file with size limit check
+    # Stream to disk with size limit enforced while reading
     try:
-        contents = await file.read()
-        
-        # Security: Check file size limit
-        if len(contents) > settings.MAX_UPLOAD_SIZE:
-            raise HTTPException(
-                status_code=413,
-                detail=f"File too large. Maximum size is {settings.MAX_UPLOAD_SIZE // (1024*1024)}MB"
-            )
+        entry = await firmware_store.save_upload(file, filename)
         
-        with open(filepath, "wb") as f:
-            f.write(contents)
+        print(f"📦 Firmware uploaded: {filename} ({entry['size_bytes']} bytes, sha256={entry['sha256'][:12]})")
         
-        file_size = len(contents)
-        print(f"📦 Firmware uploaded: {filename} ({file_size} bytes)")
+        # Prepare the patch from the previous version so devices can fetch a delta
+        background_tasks.add_task(delta_cache.precompute_for, device_type, version)
         
         return FirmwareUploadResponse(
             success=True,
             filename=filename,
             device_type=device_type,
             version=version,
-            size_bytes=file_size,
-            download_url=f"/firmware/{filename}"
+            size_bytes=entry["size_bytes"],
+            download_url=f"/firmware/{filename}",
+            sha256=entry["sha256"],
+            md5=entry["md5"]
+        )
+    except FirmwareTooLarge:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large. Maximum size is {settings.MAX_UPLOAD_SIZE // (1024*1024)}MB"
         )
     except HTTPException:
         raise
@@ -555,11 +829,14 @@ async def upload_firmware(
         raise HTTPException(status_code=500, detail=f"Failed to save firmware: {str(e)}")
 
 
-@app.get("/firmware/{filename}")
-async def download_firmware(filename: str):
+@app.api_route("/firmware/{filename}", methods=["GET", "HEAD"])
+async def download_firmware(filename: str, request: Request):
     """
     Download a firmware binary for OTA update.
     ESP32 devices will call this endpoint to fetch the new firmware.
+    
+    Supports Range requests (resume after a dropped connection) and
+    If-None-Match against the firmware's SHA-256 ETag.
     """
     # Security: Prevent path traversal attacks
     if ".." in filename or "/" in filename or "\\" in filename:
@@ -569,43 +846,119 @@ async def download_firmware(filename: str):
     if not filename.endswith('.bin'):
         raise HTTPException(status_code=400, detail="Invalid file type")
     
-    filepath = os.path.join(settings.FIRMWARE_DIR, filename)
+    filepath = firmware_store.path_for(filename)
     
     if not os.path.exists(filepath):
         raise HTTPException(status_code=404, detail="Firmware not found")
     
-    return FileResponse(
-        filepath,
-        media_type="application/octet-stream",
-        filename=filename
+    entry = await firmware_store.get_entry(filename)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Firmware not found")
+    
+    return build_download_response(request, entry, filepath, download_tracker)
+
+
+@app.api_route("/firmware/delta/{device_type}/{from_version}/{to_version}", methods=["GET", "HEAD"])
+async def download_firmware_delta(device_type: str, from_version: str, to_version: str, request: Request):
+    """
+    Download a binary patch from **from_version** to **to_version**.
+    
+    The X-Delta-Base-SHA256 header lets the device check its running image
+    before applying. When no useful patch exists the request is redirected
+    to the full image.
+    """
+    if device_type not in VALID_DEVICE_TYPES or not is_valid_version(from_version) or not is_valid_version(to_version):
+        raise HTTPException(status_code=400, detail="Invalid firmware reference")
+    
+    target = firmware_filename(device_type, to_version)
+    if not await firmware_store.get_entry(target):
+        raise HTTPException(status_code=404, detail="Firmware not found")
+    
+    meta = await delta_cache.get_delta(device_type, from_version, to_version)
+    if not meta or not meta["beneficial"]:
+        return RedirectResponse(url=f"/firmware/{target}", status_code=307)
+    
+    return build_download_response(
+        request, meta, delta_cache.path_for(meta["filename"]), download_tracker,
+        extra_headers={
+            "x-delta-base-sha256": meta["base_sha256"],
+            "x-delta-target-sha256": meta["target_sha256"],
+            "x-delta-target-size": str(meta["target_size_bytes"]),
+        }
     )
 
 
+@app.get("/api/firmware/delta-info")
+async def firmware_delta_info(device_type: str, from_version: str, to_version: Optional[str] = None):
+    """
+    Tell a device how to update from **from_version**.
+    
+    - **to_version**: Target version (default: latest uploaded for the device type)
+    
+    Returns type "delta" with the patch URL and base hash to verify, or
+    type "full" with the full image URL when no useful patch exists.
+    """
+    if device_type not in VALID_DEVICE_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid device_type. Must be one of: {VALID_DEVICE_TYPES}"
+        )
+    
+    if to_version is None:
+        versions = [e["version"] for e in await firmware_store.list_entries() if e["device_type"] == device_type]
+        if not versions:
+            raise HTTPException(status_code=404, detail="Firmware not found")
+        to_version = max(versions, key=version_key)
+    
+    if not is_valid_version(from_version) or not is_valid_version(to_version):
+        raise HTTPException(status_code=400, detail="Invalid version string")
+    
+    target = await firmware_store.get_entry(firmware_filename(device_type, to_version))
+    if not target:
+        raise HTTPException(status_code=404, detail="Firmware not found")
+    
+    meta = await delta_cache.get_delta(device_type, from_version, to_version)
+    if meta and meta["beneficial"]:
+        return {
+            "type": "delta",
+            "to_version": to_version,
+            "url": f"/firmware/delta/{device_type}/{from_version}/{to_version}",
+            "size_bytes": meta["size_bytes"],
+            "sha256": meta["sha256"],
+            "base_sha256": meta["base_sha256"],
+            "target_sha256": meta["target_sha256"],
+            "target_size_bytes": meta["target_size_bytes"],
+        }
+    
+    return {
+        "type": "full",
+        "to_version": to_version,
+        "url": f"/firmware/{target['filename']}",
+        "size_bytes": target["size_bytes"],
+        "sha256": target["sha256"],
+    }
+
+
+@app.get("/api/firmware/downloads")
+async def firmware_download_stats():
+    """
+    Firmware download accounting (active/peak/rejected downloads, bytes sent).
+    """
+    return download_tracker.stats()
+
+
 @app.get("/api/firmware/list")
 async def list_firmware():
     """
-    List all available firmware files.
+    List all available firmware files (served from the firmware manifest).
     """
     try:
         files = []
-        for filename in os.listdir(settings.FIRMWARE_DIR):
-            if filename.endswith('.bin'):
-                filepath = os.path.join(settings.FIRMWARE_DIR, filename)
-                stat = os.stat(filepath)
-                
-                # Parse device type and version from filename
-                parts = filename.replace('.bin', '').split('_')
-                device_type = parts[0] if parts else "unknown"
-                version = '_'.join(parts[1:]) if len(parts) > 1 else "unknown"
-                
-                files.append({
-                    "filename": filename,
-                    "device_type": device_type,
-                    "version": version,
-                    "size_bytes": stat.st_size,
-                    "modified": stat.st_mtime,
-                    "download_url": f"/firmware/{filename}"
-                })
+        for entry in await firmware_store.list_entries():
+            files.append({
+                **entry,
+                "download_url": f"/firmware/{entry['filename']}"
+            })
         
         return {"firmware_files": files, "count": len(files)}
     except Exception as e:
@@ -629,25 +982,6 @@ async def trigger_ota(request: OTATriggerRequest):
             detail=f"Invalid device_type. Must be one of: {valid_devices}"
         )
     
-    # Get server base URL (for firmware download)
-    # Use the MQTT broker host as server address since they're co-located
-    server_host = settings.MQTT_BROKER_HOST
-    
-    # If running locally (localhost/127.0.0.1), find actual LAN IP
-    if server_host in ["localhost", "127.0.0.1", "::1"]:
-        try:
-            import socket
-            # Connect to a public DNS server (doesn't send data) to get local IP
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.settimeout(0.1)
-            s.connect(("8.8.8.8", 80))
-            server_host = s.getsockname()[0]
-            s.close()
-            print(f"📍 Auto-detected LAN IP for OTA: {server_host}")
-        except Exception as e:
-            print(f"⚠️ Could not detect LAN IP: {e}")
-            server_host = "203.158.3.14"  # Fallback only if detection fails
-    
     # Determine topics to publish to
     topics = []
     if request.device_type == "all":
@@ -680,7 +1014,7 @@ async def trigger_ota(request: OTATriggerRequest):
         payload = {
             "command": "ota_update",
             "version": request.version,
-            "url": f"http://{server_host}:8000/firmware/{fw_filename}",
+            "url": firmware_url(fw_filename),  # Server address is resolved once and cached
             "force": request.force,
             "timestamp": int(time.time())
         }
@@ -707,11 +1041,193 @@ async def trigger_ota(request: OTATriggerRequest):
     )
 
 
+@app.post("/api/ota/rollouts")
+async def create_ota_rollout(request: OTARolloutRequest):
+    """
+    Start a staged OTA rollout.
+    
+    Devices receive targeted commands on sut/ota/<device_type>/<mac> in waves,
+    with at most **max_concurrent** downloading at once. Progress comes from
+    device acks on sut/ota/ack; the rollout pauses itself when the failure
+    rate exceeds **failure_threshold**.
+    """
+    if request.device_type not in VALID_DEVICE_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid device_type. Must be one of: {VALID_DEVICE_TYPES}"
+        )
+    if not is_valid_version(request.version):
+        raise HTTPException(status_code=400, detail="Invalid version string")
+    
+    filename = firmware_filename(request.device_type, request.version)
+    entry = await firmware_store.get_entry(filename)
+    if not entry:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Firmware file not found: {filename}. Upload it first via /api/firmware/upload"
+        )
+    
+    devices = request.devices
+    if devices is None:
+        # Prefer devices currently online with a matching type, then every known
+        # device of that type; buses the registry has no type for count as candidates
+        devices = device_registry.online_macs(device_type=request.device_type)
+        if not devices:
+            types = {d["mac_address"]: d["device_type"] for d in device_registry.snapshot()}
+            buses = await crud.get_buses(limit=10000)
+            devices = [mac for mac, device_type in types.items() if device_type == request.device_type]
+            devices += [bus["mac_address"] for bus in buses
+                        if bus.get("mac_address") and types.get(bus["mac_address"]) is None]
+    elif not devices:
+        raise HTTPException(status_code=400, detail="devices is empty; omit it to target every device of the type")
+    if not devices:
+        raise HTTPException(status_code=400, detail="No target devices")
+    
+    rollout = Rollout(
+        device_type=request.device_type,
+        version=request.version,
+        devices=devices,
+        url=firmware_url(filename),
+        force=request.force,
+        sha256=entry["sha256"],
+        size_bytes=entry["size_bytes"],
+        wave_size=request.wave_size,
+        max_concurrent=request.max_concurrent,
+        wave_interval=request.wave_interval,
+        failure_threshold=request.failure_threshold,
+        min_samples=request.min_samples,
+        device_timeout=request.device_timeout,
+    )
+    rollout_manager.start(rollout)
+    return rollout.summary()
+
+
+@app.get("/api/ota/rollouts")
+async def list_ota_rollouts():
+    """List OTA rollouts (newest first)."""
+    rollouts = rollout_manager.list_rollouts()
+    return {"rollouts": rollouts, "count": len(rollouts)}
+
+
+def _get_rollout_or_404(rollout_id: str) -> Rollout:
+    rollout = rollout_manager.get(rollout_id)
+    if not rollout:
+        raise HTTPException(status_code=404, detail="Rollout not found")
+    return rollout
+
+
+@app.get("/api/ota/rollouts/{rollout_id}")
+async def get_ota_rollout(rollout_id: str):
+    """Rollout progress including per-device state."""
+    return _get_rollout_or_404(rollout_id).summary(include_devices=True)
+
+
+@app.post("/api/ota/rollouts/{rollout_id}/pause")
+async def pause_ota_rollout(rollout_id: str):
+    rollout = _get_rollout_or_404(rollout_id)
+    rollout_manager.pause(rollout)
+    return rollout.summary()
+
+
+@app.post("/api/ota/rollouts/{rollout_id}/resume")
+async def resume_ota_rollout(rollout_id: str):
+    rollout = _get_rollout_or_404(rollout_id)
+    rollout_manager.resume(rollout)
+    return rollout.summary()
+
+
+@app.post("/api/ota/rollouts/{rollout_id}/cancel")
+async def cancel_ota_rollout(rollout_id: str):
+    rollout = _get_rollout_or_404(rollout_id)
+    rollout_manager.cancel(rollout)
+    return rollout.summary()
+
+
 # =============================================================================
-# Air Quality Analytics Endpoints
+# Admin endpoints (require the "admin" scope when API keys are configured)
 # =============================================================================
 
-from app import analytics
+@app.get("/api/admin/api-keys")
+async def list_api_keys():
+    """Configured API key names, scopes and request counts (secrets are never returned)."""
+    return {"keys": key_summary(api_keys)}
+
+@app.get("/api/admin/mongo")
+async def get_mongo_pool():
+    """MongoDB connection pool usage per server, client options, write concerns, the ingest spill buffer and queue."""
+    stats = pool_stats()
+    stats["reachable"] = await mongo_ping()
+    stats["spill"] = ingest_writer.stats()
+    stats["ingest"] = ingest_executor.stats()
+    return stats
+
+@app.get("/api/admin/profiling")
+async def get_profiling():
+    """Current sample rates and per-stage timing summary (ms) of retained traces."""
+    return {
+        "http_sample_rate": profiler.rates["http"],
+        "mqtt_sample_rate": profiler.rates["mqtt"],
+        "traces": len(profiler.traces),
+        "stages": profiler.summary(),
+        "sampler": profiler.sampler.status,
+    }
+
+@app.put("/api/admin/profiling")
+async def configure_profiling(request: ProfilingConfigRequest):
+    """
+    Change trace sample rates at runtime (no redeploy).
+    
+    - **http_sample_rate**: 0.0 (off) to 1.0 (every request)
+    - **mqtt_sample_rate**: 0.0 (off) to 1.0 (every message)
+    """
+    for rate in (request.http_sample_rate, request.mqtt_sample_rate):
+        if rate is not None and not (0.0 <= rate <= 1.0):
+            raise HTTPException(status_code=400, detail="Sample rates must be between 0.0 and 1.0")
+    profiler.configure(http_rate=request.http_sample_rate, mqtt_rate=request.mqtt_sample_rate)
+    return {"http_sample_rate": profiler.rates["http"], "mqtt_sample_rate": profiler.rates["mqtt"]}
+
+@app.get("/api/admin/profiling/traces")
+async def list_profiling_traces(kind: Optional[str] = None, limit: int = 50):
+    """
+    Most recent sampled traces (newest first) with their stage timings.
+    
+    - **kind**: Optional filter ("http" or "mqtt")
+    """
+    traces = profiler.recent(kind=kind, limit=max(1, min(limit, 500)))
+    return {"traces": traces, "count": len(traces)}
+
+@app.post("/api/admin/profiling/sampler")
+async def start_stack_sampler(request: SamplerRequest):
+    """
+    Sample every thread's stack for a window and write a folded-stack file
+    (flamegraph.pl / speedscope input). Poll GET .../sampler for the result.
+    """
+    if not (0 < request.seconds <= MAX_SAMPLER_SECONDS):
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {MAX_SAMPLER_SECONDS}")
+    if not (1 <= request.interval_ms <= 1000):
+        raise HTTPException(status_code=400, detail="interval_ms must be between 1 and 1000")
+    try:
+        return profiler.sampler.start(request.seconds, request.interval_ms / 1000)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/api/admin/profiling/sampler")
+async def get_stack_sampler():
+    """Sampler status and the folded-stack files available for download."""
+    return {"status": profiler.sampler.status, "files": profiler.sampler.list_files()}
+
+@app.get("/api/admin/profiling/sampler/{filename}")
+async def download_stack_profile(filename: str):
+    """Download a folded-stack file."""
+    path = profiler.sampler.path_for(filename)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="text/plain", filename=filename)
+
+
+# =============================================================================
+# Air Quality Analytics Endpoints
+# =============================================================================
 
 @app.get("/api/analytics/zones")
 async def get_analytics_zones(hours: int = 24, grid_size: float = 0.001, bus_mac: Optional[str] = None):
@@ -763,6 +1279,7 @@ async def get_analytics_stats(hours: int = 24, bus_mac: Optional[str] = None):
     - **hours**: Number of hours of data to analyze (default: 24)
     - **bus_mac**: Optional filter for specific bus
     """
+    stats = await analytics.get_overall_stats(hours=hours, bus_mac=bus_mac)
     return {
         "stats": stats,
         "hours": hours,
@@ -770,18 +1287,73 @@ async def get_analytics_stats(hours: int = 24, bus_mac: Optional[str] = None):
     }
 
 
+@app.get("/api/analytics/summary")
+async def get_analytics_summary(hours: int = 24, grid_size: float = 0.001, interval: int = 60, bus_mac: Optional[str] = None):
+    """
+    Zones, trends and stats in one request (one aggregation over the window).
+    Results are shared between clients for ANALYTICS_CACHE_SECONDS.
+    
+    - **hours**: Number of hours of data (default: 24)
+    - **grid_size**: Zone cell size in degrees (default: 0.001 ≈ 111m)
+    - **interval**: Trend interval in minutes (default: 60)
+    - **bus_mac**: Optional filter for specific bus
+    """
+    try:
+        summary = await analytics.summary_cache.get(hours, grid_size, interval, bus_mac)
+    except Exception as e:
+        print(f"Error in analytics summary: {e}")
+        raise HTTPException(status_code=500, detail="Failed to compute analytics summary")
+    return {
+        "zones": summary["zones"],
+        "zone_count": len(summary["zones"]),
+        "series": summary["series"],
+        "stats": summary["stats"],
+        "hours": hours,
+        "interval_minutes": interval,
+        "grid_size_meters": int(grid_size * 111000),
+        "bus_mac": bus_mac
+    }
+
+
 # =============================================================================
 # Heatmap Endpoints
 # =============================================================================
 
 @app.get("/api/heatmap")
-async def get_heatmap(limit: int = 5000, range: str = "1h", mode: str = "gradient", grid_size: float = 0.001):
+async def get_heatmap(limit: int = 5000, range: str = "1h", mode: str = "gradient", grid_size: float = 0.001,
+                      zoom: Optional[int] = None, bbox: Optional[str] = None,
+                      method: str = "idw", resolution: int = 200, radius: float = 300.0):
     """
     Get heatmap data for visualization.
     Range options: "now" (30m), "1h", "1d", "1w", "1m" (30d)
-    Mode: "gradient" (default, weighted points) or "grid" (averaged cells)
+    Mode: "gradient" (default, weighted points), "grid" (averaged cells) or
+    "interpolated" (smooth surface between routes, see app/interpolation.py)
     Grid size: degrees (0.001° ≈ 111m)
+    
+    - **zoom**: Map zoom level. With gradient mode, readings are decimated to
+      one weighted point per few screen pixels (level of detail)
+    - **bbox**: Optional visible area "min_lon,min_lat,max_lon,max_lat"
+    - **method**: Interpolated mode: "idw" or "gaussian"
+    - **resolution**: Interpolated mode: grid cells along the longer side (max 1000)
+    - **radius**: Interpolated mode: search radius in metres around each cell
     """
+    try:
+        bbox_value = parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if mode == "interpolated":
+        try:
+            return await interpolation_engine.surface(
+                range_key=range, method=method, resolution=resolution, radius_m=radius,
+                bbox=bbox_value, grid_size=grid_size
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            print(f"Error interpolating heatmap: {e}")
+            raise HTTPException(status_code=500, detail="Failed to interpolate heatmap data")
+
     try:
         # Calculate start_time based on range
         now = datetime.utcnow()
@@ -803,6 +1375,11 @@ async def get_heatmap(limit: int = 5000, range: str = "1h", mode: str = "gradien
         # Choose data format based on mode
         if mode == "grid":
             points = await crud.get_pm_grid_data(limit=limit, start_time=start_time, grid_size_degrees=grid_size)
+        elif zoom is not None or bbox_value is not None:
+            points = await crud.get_heatmap_lod_data(
+                cell_degrees=lod_cell_degrees(zoom if zoom is not None else 16),
+                limit=limit, start_time=start_time, bbox=bbox_value
+            )
         else:
             points = await crud.get_heatmap_data(limit=limit, start_time=start_time)
             
@@ -811,6 +1388,77 @@ async def get_heatmap(limit: int = 5000, range: str = "1h", mode: str = "gradien
         print(f"Error fetching heatmap: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch heatmap data")
 
+@app.get("/api/heatmap/tiles/{z}/{x}/{y}")
+async def get_heatmap_tile(z: int, x: int, y: int, request: Request, format: str = "png", range: str = "1h"):
+    """
+    PM2.5 heatmap as slippy-map tiles, so clients fetch only what is visible.
+    Tiles are cached per time bucket and shared between clients; a new reading
+    evicts only the tiles it falls in.
+
+    - **z/x/y**: Tile coordinates (zoom 0-20)
+    - **format**: "png" (256x256, PM2.5 colour bands) or "bin" (64x64
+      little-endian uint16 grid of PM2.5 * 10, 0xFFFF = no data)
+    - **range**: "now" (30m), "1h", "1d", "1w", "3m" or "all"
+    """
+    if not is_valid_tile(z, x, y):
+        raise HTTPException(status_code=400, detail="Invalid tile coordinates")
+    if format not in TILE_ENCODERS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Must be one of: {list(TILE_ENCODERS)}")
+    if range not in TILE_RANGES:
+        raise HTTPException(status_code=400, detail=f"Invalid range. Must be one of: {list(TILE_RANGES)}")
+
+    bucket, _, _ = time_window(range)
+    key = (z, x, y, range, bucket, format)
+    try:
+        body, etag = await tile_cache.get_or_render(
+            key, lambda: render_tile(crud.get_tile_cells, z, x, y, range, format)
+        )
+    except Exception as e:
+        print(f"Error rendering heatmap tile {z}/{x}/{y}: {e}")
+        raise HTTPException(status_code=500, detail="Failed to render heatmap tile")
+
+    # Short-lived: new readings change the tile within its time bucket
+    bucket_seconds = TILE_RANGES[range][1]
+    max_age = max(1, min(TILE_MAX_AGE_SECONDS, int((bucket + 1) * bucket_seconds - time.time())))
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=TILE_ENCODERS[format][1], headers=headers)
+
+@app.get("/api/export/hardware-locations")
+async def export_hardware_locations(
+    format: str = "ndjson",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    bus_mac: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+    gzip: bool = False,
+):
+    """
+    Stream hardware_locations history, oldest first.
+    
+    - **format**: "ndjson" (default), "csv" or "arrow" (Arrow IPC stream; needs pyarrow)
+    - **start** / **end**: Optional UTC time range (ISO 8601, end exclusive)
+    - **bus_mac**: Optional device filter
+    - **after**: Resume after a row, as "<timestamp>_<id>" of the last row received
+    - **limit**: Optional maximum number of rows
+    - **gzip**: Compress the response (Content-Encoding: gzip)
+    """
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    try:
+        cursor = parse_cursor(after) if after else None
+        stream = export_stream(format, build_export_query(start, end, bus_mac), after=cursor, limit=limit, gzip=gzip)
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    media_type, extension = EXPORT_FORMATS[format]
+    headers = {"Content-Disposition": f'attachment; filename="hardware_locations.{extension}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(stream, media_type=media_type, headers=headers)
+
 # Internal Debug Endpoint
 class DebugLocation(BaseModel):
     lat: float
@@ -38,6 +38,8 @@ class Bus(MongoBaseModel):
     pm10: float = 0.0
     temp: float = 0.0
     hum: float = 0.0
+    speed_mps: Optional[float] = None    # From the GPS smoothing filter (app/tracking.py)
+    heading_deg: Optional[float] = None  # Degrees from north; None when stationary
     last_updated: datetime = Field(default_factory=datetime.utcnow)
 
 class Stop(MongoBaseModel):
@@ -62,6 +64,7 @@ class HardwareLocation(MongoBaseModel):
     pm10: float = 0.0
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     bus_mac: Optional[str] = "FAKE-PM-BUS"
+    anomaly: Optional[str] = None  # Set by ingest anomaly detection ("spike", "drop", "saturated")
 
 class BlockedMAC(MongoBaseModel):
     mac_address: str = Field(..., unique=True)
@@ -1,9 +1,22 @@
 import paho.mqtt.client as mqtt
 import os
 import json
-import asyncio
-from datetime import datetime
+import logging
+import time
+from datetime import timezone
+from functools import partial
+from core.config import settings
+from core.executor import IngestExecutor
+from core.logger import SampledLogger
+from core.metrics import MQTT_ERRORS, MQTT_MESSAGES, MQTT_PARSE_SECONDS
+from core.profiling import current_trace, profiler, stage
 from . import crud, models # Import crud and models from the current package
+from .anomaly import detector as anomaly_detector
+from .devices import registry as device_registry
+from .ordering import DUPLICATE, LATE, parse_device_time, sequence_tracker
+from .spill import ingest_writer
+from .tracking import tracker as gps_tracker
+from .zones import zone_stats
 
 # Get MQTT broker host from environment variable, with a fallback for local development
 MQTT_BROKER_HOST = os.getenv("MQTT_BROKER_HOST", "localhost")
@@ -11,134 +24,146 @@ MQTT_BROKER_PORT = int(os.getenv("MQTT_BROKER_PORT", "1883"))
 MQTT_KEEP_ALIVE = 60
 
 # Define topics
+logger = logging.getLogger(__name__)
+message_logger = SampledLogger(__name__)  # Per-message lines, 1 in LOG_SAMPLE_EVERY
+
 TOPIC_ESP32_GPS = "sut/bus/gps"
 TOPIC_ESP32_GPS_FAST = "sut/bus/gps/fast"  # Fast GPS-only updates
 TOPIC_APP_LOCATION = "sut/app/bus/location"
 TOPIC_IR_TRIGGER = "sut/bus/ir/triggered"
 TOPIC_BUS_DOOR_COUNT = "bus/door/count"
-
-# Helper for Point in Polygon (Ray Casting)
-def is_point_in_polygon(lat: float, lon: float, polygon: list):
-    num_vertices = len(polygon)
-    x, y = lon, lat
-    inside = False
-    
-    # Polygon is list of [lat, lon]
-    p1 = polygon[0]
-    p1x, p1y = p1[1], p1[0]
-    
-    for i in range(num_vertices + 1):
-        p2 = polygon[i % num_vertices]
-        p2x, p2y = p2[1], p2[0]
-        
-        if y > min(p1y, p2y):
-            if y <= max(p1y, p2y):
-                if x <= max(p1x, p2x):
-                    if p1y != p2y:
-                        xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-                    if p1x == p2x or x <= xinters:
-                        inside = not inside
-        p1x, p1y = p2x, p2y
-        
-    return inside
-
-async def check_pm_zones_logic(bus_mac, lat, lon, pm2_5, pm10, temp, hum):
-    try:
-        zones = await crud.get_pm_zones()
-        for zone in zones:
-            is_inside = False
-            
-            # Check Polygon (New)
-            if "points" in zone and zone["points"] and len(zone["points"]) >= 3:
-                is_inside = is_point_in_polygon(lat, lon, zone["points"])
-            
-            # Check Radius (Backward Compatibility / Fallback)
-            elif "lat" in zone and "lon" in zone:
-                import math
-                R = 6371000
-                phi1 = lat * math.pi / 180
-                phi2 = zone["lat"] * math.pi / 180
-                dphi = (zone["lat"] - lat) * math.pi / 180
-                dlambda = (zone["lon"] - lon) * math.pi / 180
-                a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2) * math.sin(dlambda/2)**2
-                c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-                distance = R * c
-                if distance <= zone.get("radius", 50.0):
-                    is_inside = True
-
-            if is_inside:
-                print(f"📍 Bus {bus_mac} inside PM Zone: {zone.get('name')}")
-                
-                # Log to CSV
-                data_dir = "data"
-                if not os.path.exists(data_dir):
-                    os.makedirs(data_dir)
-                    
-                filename = os.path.join(data_dir, f"pm_zone_{zone['_id']}.csv")
-                file_exists = os.path.exists(filename)
-                
-                with open(filename, 'a') as f:
-                    if not file_exists:
-                        f.write("timestamp,bus_mac,pm2_5,pm10,temp,hum\n")
-                    timestamp_str = datetime.utcnow().isoformat()
-                    f.write(f"{timestamp_str},{bus_mac},{pm2_5},{pm10},{temp},{hum}\n")
-                
-                # Update Stats
-                current_avg_pm25 = zone.get("avg_pm25", 0.0)
-                current_avg_pm10 = zone.get("avg_pm10", 0.0)
-                alpha = 0.1
-                
-                if current_avg_pm25 == 0:
-                    new_avg_pm25 = pm2_5
-                    new_avg_pm10 = pm10
-                else:
-                    new_avg_pm25 = (alpha * pm2_5) + ((1 - alpha) * current_avg_pm25)
-                    new_avg_pm10 = (alpha * pm10) + ((1 - alpha) * current_avg_pm10)
-                
-                await crud.update_pm_zone_stats(zone["_id"], new_avg_pm25, new_avg_pm10)
-
-    except Exception as e:
-        print(f"Error processing PM Zones: {e}")
+TOPIC_OTA_ACK = "sut/ota/ack"
+TOPIC_BUS_STATUS = "sut/bus/+/status"  # Device heartbeats (not location updates)
 
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the broker."""
     if rc == 0:
-        print("Connected to MQTT Broker!")
+        logger.info("Connected to MQTT Broker!")
         # Subscribe to the topic the ESP32 will publish to
         client.subscribe(TOPIC_ESP32_GPS)
         client.subscribe(TOPIC_ESP32_GPS_FAST)
         client.subscribe(TOPIC_IR_TRIGGER)
-        print(f"Subscribed to: {TOPIC_ESP32_GPS}, {TOPIC_ESP32_GPS_FAST}, {TOPIC_IR_TRIGGER}")
+        client.subscribe(TOPIC_OTA_ACK, qos=1)
+        client.subscribe(TOPIC_BUS_STATUS)
+        # Door counts are handled by app/main.py; subscribed here so every
+        # reconnect (and a broker that was down at boot) restores it
+        client.subscribe(TOPIC_BUS_DOOR_COUNT)
+        logger.info("Subscribed to: %s, %s, %s, %s, %s, %s", TOPIC_ESP32_GPS, TOPIC_ESP32_GPS_FAST, TOPIC_IR_TRIGGER,
+                    TOPIC_OTA_ACK, TOPIC_BUS_STATUS, TOPIC_BUS_DOOR_COUNT)
     else:
-        print(f"Failed to connect, return code {rc}\n")
+        logger.error("Failed to connect, return code %s", rc)
 
 
 # Global loop variable
 main_loop = None
 
+# Bounded hand-off of database work from the MQTT thread to main_loop
+ingest_executor = IngestExecutor(
+    max_in_flight=settings.INGEST_MAX_IN_FLIGHT,
+    max_queue=settings.INGEST_MAX_QUEUE,
+    policy=settings.INGEST_OVERFLOW,
+)
+ingest_executor.register_metrics()
+
 def set_main_loop(loop):
     global main_loop
     main_loop = loop
+    ingest_executor.set_loop(loop)
+
+# OTA ack handler (set by the rollout manager, called from the MQTT thread)
+ota_ack_handler = None
+
+def set_ota_ack_handler(handler):
+    global ota_ack_handler
+    ota_ack_handler = handler
+
+def store_reading(location: models.HardwareLocation):
+    """
+    Coroutine persisting a reading: quarantined if anomalous and ANOMALY_MODE=quarantine,
+    spilled to local disk while MongoDB is unavailable (app/spill.py).
+    """
+    quarantine = location.anomaly and settings.ANOMALY_MODE == "quarantine"
+    collection = "quarantined_readings" if quarantine else "hardware_locations"
+    return ingest_writer.store(collection, location.model_dump(by_alias=True, exclude=["id"]))
+
+def handle_status_message(msg):
+    """
+    Heartbeat on sut/bus/<mac>/status: refresh the device registry only.
+    Payload is optional JSON, e.g. {"fw_version": "1.0.1", "device_type": "pm"}.
+    """
+    parts = msg.topic.split("/")
+    bus_mac = parts[2] if len(parts) == 4 else None
+    data = {}
+    try:
+        data = json.loads(msg.payload.decode()) if msg.payload else {}
+        if not isinstance(data, dict):
+            data = {}
+    except (ValueError, UnicodeDecodeError):
+        pass
+
+    bus_mac = data.get("bus_mac") or bus_mac
+    if not isinstance(bus_mac, str) or not bus_mac or len(bus_mac) > 20:
+        return
+    device_registry.record(
+        bus_mac,
+        topic=msg.topic,
+        firmware_version=data.get("fw_version") or data.get("version"),
+        device_type=data.get("device_type")
+    )
 
 def on_message(client, userdata, msg):
     """Callback for when a message is received from a subscribed topic."""
-    print(f"Received message from topic {msg.topic}: {msg.payload.decode()}")
-    
+    started = time.perf_counter()
+
+    if msg.topic == TOPIC_OTA_ACK:
+        MQTT_MESSAGES.inc(labels=(msg.topic,))
+        if ota_ack_handler:
+            ota_ack_handler(msg.payload)
+        return
+
+    if msg.topic.startswith("sut/bus/") and msg.topic.endswith("/status"):
+        # Label by subscription pattern so per-device topics don't explode cardinality
+        MQTT_MESSAGES.inc(labels=(TOPIC_BUS_STATUS,))
+        handle_status_message(msg)
+        return
+
+    MQTT_MESSAGES.inc(labels=(msg.topic,))
+
+    # Sampled per-stage timings (Mongo stages are recorded by crud's decorators
+    # in the coroutines scheduled below, which inherit the trace context)
+    trace = profiler.maybe_trace("mqtt", msg.topic)
+    trace_token = current_trace.set(trace) if trace is not None else None
+
     # Process the incoming GPS data
     try:
-        payload = json.loads(msg.payload.decode())
+        raw = msg.payload.decode()
+        message_logger.debug("Received message from topic %s: %s", msg.topic, raw)
+        payload = json.loads(raw)
+        if trace is not None:
+            decoded = time.perf_counter()
+            trace.add("decode", decoded - started)
         
         # === SECURITY: Validate bus_mac ===
         bus_mac = payload.get("bus_mac")
         if not bus_mac:
-            print("Error: bus_mac not found in payload.")
+            logger.warning("bus_mac not found in payload (topic %s)", msg.topic)
+            MQTT_ERRORS.inc(labels=(msg.topic, "missing_mac"))
             return
         
         # Sanitize bus_mac (should be MAC address format)
         if not isinstance(bus_mac, str) or len(bus_mac) > 20:
-            print(f"Error: Invalid bus_mac format: {bus_mac}")
+            logger.warning("Invalid bus_mac format: %r", bus_mac)
+            MQTT_ERRORS.inc(labels=(msg.topic, "invalid_mac"))
             return
 
+        # Any valid message counts as a heartbeat
+        device_registry.record(
+            bus_mac,
+            topic=msg.topic,
+            firmware_version=payload.get("fw_version"),
+            device_type=payload.get("device_type")
+        )
+
         # Check if bus_name is in payload, otherwise look up from database
         bus_name = payload.get("bus_name")
         
@@ -155,43 +180,74 @@ def on_message(client, userdata, msg):
         lat = payload.get("lat")
         lon = payload.get("lon")
         pm2_5 = payload.get("pm2_5", 0.0)
+        has_pm = payload.get("pm2_5") is not None  # Fast GPS fixes carry no sensor data
         pm10 = payload.get("pm10", 0.0)
         temp = payload.get("temp", 0.0)
         hum = payload.get("hum", 0.0)
         seats_available = payload.get("seats_available", 0)
+        seq = payload.get("seq")
+        device_ts = payload.get("ts")
 
         # === SECURITY: Validate numeric types ===
         try:
             if lat is not None:
                 lat = float(lat)
                 if not (-90 <= lat <= 90):
-                    print(f"Error: Invalid latitude: {lat}")
+                    logger.warning("Invalid latitude from %s: %s", bus_mac, lat)
+                    MQTT_ERRORS.inc(labels=(msg.topic, "invalid_value"))
                     return
             if lon is not None:
                 lon = float(lon)
                 if not (-180 <= lon <= 180):
-                    print(f"Error: Invalid longitude: {lon}")
+                    logger.warning("Invalid longitude from %s: %s", bus_mac, lon)
+                    MQTT_ERRORS.inc(labels=(msg.topic, "invalid_value"))
                     return
             pm2_5 = float(pm2_5) if pm2_5 is not None else 0.0
             pm10 = float(pm10) if pm10 is not None else 0.0
             temp = float(temp) if temp is not None else 0.0
             hum = float(hum) if hum is not None else 0.0
             seats_available = int(seats_available) if seats_available is not None else 0
+            seq = int(seq) if seq is not None else None
+            device_ts = parse_device_time(device_ts) if device_ts is not None else None
             
             # Sanity checks for sensor data
             pm2_5 = max(0, min(pm2_5, 1000))  # Reasonable PM2.5 range
             pm10 = max(0, min(pm10, 1000))    # Reasonable PM10 range
             seats_available = max(0, min(seats_available, 100))  # Reasonable seat count
         except (ValueError, TypeError) as e:
-            print(f"Error: Invalid numeric value in payload: {e}")
+            logger.warning("Invalid numeric value in payload from %s: %s", bus_mac, e)
+            MQTT_ERRORS.inc(labels=(msg.topic, "invalid_value"))
             return
 
+        # Duplicates (QoS 0 redelivery, reconnects) stop here, before any write;
+        # late fixes are stored at their device time without moving the live position
+        ordering, timestamp = sequence_tracker.check(bus_mac, msg.topic, msg.payload, seq=seq, device_ts=device_ts)
+        if ordering == DUPLICATE:
+            message_logger.debug("Dropped duplicate fix from %s (topic %s)", bus_mac, msg.topic)
+            return
+        late = ordering == LATE
+
+        # Per-bus outlier check (O(1)); the reading is flagged or quarantined when stored.
+        # A reported 0 is scored too: a sensor dropping out reads ~0.
+        anomaly = None
+        if settings.ANOMALY_MODE != "off" and has_pm:
+            anomaly = anomaly_detector.check(bus_mac, pm2_5)
+
+        parsed = time.perf_counter()
+        MQTT_PARSE_SECONDS.observe(parsed - started, (msg.topic,))
+        if trace is not None:
+            trace.add("validate", parsed - decoded)
+
+        # Live position and motion (smoothed when GPS is present, see below)
+        live_lat, live_lon, speed, heading = lat, lon, None, None
+        fast = msg.topic == TOPIC_ESP32_GPS_FAST
+
         # Ensure lat and lon are not None before processing location data
         # Use thread-safe execution on the main loop
         if main_loop:
             # Handle missing GPS by fetching last known location
             if lat is None or lon is None:
-                print(f"Notice: Lat/Lon missing for {bus_mac}. Fetching last known location.")
+                message_logger.debug("Lat/Lon missing for %s. Fetching last known location.", bus_mac)
                 # We need to do this via thread-safe call, but run_until_complete is not good here 
                 # inside a callback if the loop is running. 
                 # We'll just define a background task to handle the whole update logic.
@@ -202,75 +258,115 @@ def on_message(client, userdata, msg):
                 if main_loop:
                     async def process_update_async():
                         nonlocal lat, lon
-                        existing_bus = await crud.get_bus_by_mac(bus_mac)
+                        # Last smoothed fix if we have one (no read, works while MongoDB is down)
+                        existing_bus = gps_tracker.state(bus_mac)
                         if existing_bus:
-                             if lat is None: lat = existing_bus.get("current_lat")
-                             if lon is None: lon = existing_bus.get("current_lon")
+                             if lat is None: lat = existing_bus["lat"]
+                             if lon is None: lon = existing_bus["lon"]
+                        elif ingest_writer.available:
+                            existing_bus = await crud.get_bus_by_mac(bus_mac)
+                            if existing_bus:
+                                 if lat is None: lat = existing_bus.get("current_lat")
+                                 if lon is None: lon = existing_bus.get("current_lon")
                         
                         if lat is None or lon is None: 
                             # ... (missing loc handling) ...
                             return
 
-                        # 1. Update Bus
-                        await crud.update_bus_location(
-                            mac_address=bus_mac, bus_name=bus_name, lat=lat, lon=lon,
-                            seats_available=seats_available, pm2_5=pm2_5, pm10=pm10, temp=temp, hum=hum
-                        )
+                        # 1. Update Bus (not for late fixes, nor while MongoDB is down)
+                        if not late and ingest_writer.available:
+                            await crud.update_bus_location(
+                                mac_address=bus_mac, bus_name=bus_name, lat=lat, lon=lon,
+                                seats_available=seats_available, pm2_5=pm2_5, pm10=pm10, temp=temp, hum=hum
+                            )
                         # 2. Hardware Loc
-                        hw_loc = models.HardwareLocation(lat=lat, lon=lon, pm2_5=pm2_5, pm10=pm10, timestamp=datetime.utcnow())
-                        await crud.create_hardware_location(hw_loc)
+                        hw_loc = models.HardwareLocation(lat=lat, lon=lon, pm2_5=pm2_5, pm10=pm10, timestamp=timestamp, bus_mac=bus_mac, anomaly=anomaly)
+                        await store_reading(hw_loc)
                         
-                        # 3. Check Zones - REMOVED for Heatmap
-                        # await check_pm_zones_logic(bus_mac, lat, lon, pm2_5, pm10, temp, hum)
+                        # 3. Zone statistics (in memory, flushed in batches)
+                        if pm2_5 > 0 and not anomaly:
+                            zone_stats.record(lat, lon, pm2_5, pm10, temp, hum, bus_mac, timestamp)
 
                     # Execute async logic
-                    asyncio.run_coroutine_threadsafe(process_update_async(), main_loop)
+                    ingest_executor.submit(process_update_async, name="process_update")
                     
             else:
                  # GPS Present
-                asyncio.run_coroutine_threadsafe(
-                    crud.update_bus_location(
-                        mac_address=bus_mac, bus_name=bus_name, lat=lat, lon=lon,
-                        seats_available=seats_available, pm2_5=pm2_5, pm10=pm10, temp=temp, hum=hum
-                    ),
-                    main_loop
-                )
-
-                hardware_location = models.HardwareLocation(lat=lat, lon=lon, pm2_5=pm2_5, pm10=pm10, timestamp=datetime.utcnow())
-                asyncio.run_coroutine_threadsafe(crud.create_hardware_location(hardware_location), main_loop)
+                # Fast and full fixes feed one filter per bus; the live position is the
+                # smoothed one, history keeps the raw fix
+                if settings.GPS_SMOOTHING and not late:
+                    fix_time = timestamp.replace(tzinfo=timezone.utc).timestamp()
+                    live_lat, live_lon, speed, heading = gps_tracker.update(bus_mac, lat, lon, fix_time)
+                    speed = round(speed, 2)
+                    heading = round(heading, 1) if heading is not None else None
+
+                # Bus updates are keyed per bus: with INGEST_OVERFLOW=coalesce a queued
+                # update is replaced by the newer fix instead of both being written
+                with stage(trace, "handoff"):
+                    if late or not ingest_writer.available:
+                        pass  # History only; the next fix refreshes the bus once MongoDB is back
+                    elif fast and settings.GPS_SMOOTHING:
+                        # GPS-only: move the bus, keep its last sensor readings
+                        ingest_executor.submit(
+                            partial(crud.update_bus_position, bus_mac, live_lat, live_lon, speed, heading),
+                            key=("position", bus_mac), name="update_bus_position"
+                        )
+                    else:
+                        ingest_executor.submit(
+                            partial(
+                                crud.update_bus_location,
+                                mac_address=bus_mac, bus_name=bus_name, lat=live_lat, lon=live_lon,
+                                seats_available=seats_available, pm2_5=pm2_5, pm10=pm10, temp=temp, hum=hum,
+                                speed_mps=speed, heading_deg=heading
+                            ),
+                            key=("bus", bus_mac), name="update_bus_location"
+                        )
+
+                    # With smoothing, fast fixes (no sensor data) only feed the filter
+                    if not (fast and settings.GPS_SMOOTHING):
+                        hardware_location = models.HardwareLocation(lat=lat, lon=lon, pm2_5=pm2_5, pm10=pm10, timestamp=timestamp, bus_mac=bus_mac, anomaly=anomaly)
+                        ingest_executor.submit(partial(store_reading, hardware_location), name="store_reading")
                 
-                # Check Zones - REMOVED for Heatmap
-                # asyncio.run_coroutine_threadsafe(
-                #    check_pm_zones_logic(bus_mac, lat, lon, pm2_5, pm10, temp, hum),
-                #    main_loop
-                # )
+                # Zone statistics (in memory, flushed in batches by app/zones.py)
+                if pm2_5 > 0 and not anomaly:
+                    zone_stats.record(lat, lon, pm2_5, pm10, temp, hum, bus_mac, timestamp)
                 
-                print(f"Processed message for {bus_mac} (topic: {msg.topic}). Loc: {lat}, {lon}")
+                message_logger.debug("Processed message for %s (topic: %s). Loc: %s, %s", bus_mac, msg.topic, lat, lon)
             
             # 3. Publish to app (this is thread-safe on client object)
             # ONLY publish to the main app topic if this was a full update (not fast GPS)
             # This prevents overwriting sensor data with 0s in the app
-            if msg.topic != TOPIC_ESP32_GPS_FAST:
+            # (late fixes are history only and would move the bus backwards)
+            if not fast and not late:
                 app_payload = {
                     "bus_mac": bus_mac,
                     "bus_name": bus_name,
-                    "lat": lat,
-                    "lon": lon,
+                    "lat": live_lat,
+                    "lon": live_lon,
+                    "speed_mps": speed,
+                    "heading_deg": heading,
                     "pm2_5": pm2_5,
                     "pm10": pm10,
                     "temp": temp,
                     "hum": hum,
                     "seats_available": seats_available
                 }
-                client.publish(TOPIC_APP_LOCATION, json.dumps(app_payload), qos=0, retain=False)
+                with stage(trace, "republish"):
+                    client.publish(TOPIC_APP_LOCATION, json.dumps(app_payload), qos=0, retain=False)
             
         else:
-            print("Error: Main event loop not set in mqtt.py")
+            logger.error("Main event loop not set in mqtt.py")
 
     except json.JSONDecodeError:
-        print(f"Error decoding JSON payload: {msg.payload.decode()}")
+        logger.warning("Error decoding JSON payload on %s: %r", msg.topic, msg.payload[:200])
+        MQTT_ERRORS.inc(labels=(msg.topic, "invalid_json"))
     except Exception as e:
-        print(f"An unexpected error occurred in on_message: {e}")
+        logger.exception("An unexpected error occurred in on_message: %s", e)
+        MQTT_ERRORS.inc(labels=(msg.topic, "exception"))
+    finally:
+        if trace_token is not None:
+            trace.add("handler", time.perf_counter() - started)
+            current_trace.reset(trace_token)
 
 # Create and configure the MQTT client
 # Use a fixed client ID to easily identify in Mosquitto logs
@@ -279,12 +375,14 @@ client.on_connect = on_connect
 client.on_message = on_message
 
 
-def connect_mqtt():
-    """Connects the client to the MQTT broker."""
+def connect_mqtt() -> bool:
+    """Connects the client to the MQTT broker; False if it could not be reached."""
     try:
         client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_KEEP_ALIVE)
+        return True
     except Exception as e:
-        print(f"Error connecting to MQTT Broker: {e}")
+        logger.error("Error connecting to MQTT Broker: %s", e)
+        return False
 
 def start_mqtt_loop():
     """Starts the MQTT client's network loop."""
@@ -0,0 +1,122 @@
+"""
+Ingest Ordering Module
+Duplicate and out-of-order detection for bus GPS fixes.
+
+MQTT QoS 0 and reconnects deliver some fixes twice and some late. Each
+fix is classified before anything is written:
+
+    duplicate  the exact payload (with `seq` or `ts`) was already seen on
+               this topic within the dedupe window (an LRU of payload
+               hashes) -> dropped
+    late       older than the bus's high-water mark -> stored in history
+               at its device time, but the live position is not moved back
+    new        everything else
+
+Ordering uses the optional payload fields `ts` (device time, unix seconds
+or milliseconds) and `seq` (per-device message counter). `ts` is compared
+across topics (fast and full GPS updates share the device clock); `seq` is
+tracked per topic, and seq 0 or a large backwards jump is taken as a
+device restart rather than a late fix. Fixes with neither are always
+"new", as before: without them a repeated payload is a parked bus sending
+steady readings, not a redelivery.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from core.config import settings
+from core.metrics import REGISTRY
+
+NEW = "new"
+LATE = "late"
+DUPLICATE = "duplicate"
+
+MAX_CLOCK_SKEW_SECONDS = 300  # Device times further ahead than this are ignored (clock not set)
+SEQ_RESET_GAP = 1000          # seq falling back by more than this = device restarted its counter
+
+OUT_OF_ORDER = REGISTRY.counter("mqtt_out_of_order_total", "GPS fixes dropped as duplicates or stored as late", ["kind"])
+
+
+def parse_device_time(value) -> Optional[float]:
+    """Payload `ts` as unix seconds (milliseconds accepted); raises ValueError/TypeError if not numeric."""
+    ts = float(value)
+    if ts > 1e12:
+        ts /= 1000.0
+    return ts
+
+
+class SequenceTracker:
+    """
+    Args:
+        window_size: Payload hashes remembered for dedupe (LRU)
+        window_seconds: How long a payload hash counts as a duplicate
+    """
+
+    def __init__(self, window_size: int = 4096, window_seconds: float = 60.0):
+        self.window_size = window_size
+        self.window_seconds = window_seconds
+        self.high_water: Dict[str, float] = {}          # bus_mac -> latest device time
+        self.sequences: Dict[Tuple[str, str], int] = {}  # (bus_mac, topic) -> latest seq
+        self.recent: "OrderedDict[tuple, float]" = OrderedDict()  # dedupe key -> first seen (monotonic)
+        self._lock = threading.Lock()
+
+    def _seen(self, key: tuple, now: float) -> bool:
+        recent = self.recent
+        cutoff = now - self.window_seconds
+        while recent and next(iter(recent.values())) < cutoff:
+            recent.popitem(last=False)
+        if key in recent:
+            return True
+        recent[key] = now
+        if len(recent) > self.window_size:
+            recent.popitem(last=False)
+        return False
+
+    def check(self, bus_mac: str, topic: str, raw: bytes, seq: Optional[int] = None,
+              device_ts: Optional[float] = None) -> Tuple[str, datetime]:
+        """
+        (outcome, timestamp) for one fix: outcome is NEW, LATE or
+        DUPLICATE; timestamp is the device time when usable, else now.
+        Safe to call from the MQTT thread.
+        """
+        now = time.time()
+        ordered = seq is not None or device_ts is not None  # Only these can be told apart from a repeat
+        if device_ts is not None and (device_ts > now + MAX_CLOCK_SKEW_SECONDS or device_ts <= 0):
+            device_ts = None
+        timestamp = datetime.utcfromtimestamp(device_ts if device_ts is not None else now)
+
+        with self._lock:
+            if ordered and self._seen((bus_mac, topic, hash(raw)), time.monotonic()):
+                outcome = DUPLICATE
+            elif device_ts is not None:
+                latest = self.high_water.get(bus_mac)
+                if latest is not None and device_ts < latest:
+                    outcome = LATE
+                else:
+                    self.high_water[bus_mac] = device_ts
+                    outcome = NEW
+            elif seq is not None:
+                stream = (bus_mac, topic)
+                latest = self.sequences.get(stream)
+                # seq 0 is the first message after a device restart
+                if latest is not None and 0 < seq <= latest and latest - seq < SEQ_RESET_GAP:
+                    outcome = LATE
+                else:
+                    self.sequences[stream] = seq
+                    outcome = NEW
+            else:
+                outcome = NEW
+
+        if outcome != NEW:
+            OUT_OF_ORDER.inc(labels=(outcome,))
+        return outcome, timestamp
+
+
+# Shared tracker (fed from the MQTT thread)
+sequence_tracker = SequenceTracker(
+    window_size=settings.DEDUPE_WINDOW_SIZE,
+    window_seconds=settings.DEDUPE_WINDOW_SECONDS,
+)
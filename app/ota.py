@@ -0,0 +1,325 @@
+"""
+OTA Rollout Module
+Staged firmware rollouts over MQTT.
+
+Instead of broadcasting one command that makes every device download at
+once, a rollout sends per-device commands (sut/ota/<device_type>/<mac>) in
+waves, keeps at most `max_concurrent` devices downloading, tracks progress
+from device acks on sut/ota/ack and pauses itself when the failure rate of
+finished devices crosses `failure_threshold`. A device that sends no ack
+for `device_timeout` seconds (since its command or its last ack, so slow
+downloads that keep reporting progress are not cut off) times out.
+
+Expected ack payload:
+    {"bus_mac": "...", "rollout_id": "...", "status": "downloading|success|failed", "error": "..."}
+"""
+
+import asyncio
+import json
+import socket
+import time
+import uuid
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from core.config import settings
+
+TOPIC_OTA_DEVICE = "sut/ota/{device_type}/{mac}"
+
+# Server address detection is cached; the LAN IP rarely changes
+SERVER_HOST_TTL_SECONDS = 300
+FALLBACK_SERVER_HOST = "203.158.3.14"
+
+IN_FLIGHT_STATES = ("sent", "downloading")
+
+_server_host_cache = {"host": None, "expires": 0.0}
+
+
+def get_server_host() -> str:
+    """
+    Address devices should use to reach this server.
+
+    Uses OTA_SERVER_HOST if configured, otherwise the MQTT broker host
+    (they are co-located); for localhost the LAN IP is detected once and
+    cached for SERVER_HOST_TTL_SECONDS.
+    """
+    if settings.OTA_SERVER_HOST:
+        return settings.OTA_SERVER_HOST
+
+    server_host = settings.MQTT_BROKER_HOST
+    if server_host not in ["localhost", "127.0.0.1", "::1"]:
+        return server_host
+
+    now = time.monotonic()
+    if _server_host_cache["host"] and now < _server_host_cache["expires"]:
+        return _server_host_cache["host"]
+
+    try:
+        # Connect to a public DNS server (doesn't send data) to get local IP
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(0.1)
+        s.connect(("8.8.8.8", 80))
+        server_host = s.getsockname()[0]
+        s.close()
+        print(f"📍 Auto-detected LAN IP for OTA: {server_host}")
+    except Exception as e:
+        print(f"⚠️ Could not detect LAN IP: {e}")
+        server_host = FALLBACK_SERVER_HOST  # Fallback only if detection fails
+
+    _server_host_cache["host"] = server_host
+    _server_host_cache["expires"] = now + SERVER_HOST_TTL_SECONDS
+    return server_host
+
+
+def firmware_url(filename: str) -> str:
+    return f"http://{get_server_host()}:8000/firmware/{filename}"
+
+
+class Rollout:
+    def __init__(self, device_type: str, version: str, devices: List[str], url: str,
+                 force: bool = False, sha256: Optional[str] = None, size_bytes: Optional[int] = None,
+                 wave_size: int = 5, max_concurrent: int = 10, wave_interval: float = 10.0,
+                 failure_threshold: float = 0.2, min_samples: int = 5, device_timeout: float = 300.0):
+        self.id = uuid.uuid4().hex[:12]
+        self.device_type = device_type
+        self.version = version
+        self.url = url
+        self.force = force
+        self.sha256 = sha256
+        self.size_bytes = size_bytes
+        self.wave_size = max(1, wave_size)
+        self.max_concurrent = max(1, max_concurrent)
+        self.wave_interval = wave_interval
+        self.failure_threshold = failure_threshold
+        self.min_samples = max(1, min_samples)
+        self.device_timeout = device_timeout
+
+        self.status = "running"
+        self.pause_reason: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.waves = 0
+
+        # De-duplicate while keeping order
+        unique = list(dict.fromkeys(devices))
+        self.devices: Dict[str, dict] = {mac: {"state": "pending"} for mac in unique}
+        self.pending = deque(unique)
+        self.in_flight = set()
+
+        # Outcomes since start / last resume, used for the failure-rate check
+        self.window_success = 0
+        self.window_failed = 0
+
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def counts(self) -> dict:
+        counts = {"pending": 0, "sent": 0, "downloading": 0, "success": 0, "failed": 0, "timeout": 0}
+        for device in self.devices.values():
+            counts[device["state"]] += 1
+        return counts
+
+    def summary(self, include_devices: bool = False) -> dict:
+        data = {
+            "id": self.id,
+            "device_type": self.device_type,
+            "version": self.version,
+            "status": self.status,
+            "pause_reason": self.pause_reason,
+            "url": self.url,
+            "wave_size": self.wave_size,
+            "max_concurrent": self.max_concurrent,
+            "failure_threshold": self.failure_threshold,
+            "waves": self.waves,
+            "total_devices": len(self.devices),
+            "counts": self.counts(),
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+        if include_devices:
+            data["devices"] = self.devices
+        return data
+
+
+class RolloutManager:
+    """
+    Runs rollouts as asyncio tasks on the main loop.
+    `publish` is the MQTT client's publish method (thread-safe in paho).
+    """
+
+    def __init__(self, publish: Callable):
+        self.publish = publish
+        self.rollouts: Dict[str, Rollout] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def set_loop(self, loop):
+        self.loop = loop
+
+    # --- Lifecycle ---
+
+    def start(self, rollout: Rollout) -> Rollout:
+        self.rollouts[rollout.id] = rollout
+        rollout.task = asyncio.create_task(self._run(rollout))
+        print(f"🚀 OTA rollout {rollout.id} started: {rollout.device_type} v{rollout.version} -> {len(rollout.devices)} devices")
+        return rollout
+
+    def get(self, rollout_id: str) -> Optional[Rollout]:
+        return self.rollouts.get(rollout_id)
+
+    def list_rollouts(self) -> List[dict]:
+        return [r.summary() for r in sorted(self.rollouts.values(), key=lambda r: r.created_at, reverse=True)]
+
+    def pause(self, rollout: Rollout, reason: str = "manual"):
+        if rollout.status == "running":
+            rollout.status = "paused"
+            rollout.pause_reason = reason
+            print(f"⏸️ OTA rollout {rollout.id} paused ({reason})")
+            rollout.wakeup.set()
+
+    def resume(self, rollout: Rollout):
+        if rollout.status == "paused":
+            rollout.status = "running"
+            rollout.pause_reason = None
+            rollout.window_success = 0
+            rollout.window_failed = 0
+            print(f"▶️ OTA rollout {rollout.id} resumed")
+            rollout.wakeup.set()
+
+    def cancel(self, rollout: Rollout):
+        if rollout.status in ("running", "paused"):
+            rollout.status = "cancelled"
+            rollout.finished_at = time.time()
+            print(f"⏹️ OTA rollout {rollout.id} cancelled")
+            rollout.wakeup.set()
+
+    # --- Scheduler ---
+
+    async def _run(self, rollout: Rollout):
+        try:
+            while rollout.status in ("running", "paused"):
+                self._expire_timeouts(rollout)
+
+                if rollout.status == "running":
+                    if self._failure_rate_exceeded(rollout):
+                        rate = rollout.window_failed / (rollout.window_failed + rollout.window_success)
+                        self.pause(rollout, reason=f"failure rate {rate:.0%} above {rollout.failure_threshold:.0%}")
+                    else:
+                        self._dispatch_wave(rollout)
+
+                if not rollout.pending and not rollout.in_flight:
+                    rollout.status = "completed"
+                    rollout.finished_at = time.time()
+                    print(f"✅ OTA rollout {rollout.id} completed: {rollout.counts()}")
+                    break
+
+                try:
+                    await asyncio.wait_for(rollout.wakeup.wait(), timeout=rollout.wave_interval)
+                except asyncio.TimeoutError:
+                    pass
+                rollout.wakeup.clear()
+        except Exception as e:
+            print(f"❌ OTA rollout {rollout.id} crashed: {e}")
+            rollout.status = "paused"
+            rollout.pause_reason = f"error: {e}"
+
+    def _failure_rate_exceeded(self, rollout: Rollout) -> bool:
+        finished = rollout.window_success + rollout.window_failed
+        if finished < rollout.min_samples:
+            return False
+        return rollout.window_failed / finished > rollout.failure_threshold
+
+    def _dispatch_wave(self, rollout: Rollout):
+        slots = min(rollout.wave_size, rollout.max_concurrent - len(rollout.in_flight))
+        if slots <= 0 or not rollout.pending:
+            return
+
+        sent = 0
+        while sent < slots and rollout.pending:
+            mac = rollout.pending.popleft()
+            if self._send_command(rollout, mac):
+                sent += 1
+        if sent:
+            rollout.waves += 1
+
+    def _send_command(self, rollout: Rollout, mac: str) -> bool:
+        device = rollout.devices[mac]
+        payload = {
+            "command": "ota_update",
+            "rollout_id": rollout.id,
+            "bus_mac": mac,
+            "version": rollout.version,
+            "url": rollout.url,
+            "sha256": rollout.sha256,
+            "size": rollout.size_bytes,
+            "force": rollout.force,
+            "timestamp": int(time.time())
+        }
+        topic = TOPIC_OTA_DEVICE.format(device_type=rollout.device_type, mac=mac)
+        now = time.time()
+        try:
+            self.publish(topic, json.dumps(payload), qos=1)
+        except Exception as e:
+            print(f"❌ OTA publish error for {topic}: {e}")
+            device.update({"state": "failed", "error": f"publish: {e}", "updated_at": now})
+            rollout.window_failed += 1
+            return False
+
+        device.update({"state": "sent", "sent_at": now, "last_progress_at": now, "updated_at": now})
+        rollout.in_flight.add(mac)
+        return True
+
+    def _expire_timeouts(self, rollout: Rollout):
+        """In-flight devices silent for device_timeout (since the command or their last ack) time out."""
+        now = time.time()
+        for mac in list(rollout.in_flight):
+            device = rollout.devices[mac]
+            if now - device.get("last_progress_at", now) > rollout.device_timeout:
+                device.update({"state": "timeout", "updated_at": now})
+                rollout.in_flight.discard(mac)
+                rollout.window_failed += 1
+
+    # --- Device acks ---
+
+    def handle_ack_threadsafe(self, payload: bytes):
+        """Called from the MQTT thread; hops onto the event loop."""
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.handle_ack, payload)
+
+    def handle_ack(self, payload: bytes):
+        try:
+            data = json.loads(payload)
+        except (ValueError, TypeError):
+            print(f"Error decoding OTA ack: {payload!r}")
+            return
+
+        mac = data.get("bus_mac")
+        status = data.get("status")
+        if not isinstance(mac, str) or status not in ("downloading", "success", "failed"):
+            return
+
+        rollout = self.rollouts.get(data.get("rollout_id"))
+        if rollout is None:
+            # Older firmware doesn't echo rollout_id: find the rollout waiting on this device
+            rollout = next((r for r in self.rollouts.values() if mac in r.in_flight), None)
+        if rollout is None or mac not in rollout.devices:
+            return
+
+        device = rollout.devices[mac]
+        if device["state"] not in IN_FLIGHT_STATES:
+            return
+
+        device["updated_at"] = device["last_progress_at"] = time.time()
+        if status == "downloading":
+            device["state"] = "downloading"
+            return
+
+        device["state"] = status
+        rollout.in_flight.discard(mac)
+        if status == "success":
+            rollout.window_success += 1
+        else:
+            device["error"] = str(data.get("error", ""))[:200]
+            rollout.window_failed += 1
+        # A slot freed up: let the scheduler dispatch without waiting a full interval
+        rollout.wakeup.set()
@@ -0,0 +1,94 @@
+"""
+Keyset Pagination Module
+Opaque cursor tokens for list endpoints.
+
+A page is fetched with "sort keys after the last row of the previous page"
+instead of skip(n): every page is an index range scan from the cursor, so
+page 1000 costs the same as page 1, and rows inserted while a client pages
+never shift the window (no skipped or duplicated rows).
+
+A cursor encodes the sort-key values of the last row returned, tagged with
+the sort it belongs to so a cursor from one endpoint is rejected by another.
+"""
+
+import base64
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from bson import ObjectId
+
+Sort = List[Tuple[str, int]]  # [(field, 1 | -1), ...], must end with a unique field (_id)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _sort_tag(sort: Sort) -> str:
+    return ",".join(f"{field}{'+' if direction > 0 else '-'}" for field, direction in sort)
+
+
+def _encode_value(value):
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if "$oid" in value:
+            return ObjectId(value["$oid"])
+        if "$date" in value:
+            return datetime.fromisoformat(value["$date"])
+    return value
+
+
+def encode_cursor(sort: Sort, doc: dict) -> str:
+    """Cursor pointing just after `doc` in `sort` order."""
+    payload = {"s": _sort_tag(sort), "v": [_encode_value(doc.get(field)) for field, _ in sort]}
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(sort: Sort, token: str) -> tuple:
+    """Sort-key values from `token`; raises InvalidCursor."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        payload = json.loads(raw)
+        values = [_decode_value(v) for v in payload["v"]]
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursor("Malformed cursor")
+    if payload.get("s") != _sort_tag(sort) or len(values) != len(sort):
+        raise InvalidCursor("Cursor does not belong to this listing")
+    return tuple(values)
+
+
+def keyset_filter(sort: Sort, after: tuple) -> dict:
+    """
+    Rows strictly after `after` in `sort` order, e.g. for
+    [("timestamp", -1), ("_id", -1)]:
+        {"$or": [{"timestamp": {"$lt": t}}, {"timestamp": t, "_id": {"$lt": id}}]}
+    """
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = {prev_field: after[j] for j, (prev_field, _) in enumerate(sort[:i])}
+        branch[field] = {"$gt" if direction > 0 else "$lt": after[i]}
+        branches.append(branch)
+    return branches[0] if len(branches) == 1 else {"$or": branches}
+
+
+def keyset_query(query: dict, sort: Sort, after: Optional[tuple]) -> dict:
+    if after is None:
+        return query
+    condition = keyset_filter(sort, after)
+    return {"$and": [query, condition]} if query else condition
+
+
+def next_cursor(sort: Sort, docs: list, limit: int) -> Optional[str]:
+    """Cursor for the following page, or None when this page was the last."""
+    if len(docs) < limit or not docs:
+        return None
+    return encode_cursor(sort, docs[-1])
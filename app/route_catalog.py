@@ -0,0 +1,92 @@
+"""
+Route Catalog Module
+Route files (routes/<routeId>.json) uploaded from the app's admin mode.
+
+The listing summaries (name, colour, waypoint and stop counts) are cached
+per file under its (mtime, size): a listing stats the directory's files
+and re-reads only those added or changed since, so files copied in or
+edited by hand show up on the next request. The catalog is created on
+first use (app/main.py), so the directory is not touched at import.
+"""
+
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+def is_valid_route_id(route_id: str) -> bool:
+    """Route IDs become file names: no path separators or traversal."""
+    return bool(route_id) and ".." not in route_id and "/" not in route_id and "\\" not in route_id
+
+
+def summarize(filename: str, route_data: dict) -> dict:
+    return {
+        "routeId": route_data.get("routeId", filename.replace('.json', '')),
+        "routeName": route_data.get("routeName", "Unnamed Route"),
+        "routeColor": route_data.get("routeColor", "#2563eb"),
+        "waypointCount": len(route_data.get("waypoints", [])),
+        "stopCount": sum(1 for wp in route_data.get("waypoints", []) if wp.get("isStop")),
+        "updatedAt": route_data.get("updatedAt"),
+    }
+
+
+class RouteCatalog:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._summaries: Dict[str, Tuple[tuple, dict]] = {}  # filename -> ((mtime_ns, size), summary)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path_for(self, route_id: str) -> str:
+        return os.path.join(self.directory, f"{route_id}.json")
+
+    @staticmethod
+    def _stamp(stat: os.stat_result) -> tuple:
+        return stat.st_mtime_ns, stat.st_size
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            summaries = {}
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith('.json') or not entry.is_file():
+                    continue
+                try:
+                    stamp = self._stamp(entry.stat())
+                    cached = self._summaries.get(entry.name)
+                    if cached is not None and cached[0] == stamp:
+                        summaries[entry.name] = cached
+                        continue
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        summaries[entry.name] = (stamp, summarize(entry.name, json.load(f)))
+                except Exception as e:
+                    print(f"Error reading route file {entry.name}: {e}")
+            self._summaries = summaries
+            return [summary for _, summary in summaries.values()]
+
+    def get(self, route_id: str) -> Optional[dict]:
+        """Full route data, or None if there is no such route."""
+        try:
+            with open(self.path_for(route_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, route: dict):
+        filename = f"{route['routeId']}.json"
+        path = os.path.join(self.directory, filename)
+        with self._lock:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(route, f, ensure_ascii=False, indent=2)
+            self._summaries[filename] = (self._stamp(os.stat(path)), summarize(filename, route))
+
+    def delete(self, route_id: str) -> bool:
+        """False if there was no such route."""
+        filename = f"{route_id}.json"
+        with self._lock:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                return False
+            self._summaries.pop(filename, None)
+            return True
@@ -0,0 +1,327 @@
+"""
+Ingest Spill Module
+Durable local buffer for readings while MongoDB is down or too slow.
+
+Ingest writes go through `ingest_writer.store()`. While MongoDB answers
+within SPILL_WRITE_TIMEOUT_SECONDS the reading is inserted directly; on a
+timeout or error the writer marks MongoDB unavailable and readings are
+appended to a SQLite database in WAL mode instead (synchronous=NORMAL: an
+append is a page write, no fsync per reading), from a worker thread like
+every other buffer operation, so the event loop never waits on the disk. Every few seconds the
+writer pings MongoDB and, once it answers, replays the buffer oldest
+first in insert_many batches and truncates what was stored.
+
+Readings get their _id before the first attempt, so a write that timed out
+but landed, or a replay interrupted before its rows were deleted, is
+skipped as a duplicate key instead of stored twice. The buffer is bounded
+by SPILL_MAX_MB; beyond that new readings are dropped and counted.
+
+Only connectivity errors (network, timeouts, write concern) mean MongoDB
+is unavailable. A reading MongoDB itself rejects (a write error on that
+document) would fail the same way on every retry, so it is moved to a
+dead-letter table in the same file (the newest MAX_DEAD_ROWS are kept)
+instead of blocking the readings behind it or switching ingest to the
+buffer.
+
+Live bus documents are not spilled: they are last-value state, and the
+first fix after recovery refreshes them.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import bson
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, ConnectionFailure, ExecutionTimeout, PyMongoError, WTimeoutError
+
+from app import crud
+from core.config import settings
+from core.logger import SampledLogger
+from core.metrics import REGISTRY
+from core.mongo import ping
+
+logger = logging.getLogger(__name__)
+spill_logger = SampledLogger(__name__)  # Per-reading lines, 1 in LOG_SAMPLE_EVERY
+
+RETRY_SECONDS = 5.0  # MongoDB ping interval while unavailable / buffer not empty
+MAX_DEAD_ROWS = 10000  # Rejected readings kept for inspection
+DUPLICATE_KEY = 11000
+
+SPILL_ROWS = REGISTRY.counter("ingest_spill_rows_total", "Readings through the local spill buffer", ["outcome"])
+
+Row = Tuple[int, str, dict, int]  # id, collection, document, encoded size
+
+
+def is_unavailable(error: BaseException) -> bool:
+    """True for errors worth retrying later (MongoDB unreachable or slow), False for rejected documents."""
+    if isinstance(error, (ConnectionFailure, ExecutionTimeout, WTimeoutError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, BulkWriteError):
+        return bool(error.details.get("writeConcernErrors"))
+    return isinstance(error, PyMongoError) and error.has_error_label("RetryableWriteError")
+
+
+def describe(error: BaseException) -> str:
+    return f"{type(error).__name__}: {error}"[:500]
+
+
+class SpillBuffer:
+    """Append-only SQLite (WAL) queue of BSON documents, bounded by `max_bytes` of payload."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.bytes = 0
+        self.dead_rows = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS spill ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT NOT NULL, doc BLOB NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letter ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT NOT NULL, doc BLOB NOT NULL, "
+            "error TEXT, failed_at REAL NOT NULL)"
+        )
+        self.dead_rows = conn.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+        self.rows, self.bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(doc)), 0) FROM spill").fetchone()
+        self._conn = conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def append(self, collection: str, doc: dict) -> bool:
+        """False (nothing written) when the buffer is full or closed."""
+        data = bson.encode(doc)
+        with self._lock:
+            if self._conn is None or self.bytes + len(data) > self.max_bytes:
+                return False
+            self._conn.execute("INSERT INTO spill (collection, doc) VALUES (?, ?)", (collection, data))
+            self.rows += 1
+            self.bytes += len(data)
+        return True
+
+    def read(self, limit: int) -> List[Row]:
+        """Oldest `limit` rows (not removed until delete_through)."""
+        with self._lock:
+            if self._conn is None:
+                return []
+            rows = self._conn.execute(
+                "SELECT id, collection, doc FROM spill ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [(row_id, collection, bson.decode(data), len(data)) for row_id, collection, data in rows]
+
+    def delete_through(self, last_id: int, count: int, size: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM spill WHERE id <= ?", (last_id,))
+            self.rows -= count
+            self.bytes -= size
+
+    def bury(self, rejected: List[Tuple[str, dict, str]]):
+        """Store (collection, document, error) entries in the dead-letter table, keeping the newest MAX_DEAD_ROWS."""
+        now = time.time()
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.executemany(
+                "INSERT INTO dead_letter (collection, doc, error, failed_at) VALUES (?, ?, ?, ?)",
+                [(collection, bson.encode(doc), error, now) for collection, doc, error in rejected],
+            )
+            self.dead_rows += len(rejected)
+            if self.dead_rows > MAX_DEAD_ROWS:
+                self._conn.execute(
+                    "DELETE FROM dead_letter WHERE id <= (SELECT MAX(id) FROM dead_letter) - ?", (MAX_DEAD_ROWS,)
+                )
+                self.dead_rows = self._conn.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+
+    def compact(self):
+        """Give the disk back once drained (WAL truncated, file vacuumed)."""
+        with self._lock:
+            if self._conn is not None and self.rows == 0:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self._conn.execute("VACUUM")
+
+
+class IngestWriter:
+    """
+    Args:
+        buffer: Where readings go while MongoDB is unavailable
+        insert: Coroutine inserting (collection name, documents), e.g. crud.insert_readings
+        is_up: Coroutine returning True when MongoDB answers
+        write_timeout: Seconds a direct insert may take before spilling
+        batch_size: Readings per replay insert_many
+    """
+
+    def __init__(self, buffer: SpillBuffer, insert: Callable[[str, list], Awaitable],
+                 is_up: Callable[[], Awaitable[bool]], write_timeout: float = 2.0,
+                 batch_size: int = 1000):
+        self.buffer = buffer
+        self.insert = insert
+        self.is_up = is_up
+        self.write_timeout = write_timeout
+        self.batch_size = batch_size
+        self.available = True
+        self._task: Optional[asyncio.Task] = None
+
+    def _mark_down(self, error: Exception):
+        if self.available:
+            self.available = False
+            logger.warning("MongoDB unavailable (%s); spilling readings to %s",
+                           str(error) or type(error).__name__, self.buffer.path)
+
+    async def store(self, collection: str, doc: dict):
+        """Insert one reading, or spill it if MongoDB is (or just became) unavailable."""
+        doc.setdefault("_id", ObjectId())
+        if self.available:
+            try:
+                await asyncio.wait_for(self.insert(collection, [doc]), self.write_timeout)
+                return
+            except Exception as e:
+                if not is_unavailable(e):
+                    await self._reject([(collection, doc, describe(e))])
+                    return
+                self._mark_down(e)
+        if await asyncio.to_thread(self.buffer.append, collection, doc):  # SQLite write: not on the loop
+            SPILL_ROWS.inc(labels=("spilled",))
+        else:
+            SPILL_ROWS.inc(labels=("dropped",))
+            spill_logger.warning("Spill buffer full (%d bytes); dropped reading from %s",
+                                 self.buffer.bytes, doc.get("bus_mac"))
+
+    async def _reject(self, rejected: List[Tuple[str, dict, str]]):
+        await asyncio.to_thread(self.buffer.bury, rejected)
+        SPILL_ROWS.inc(len(rejected), labels=("dead_lettered",))
+        spill_logger.warning("MongoDB rejected %d reading(s), moved to the dead-letter table: %s",
+                             len(rejected), rejected[0][2])
+
+    async def _insert_rows(self, collection: str, rows: List[Row]) -> List[Tuple[str, dict, str]]:
+        """
+        Insert one collection's rows of a replay batch; returns the ones
+        MongoDB rejected, as (collection, document, error). Raises when
+        MongoDB is unavailable.
+        """
+        docs = [row[2] for row in rows]
+        try:
+            await self.insert(collection, docs)
+            return []
+        except BulkWriteError as e:
+            if is_unavailable(e):
+                raise
+            # Unordered insert: everything but these documents was stored
+            return [(collection, docs[err["index"]], err.get("errmsg", ""))
+                    for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY]
+        except Exception as e:
+            if is_unavailable(e):
+                raise
+        # The batch failed as a whole: find the culprits one document at a time
+        rejected = []
+        for doc in docs:
+            try:
+                await self.insert(collection, [doc])
+            except Exception as e:
+                if is_unavailable(e):
+                    raise
+                rejected.append((collection, doc, describe(e)))
+        return rejected
+
+    async def replay(self) -> int:
+        """Move buffered readings to MongoDB, oldest first; returns how many were stored."""
+        replayed = 0
+        while self.buffer.rows:
+            rows = await asyncio.to_thread(self.buffer.read, self.batch_size)
+            if not rows:
+                break
+            by_collection: dict = {}
+            for row in rows:
+                by_collection.setdefault(row[1], []).append(row)
+            rejected = []
+            try:
+                for collection, collection_rows in by_collection.items():
+                    rejected += await self._insert_rows(collection, collection_rows)
+            except Exception as e:
+                self._mark_down(e)
+                break
+            if rejected:
+                await self._reject(rejected)
+            await asyncio.to_thread(self.buffer.delete_through, rows[-1][0], len(rows), sum(r[3] for r in rows))
+            replayed += len(rows) - len(rejected)
+            SPILL_ROWS.inc(len(rows) - len(rejected), labels=("replayed",))
+        if not self.buffer.rows:
+            await asyncio.to_thread(self.buffer.compact)
+        return replayed
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(RETRY_SECONDS)
+            if self.available and not self.buffer.rows:
+                continue
+            try:
+                if not await self.is_up():
+                    continue
+                if not self.available:
+                    logger.info("MongoDB reachable again; replaying %d spilled readings", self.buffer.rows)
+                self.available = True
+                replayed = await self.replay()
+                if replayed:
+                    logger.info("Replayed %d spilled readings (%d left)", replayed, self.buffer.rows)
+            except Exception as e:
+                logger.error("Error replaying spill buffer: %s", e)
+
+    async def start(self):
+        await asyncio.to_thread(self.buffer.open)  # Counts existing rows: not on the loop
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.buffer.close()
+
+    def stats(self) -> dict:
+        return {
+            "mongo_available": self.available,
+            "buffered_readings": self.buffer.rows,
+            "buffered_bytes": self.buffer.bytes,
+            "dead_letter_readings": self.buffer.dead_rows,
+            "max_bytes": self.buffer.max_bytes,
+            "path": self.buffer.path,
+        }
+
+
+ingest_writer = IngestWriter(
+    SpillBuffer(settings.SPILL_PATH, settings.SPILL_MAX_MB * 1024 * 1024),
+    crud.insert_readings,
+    ping,
+    write_timeout=settings.SPILL_WRITE_TIMEOUT_SECONDS,
+    batch_size=settings.SPILL_REPLAY_BATCH,
+)
+
+REGISTRY.gauge("ingest_spill_buffered", "Readings waiting in the local spill buffer", lambda: ingest_writer.buffer.rows)
+REGISTRY.gauge("ingest_spill_fill_ratio", "Spill buffer use (1 = full, new readings dropped)",
+               lambda: ingest_writer.buffer.bytes / ingest_writer.buffer.max_bytes if ingest_writer.buffer.max_bytes else 0)
+REGISTRY.gauge("ingest_spill_dead_letter", "Readings MongoDB rejected, kept in the dead-letter table",
+               lambda: ingest_writer.buffer.dead_rows)
+REGISTRY.gauge("mongo_available", "1 while ingest writes go to MongoDB, 0 while spilling", lambda: int(ingest_writer.available))
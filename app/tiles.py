@@ -0,0 +1,263 @@
+"""
+Heatmap Tiles Module
+PM2.5 intensity per slippy-map tile (/api/heatmap/tiles/{z}/{x}/{y}).
+
+Each 256px tile is a GRID x GRID raster of cells (4px each). MongoDB bins
+the readings inside the tile into cells (Web Mercator maths in the
+aggregation), and the cell means are encoded either as a PNG with the
+usual PM2.5 colour bands or as a compact binary grid:
+
+    bin: GRID*GRID little-endian uint16, row-major from the tile's top-left,
+         PM2.5 * 10 per cell, 0xFFFF = no readings
+
+Tiles are cached in-process (LRU) under (z, x, y, range, time bucket,
+format). The time bucket makes "last hour" style windows slide in steps
+rather than per request, and a new reading evicts only the cached tiles
+that contain it (one tile per cached zoom level).
+"""
+
+import asyncio
+import math
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set, Tuple
+
+from app.heatmap import TILE_SIZE
+from core.config import settings
+from core.metrics import REGISTRY
+
+GRID = 64
+CELL_PIXELS = TILE_SIZE // GRID
+MAX_TILE_ZOOM = 20
+NO_DATA = 0xFFFF
+# Browser/proxy cache lifetime of a tile. New readings evict the server-side
+# tile at once, so clients revalidate (ETag -> 304) after at most this long
+TILE_MAX_AGE_SECONDS = 60
+
+# range -> (window seconds or None for all history, time bucket seconds)
+TILE_RANGES = {
+    "now": (30 * 60, 60),
+    "1h": (3600, 300),
+    "1d": (86400, 1800),
+    "1w": (7 * 86400, 6 * 3600),
+    "3m": (90 * 86400, 86400),
+    "all": (None, 86400),
+}
+
+# (upper bound of PM2.5 band, RGBA)
+PM25_COLORS = [
+    (15.0, (0, 228, 0, 160)),       # Good
+    (35.0, (255, 255, 0, 170)),     # Moderate
+    (55.0, (255, 126, 0, 180)),     # Unhealthy for sensitive groups
+    (150.0, (255, 0, 0, 190)),      # Unhealthy
+    (float("inf"), (143, 63, 151, 200)),  # Very unhealthy
+]
+TRANSPARENT = (0, 0, 0, 0)
+
+TILE_CACHE_HITS = REGISTRY.counter("heatmap_tile_cache_hits_total", "Heatmap tiles served from cache")
+TILE_CACHE_MISSES = REGISTRY.counter("heatmap_tile_cache_misses_total", "Heatmap tiles rendered")
+TILE_CACHE_INVALIDATIONS = REGISTRY.counter(
+    "heatmap_tile_cache_invalidations_total", "Cached heatmap tiles evicted by new readings"
+)
+
+TileKey = Tuple[int, int, int]
+
+
+def lonlat_to_tile(lon: float, lat: float, zoom: int) -> TileKey:
+    n = 2 ** zoom
+    lat = max(-85.05112878, min(85.05112878, lat))
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return zoom, min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(zoom: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(min_lon, min_lat, max_lon, max_lat) of a tile."""
+    n = 2 ** zoom
+
+    def lat_of(row: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return x / n * 360.0 - 180.0, lat_of(y + 1), (x + 1) / n * 360.0 - 180.0, lat_of(y)
+
+
+def is_valid_tile(zoom: int, x: int, y: int) -> bool:
+    return 0 <= zoom <= MAX_TILE_ZOOM and 0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom
+
+
+def time_window(range_key: str, now: Optional[float] = None) -> Tuple[int, Optional[datetime], datetime]:
+    """(bucket index, start, end) for a range; the window ends at the bucket boundary."""
+    window, bucket_seconds = TILE_RANGES[range_key]
+    now = time.time() if now is None else now
+    bucket = int(now // bucket_seconds)
+    end = datetime.utcfromtimestamp((bucket + 1) * bucket_seconds)
+    start = end - timedelta(seconds=window) if window else None
+    return bucket, start, end
+
+
+def _color(pm25: float) -> Tuple[int, int, int, int]:
+    for upper, rgba in PM25_COLORS:
+        if pm25 < upper:
+            return rgba
+    return PM25_COLORS[-1][1]
+
+
+def encode_png(cells: Dict[Tuple[int, int], float]) -> bytes:
+    """256x256 RGBA PNG, each cell filled as a CELL_PIXELS square."""
+    rows = []
+    for cy in range(GRID):
+        row = bytearray(b"\x00")  # Filter type: None
+        for cx in range(GRID):
+            value = cells.get((cx, cy))
+            row += bytes(TRANSPARENT if value is None else _color(value)) * CELL_PIXELS
+        rows.append(bytes(row) * CELL_PIXELS)
+    raw = b"".join(rows)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", TILE_SIZE, TILE_SIZE, 8, 6, 0, 0, 0)  # 8-bit RGBA
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b"")
+
+
+def encode_grid(cells: Dict[Tuple[int, int], float]) -> bytes:
+    values = [NO_DATA] * (GRID * GRID)
+    for (cx, cy), value in cells.items():
+        values[cy * GRID + cx] = min(NO_DATA - 1, int(round(value * 10)))
+    return struct.pack(f"<{GRID * GRID}H", *values)
+
+
+ENCODERS = {
+    "png": (encode_png, "image/png"),
+    "bin": (encode_grid, "application/octet-stream"),
+}
+
+
+class TileCache:
+    """
+    LRU of rendered tiles with a (z, x, y) -> cache keys index, so a reading
+    evicts exactly the cached tiles it falls in. A tile still rendering when
+    a reading lands in it is served but not cached (it may predate the
+    insert). The lock keeps stats() consistent for callers off the loop.
+    """
+
+    def __init__(self, max_entries: int = 2048):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[tuple, Tuple[bytes, str]]" = OrderedDict()
+        self.by_tile: Dict[TileKey, Set[tuple]] = {}
+        self.zoom_counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._stale: Set[tuple] = set()
+
+    def get(self, key: tuple) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, body: bytes, etag: str):
+        tile = key[:3]
+        with self._lock:
+            if key not in self.entries:
+                self.by_tile.setdefault(tile, set()).add(key)
+                self.zoom_counts[tile[0]] = self.zoom_counts.get(tile[0], 0) + 1
+            self.entries[key] = (body, etag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                old_key, _ = self.entries.popitem(last=False)
+                self._unindex(old_key)
+
+    def _unindex(self, key: tuple):
+        tile = key[:3]
+        keys = self.by_tile.get(tile)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_tile[tile]
+        count = self.zoom_counts.get(tile[0], 0) - 1
+        if count > 0:
+            self.zoom_counts[tile[0]] = count
+        else:
+            self.zoom_counts.pop(tile[0], None)
+
+    def invalidate_point(self, lat: float, lon: float) -> int:
+        """Evict every cached tile containing (lat, lon); returns how many."""
+        evicted = 0
+        with self._lock:
+            for key in self._inflight:
+                if key[:3] == lonlat_to_tile(lon, lat, key[0]):
+                    self._stale.add(key)
+            for zoom in list(self.zoom_counts):
+                keys = self.by_tile.pop(lonlat_to_tile(lon, lat, zoom), None)
+                if not keys:
+                    continue
+                for key in keys:
+                    self.entries.pop(key, None)
+                    evicted += 1
+                count = self.zoom_counts.get(zoom, 0) - len(keys)
+                if count > 0:
+                    self.zoom_counts[zoom] = count
+                else:
+                    self.zoom_counts.pop(zoom, None)
+        if evicted:
+            TILE_CACHE_INVALIDATIONS.inc(evicted)
+        return evicted
+
+    async def get_or_render(self, key: tuple, render) -> Tuple[bytes, str]:
+        """Cached tile, or render() once even when several requests miss together."""
+        entry = self.get(key)
+        if entry is not None:
+            TILE_CACHE_HITS.inc()
+            return entry
+
+        pending = self._inflight.get(key)
+        while pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # This request was cancelled
+            # The request rendering it was cancelled: render here instead
+            pending = self._inflight.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            TILE_CACHE_MISSES.inc()
+            body = await render()
+            etag = f'"{zlib.crc32(body):08x}-{len(body)}"'
+            if key not in self._stale:
+                self.put(key, body, etag)
+            future.set_result((body, etag))
+            return body, etag
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved when nobody else was waiting
+            raise
+        finally:
+            if not future.done():
+                future.cancel()  # Render cancelled (client gone, shutdown): release the waiters
+            del self._inflight[key]
+            self._stale.discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries,
+                    "zooms": sorted(self.zoom_counts)}
+
+
+tile_cache = TileCache(settings.HEATMAP_TILE_CACHE_SIZE)
+
+
+async def render_tile(fetch_cells, zoom: int, x: int, y: int, range_key: str, fmt: str) -> bytes:
+    """Query the tile's cells with `fetch_cells` (crud.get_tile_cells) and encode them."""
+    _, start, end = time_window(range_key)
+    cells = await fetch_cells(zoom, x, y, tile_bounds(zoom, x, y), GRID, start, end)
+    encoder, _ = ENCODERS[fmt]
+    return encoder({(c["x"], c["y"]): c["pm2_5"] for c in cells if 0 <= c["x"] < GRID and 0 <= c["y"] < GRID})
@@ -0,0 +1,140 @@
+"""
+GPS Tracking Module
+Per-bus position smoothing that fuses sut/bus/gps and sut/bus/gps/fast fixes.
+
+Each bus has a constant-velocity Kalman filter on a local equirectangular
+plane (metres east/north of the bus's first fix). Fast GPS-only fixes and
+full sensor updates feed the same filter, so the live position published
+with a sensor update already includes every fast fix in between:
+
+    predict:  x += v * dt,  P = F P F' + Q(dt)   (white-noise acceleration)
+    update:   x += K * (z - x),  K = P H' / (P00 + R)
+
+Both axes see the same measurement and process noise, so they share one
+2x2 covariance (3 floats) and a track is a handful of slots. A fix further
+than the chi-square gate from the prediction is ignored (GPS multipath);
+a run of rejected fixes, or a long gap, re-seeds the track at the fix.
+
+History keeps the raw fixes; the smoothed position, speed and heading go
+to the live bus document and the app topic.
+"""
+
+import math
+import threading
+from typing import Dict, Optional, Tuple
+
+from core.config import settings
+from core.metrics import REGISTRY
+
+METERS_PER_DEG_LAT = 110540.0
+METERS_PER_DEG_LON = 111320.0  # At the equator; scaled by cos(latitude)
+GATE = 9.21                    # Chi-square, 2 dof, 99%
+MAX_REJECTS = 3                # Consecutive gated fixes before the track jumps to them
+RESET_SECONDS = 60.0           # Gap after which the old velocity means nothing
+INITIAL_SPEED_STD = 10.0       # m/s, velocity uncertainty of a new track
+MIN_HEADING_SPEED = 0.5        # m/s; slower than this the heading is noise
+
+REJECTED_FIXES = REGISTRY.counter("gps_fixes_rejected_total", "GPS fixes ignored by the smoothing gate")
+
+Fix = Tuple[float, float, float, Optional[float]]  # lat, lon, speed m/s, heading degrees
+
+
+class _Track:
+    __slots__ = ("lat0", "lon0", "kx", "x", "y", "vx", "vy", "p00", "p01", "p11", "t", "fixes", "rejects")
+
+    def __init__(self, lat: float, lon: float, t: float, noise_var: float):
+        self.lat0, self.lon0 = lat, lon
+        self.kx = METERS_PER_DEG_LON * math.cos(math.radians(lat))
+        self.x = self.y = self.vx = self.vy = 0.0
+        self.p00, self.p01, self.p11 = noise_var, 0.0, INITIAL_SPEED_STD ** 2
+        self.t = t
+        self.fixes = 1
+        self.rejects = 0
+
+    def to_plane(self, lat: float, lon: float) -> Tuple[float, float]:
+        return (lon - self.lon0) * self.kx, (lat - self.lat0) * METERS_PER_DEG_LAT
+
+    def fix(self) -> Fix:
+        speed = math.hypot(self.vx, self.vy)
+        heading = math.degrees(math.atan2(self.vx, self.vy)) % 360 if speed >= MIN_HEADING_SPEED else None
+        return (self.lat0 + self.y / METERS_PER_DEG_LAT, self.lon0 + self.x / self.kx, speed, heading)
+
+
+class GPSTracker:
+    """
+    Args:
+        noise_m: GPS position error (1 std, metres)
+        accel: Process noise, bus acceleration (1 std, m/s^2)
+    """
+
+    def __init__(self, noise_m: float = 10.0, accel: float = 1.5):
+        self.noise_var = noise_m ** 2
+        self.accel_var = accel ** 2
+        self.tracks: Dict[str, _Track] = {}
+        self._lock = threading.Lock()
+
+    def update(self, bus_mac: str, lat: float, lon: float, t: float) -> Fix:
+        """Fold one fix (t = unix seconds) into the bus's track; returns the smoothed fix."""
+        with self._lock:
+            track = self.tracks.get(bus_mac)
+            dt = t - track.t if track is not None else 0.0
+            if track is None or dt > RESET_SECONDS:
+                track = self.tracks[bus_mac] = _Track(lat, lon, t, self.noise_var)
+                return track.fix()
+
+            # Predict (fixes stamped out of order inside a batch get dt = 0)
+            if dt > 0:
+                q = self.accel_var
+                p00, p01, p11 = track.p00, track.p01, track.p11
+                track.p00 = p00 + 2 * dt * p01 + dt * dt * p11 + q * dt ** 4 / 4
+                track.p01 = p01 + dt * p11 + q * dt ** 3 / 2
+                track.p11 = p11 + q * dt * dt
+                track.x += track.vx * dt
+                track.y += track.vy * dt
+                track.t = t
+
+            # Gate, then update
+            zx, zy = track.to_plane(lat, lon)
+            rx, ry = zx - track.x, zy - track.y
+            s = track.p00 + self.noise_var
+            if (rx * rx + ry * ry) / s > GATE:
+                track.rejects += 1
+                if track.rejects < MAX_REJECTS:
+                    REJECTED_FIXES.inc()
+                    return track.fix()
+                # The bus really is somewhere else (tunnel exit, GPS restart)
+                track = self.tracks[bus_mac] = _Track(lat, lon, t, self.noise_var)
+                return track.fix()
+
+            k0, k1 = track.p00 / s, track.p01 / s
+            track.x += k0 * rx
+            track.y += k0 * ry
+            track.vx += k1 * rx
+            track.vy += k1 * ry
+            track.p11 -= k1 * track.p01
+            track.p01 *= 1 - k0
+            track.p00 *= 1 - k0
+            track.fixes += 1
+            track.rejects = 0
+            return track.fix()
+
+    def state(self, bus_mac: str) -> Optional[dict]:
+        with self._lock:
+            track = self.tracks.get(bus_mac)
+            if track is None:
+                return None
+            lat, lon, speed, heading = track.fix()
+            return {
+                "bus_mac": bus_mac,
+                "lat": round(lat, 7),
+                "lon": round(lon, 7),
+                "speed_mps": round(speed, 2),
+                "heading_deg": round(heading, 1) if heading is not None else None,
+                "position_std_m": round(math.sqrt(track.p00), 1),
+                "fixes": track.fixes,
+                "last_fix": track.t,
+            }
+
+
+# Shared tracker (fed from the MQTT thread)
+tracker = GPSTracker(noise_m=settings.GPS_NOISE_M, accel=settings.GPS_ACCEL_NOISE)
@@ -0,0 +1,417 @@
+"""
+PM Zone Statistics Module
+Streaming per-zone PM aggregates for the pm_zones collection.
+
+Readings are matched against the zones in memory (bounding box first,
+then polygon or radius) and folded into per-zone aggregates: count,
+EWMA of PM2.5/PM10, min/max and a t-digest of PM2.5 for percentiles.
+Nothing touches MongoDB or the disk per reading; every
+ZONE_STATS_FLUSH_SECONDS the zones that changed are written with one
+bulk update and the buffered readings are appended to the zone history.
+
+Zone history is columnar when pyarrow is installed: one Arrow IPC stream
+per zone and writer session (data/pm_zones/pm_zone_<id>_<start>.arrows),
+kept open and appended one record batch per flush. Without pyarrow it
+falls back to the original data/pm_zone_<id>.csv files, written a batch
+at a time instead of open/append/close per reading.
+"""
+
+import asyncio
+import csv
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from app import crud
+from core.config import settings
+from core.metrics import REGISTRY
+
+try:
+    import pyarrow as pa
+except ImportError:  # Optional: CSV zone history without it
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+EWMA_ALPHA = 0.1                # Same weight as the per-message update this replaces
+DIGEST_COMPRESSION = 100
+RELOAD_ZONES_SECONDS = 60.0     # Pick up zones added or edited in MongoDB
+MAX_BUFFERED_ROWS = 100000      # History rows held between flushes before new ones are dropped
+HISTORY_FIELDS = ["timestamp", "bus_mac", "pm2_5", "pm10", "temp", "hum"]
+EARTH_RADIUS_M = 6371000
+
+ZONE_READINGS = REGISTRY.counter("pm_zone_readings_total", "Readings folded into PM zone statistics")
+ZONE_HISTORY_DROPPED = REGISTRY.counter("pm_zone_history_dropped_total", "Zone history rows dropped (buffer full)")
+ZONE_FLUSH_SECONDS = REGISTRY.histogram("pm_zone_flush_seconds", "Time to flush PM zone statistics and history")
+
+
+# Helper for Point in Polygon (Ray Casting)
+def is_point_in_polygon(lat: float, lon: float, polygon: list):
+    num_vertices = len(polygon)
+    x, y = lon, lat
+    inside = False
+
+    # Polygon is list of [lat, lon]
+    p1 = polygon[0]
+    p1x, p1y = p1[1], p1[0]
+
+    for i in range(num_vertices + 1):
+        p2 = polygon[i % num_vertices]
+        p2x, p2y = p2[1], p2[0]
+
+        if y > min(p1y, p2y):
+            if y <= max(p1y, p2y):
+                if x <= max(p1x, p2x):
+                    if p1y != p2y:
+                        xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+                    if p1x == p2x or x <= xinters:
+                        inside = not inside
+        p1x, p1y = p2x, p2y
+
+    return inside
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+class TDigest:
+    """
+    Merging t-digest (Dunning): centroids near the median may hold many
+    values, centroids in the tails few, so p90/p99 stay accurate in
+    O(compression) memory however many readings arrive. Values are
+    buffered and merged in sorted batches.
+    """
+
+    def __init__(self, compression: int = DIGEST_COMPRESSION, centroids: Optional[List[List[float]]] = None):
+        self.compression = compression
+        self.centroids: List[List[float]] = [list(c) for c in centroids or []]
+        self.buffer: List[Tuple[float, float]] = []
+        self.total = sum(c[1] for c in self.centroids)
+
+    def add(self, value: float, weight: float = 1.0):
+        self.buffer.append((value, weight))
+        self.total += weight
+        if len(self.buffer) >= self.compression * 5:
+            self.compress()
+
+    def compress(self):
+        if not self.buffer:
+            return
+        items = sorted([tuple(c) for c in self.centroids] + self.buffer)
+        self.buffer = []
+        merged: List[List[float]] = []
+        total = self.total
+        cumulative = 0.0
+        mean, weight = items[0]
+        for m, w in items[1:]:
+            q = (cumulative + (weight + w) / 2) / total
+            if weight + w <= max(1.0, 4 * total * q * (1 - q) / self.compression):
+                mean += (m - mean) * w / (weight + w)
+                weight += w
+            else:
+                merged.append([mean, weight])
+                cumulative += weight
+                mean, weight = m, w
+        merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q: float) -> Optional[float]:
+        self.compress()
+        centroids = self.centroids
+        if not centroids:
+            return None
+        if len(centroids) == 1:
+            return centroids[0][0]
+        target = q * self.total
+        cumulative = 0.0
+        prev_center = prev_mean = None
+        for mean, weight in centroids:
+            center = cumulative + weight / 2
+            if target <= center:
+                if prev_center is None:
+                    return mean
+                return prev_mean + (mean - prev_mean) * (target - prev_center) / (center - prev_center)
+            prev_center, prev_mean = center, mean
+            cumulative += weight
+        return centroids[-1][0]
+
+    def to_list(self) -> List[List[float]]:
+        self.compress()
+        return [[round(m, 3), w] for m, w in self.centroids]
+
+
+class Zone:
+    """Zone geometry from a pm_zones document (polygon, or centre + radius)."""
+
+    __slots__ = ("id", "name", "polygon", "lat", "lon", "radius", "bbox")
+
+    def __init__(self, doc: dict):
+        self.id = doc["_id"]
+        self.name = doc.get("name")
+        points = doc.get("points") or []
+        self.polygon = points if len(points) >= 3 else None
+        self.lat = doc.get("lat")
+        self.lon = doc.get("lon")
+        self.radius = doc.get("radius", 50.0)
+        if self.polygon:
+            lats = [p[0] for p in points]
+            lons = [p[1] for p in points]
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+        elif self.lat is not None and self.lon is not None:
+            dlat = math.degrees(self.radius / EARTH_RADIUS_M)
+            dlon = dlat / max(0.01, math.cos(math.radians(self.lat)))
+            self.bbox = (self.lat - dlat, self.lon - dlon, self.lat + dlat, self.lon + dlon)
+        else:
+            self.bbox = None
+
+    def contains(self, lat: float, lon: float) -> bool:
+        if self.bbox is None:
+            return False
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        if self.polygon:
+            return is_point_in_polygon(lat, lon, self.polygon)
+        return haversine_m(lat, lon, self.lat, self.lon) <= self.radius
+
+
+class ZoneStats:
+    __slots__ = ("count", "avg_pm25", "avg_pm10", "min_pm25", "max_pm25", "digest", "last_updated")
+
+    def __init__(self, doc: dict):
+        stats = doc.get("stats") or {}
+        self.count = stats.get("count", 0)
+        self.avg_pm25 = doc.get("avg_pm25") or 0.0
+        self.avg_pm10 = doc.get("avg_pm10") or 0.0
+        self.min_pm25 = stats.get("min_pm25")
+        self.max_pm25 = stats.get("max_pm25")
+        self.digest = TDigest(centroids=stats.get("digest"))
+        self.last_updated = doc.get("last_updated")
+
+    def add(self, pm2_5: float, pm10: float, timestamp: datetime):
+        if self.count == 0 or self.avg_pm25 == 0:
+            self.avg_pm25, self.avg_pm10 = pm2_5, pm10
+        else:
+            self.avg_pm25 += EWMA_ALPHA * (pm2_5 - self.avg_pm25)
+            self.avg_pm10 += EWMA_ALPHA * (pm10 - self.avg_pm10)
+        self.min_pm25 = pm2_5 if self.min_pm25 is None else min(self.min_pm25, pm2_5)
+        self.max_pm25 = pm2_5 if self.max_pm25 is None else max(self.max_pm25, pm2_5)
+        self.digest.add(pm2_5)
+        self.count += 1
+        self.last_updated = timestamp
+
+    def percentiles(self) -> dict:
+        return {f"p{int(q * 100)}_pm25": _round(self.digest.quantile(q)) for q in (0.5, 0.9, 0.99)}
+
+    def to_update(self) -> dict:
+        """Fields $set on the pm_zones document."""
+        return {
+            "avg_pm25": round(self.avg_pm25, 2),
+            "avg_pm10": round(self.avg_pm10, 2),
+            "last_updated": self.last_updated,
+            "stats": {
+                "count": self.count,
+                "min_pm25": self.min_pm25,
+                "max_pm25": self.max_pm25,
+                **self.percentiles(),
+                "digest": self.digest.to_list(),
+            },
+        }
+
+
+def _round(value: Optional[float], digits: int = 1) -> Optional[float]:
+    return None if value is None else round(value, digits)
+
+
+class HistoryWriter:
+    """Appends buffered zone readings to per-zone files (Arrow IPC streams, or CSV without pyarrow)."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.session = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        self.streams: Dict[str, tuple] = {}  # zone id -> (file, RecordBatchStreamWriter)
+        self.schema = pa.schema([
+            ("timestamp", pa.timestamp("ms")),
+            ("bus_mac", pa.string()),
+            ("pm2_5", pa.float64()),
+            ("pm10", pa.float64()),
+            ("temp", pa.float64()),
+            ("hum", pa.float64()),
+        ]) if pa is not None else None
+
+    def write(self, rows_by_zone: Dict[str, List[tuple]]):
+        """Blocking; called from a worker thread."""
+        for zone_id, rows in rows_by_zone.items():
+            if rows:
+                (self._write_arrow if pa is not None else self._write_csv)(zone_id, rows)
+
+    def _write_arrow(self, zone_id: str, rows: List[tuple]):
+        stream = self.streams.get(zone_id)
+        if stream is None:
+            directory = os.path.join(self.directory, "pm_zones")
+            os.makedirs(directory, exist_ok=True)
+            sink = open(os.path.join(directory, f"pm_zone_{zone_id}_{self.session}.arrows"), "ab")
+            stream = self.streams[zone_id] = (sink, pa.ipc.new_stream(sink, self.schema))
+        columns = list(zip(*rows))
+        stream[1].write_batch(pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema,
+        ))
+        stream[0].flush()
+
+    def _write_csv(self, zone_id: str, rows: List[tuple]):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, f"pm_zone_{zone_id}.csv")
+        new_file = not os.path.exists(filename)
+        with open(filename, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(HISTORY_FIELDS)
+            writer.writerows((row[0].isoformat(),) + row[1:] for row in rows)
+
+    def close(self):
+        for sink, writer in self.streams.values():
+            try:
+                writer.close()
+            finally:
+                sink.close()
+        self.streams.clear()
+
+
+class ZoneStatsEngine:
+    """
+    record() runs on the MQTT thread and only touches memory; the flush
+    task on the event loop writes changed zones and history in batches.
+    """
+
+    def __init__(self, history_dir: str = "data", flush_seconds: float = 10.0):
+        self.flush_seconds = flush_seconds
+        self.zones: List[Zone] = []
+        self.stats: Dict[str, ZoneStats] = {}
+        self.ids: Dict[str, object] = {}  # str(_id) -> _id as stored
+        self.dirty: set = set()
+        self.history: Dict[str, List[tuple]] = {}
+        self.buffered_rows = 0
+        self.writer = HistoryWriter(history_dir)
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._loaded_at = 0.0
+
+    def load(self, docs: List[dict]):
+        """(Re)build zones from pm_zones documents, keeping in-memory stats of known zones."""
+        zones = [Zone(doc) for doc in docs]
+        with self._lock:
+            stats = {}
+            for doc, zone in zip(docs, zones):
+                key = str(zone.id)
+                stats[key] = self.stats.get(key) or ZoneStats(doc)
+            self.zones = [z for z in zones if z.bbox is not None]
+            self.stats = stats
+            self.ids = {str(z.id): z.id for z in zones}
+        self._loaded_at = time.monotonic()
+
+    def record(self, lat: float, lon: float, pm2_5: float, pm10: float, temp: float = 0.0,
+               hum: float = 0.0, bus_mac: Optional[str] = None, timestamp: Optional[datetime] = None) -> int:
+        """Fold a reading into every zone containing it; returns the number of zones hit."""
+        timestamp = timestamp or datetime.utcnow()
+        hits = 0
+        with self._lock:
+            for zone in self.zones:
+                if not zone.contains(lat, lon):
+                    continue
+                key = str(zone.id)
+                self.stats[key].add(pm2_5, pm10, timestamp)
+                self.dirty.add(key)
+                hits += 1
+                if self.buffered_rows < MAX_BUFFERED_ROWS:
+                    self.history.setdefault(key, []).append((timestamp, bus_mac, pm2_5, pm10, temp, hum))
+                    self.buffered_rows += 1
+                else:
+                    ZONE_HISTORY_DROPPED.inc()
+        if hits:
+            ZONE_READINGS.inc(hits)
+        return hits
+
+    async def flush(self):
+        with self._lock:
+            dirty, self.dirty = self.dirty, set()
+            history, self.history = self.history, {}
+            self.buffered_rows = 0
+            updates = {self.ids[key]: self.stats[key].to_update() for key in dirty if key in self.stats}
+        if not updates and not history:
+            return
+
+        started = time.perf_counter()
+        try:
+            if updates:
+                await crud.update_pm_zone_stats(updates)
+        except Exception as e:
+            logger.error("Error flushing PM zone stats: %s", e)
+            with self._lock:
+                self.dirty |= dirty  # Retry with the next flush
+        try:
+            if history:
+                await asyncio.to_thread(self.writer.write, history)
+        except Exception as e:
+            logger.error("Error writing PM zone history: %s", e)
+        ZONE_FLUSH_SECONDS.observe(time.perf_counter() - started)
+
+    async def reload(self):
+        try:
+            self.load(await crud.get_pm_zones())
+        except Exception as e:
+            logger.error("Error loading PM zones: %s", e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            if time.monotonic() - self._loaded_at >= RELOAD_ZONES_SECONDS:
+                await self.reload()
+            await self.flush()
+
+    async def start(self):
+        await self.reload()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await asyncio.to_thread(self.writer.close)
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            result = []
+            for zone in self.zones:
+                stats = self.stats[str(zone.id)]
+                result.append({
+                    "zone_id": str(zone.id),
+                    "name": zone.name,
+                    "count": stats.count,
+                    "avg_pm25": _round(stats.avg_pm25, 2),
+                    "avg_pm10": _round(stats.avg_pm10, 2),
+                    "min_pm25": stats.min_pm25,
+                    "max_pm25": stats.max_pm25,
+                    **stats.percentiles(),
+                    "last_updated": stats.last_updated,
+                })
+        return result
+
+
+# Shared engine (fed from the MQTT thread, flushed on the main loop)
+zone_stats = ZoneStatsEngine(history_dir=settings.ZONE_HISTORY_DIR, flush_seconds=settings.ZONE_STATS_FLUSH_SECONDS)
@@ -1,8 +1,9 @@
-import motor.motor_asyncio
 import asyncio
 
+from core.mongo import get_client
+
 async def clear_history():
-    client = motor.motor_asyncio.AsyncIOMotorClient("mongodb://localhost:27017")
+    client = get_client("mongodb://localhost:27017")
     db = client["sut_smart_bus"]
     result = await db["hardware_locations"].delete_many({})
     print(f"Cleared {result.deleted_count} documents from hardware_locations.")
@@ -1,53 +1,176 @@
 """
 API Key Authentication Middleware
 
-If API_SECRET_KEY is set in .env, all requests (except health check) 
-must include the X-API-Key header.
+If API_SECRET_KEY or API_KEYS is set in .env, all requests (except public
+paths such as the health check) must include the X-API-Key header (or the
+api_key query parameter, for OTA/legacy devices).
+
+API_KEYS holds additional named keys with scopes:
+
+    API_KEYS=dashboard:k3y1:read,ops:k3y2:read+write+admin
+
+- read:  GET/HEAD/OPTIONS requests
+- write: any other method
+- admin: /api/admin/*
+API_SECRET_KEY, if set, is a key named "default" with all scopes.
+
+Implemented as pure ASGI middleware (no BaseHTTPMiddleware task/stream
+wrapping, so streaming responses pass straight through), with the public
+path check precompiled into a set plus one regex and keys compared with
+hmac.compare_digest. The authenticated key name is stored in
+scope["state"]["api_key"] for downstream use.
 """
 
-from fastapi import Request, HTTPException
-from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+import hmac
+import json
+import re
+from typing import Dict, FrozenSet, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
 from core.config import settings
+from core.metrics import REGISTRY
 
 # Paths that don't require authentication
 PUBLIC_PATHS = [
     "/",
     "/health",
+    "/health/ready",
     "/docs",
     "/openapi.json",
     "/redoc",
     "/api/debug/location",
 ]
 
-class APIKeyMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        # Skip auth if no API key is configured
-        if not settings.API_SECRET_KEY:
-            return await call_next(request)
-        
-        # Allow public paths without auth
-        path = request.url.path
-        if path in PUBLIC_PATHS or path.startswith("/api/debug/location/"):
-            return await call_next(request)
-        
-        # Check for API key in header
-        api_key = request.headers.get("X-API-Key")
-        
+# Path prefixes that don't require authentication
+PUBLIC_PREFIXES = [
+    "/api/debug/location/",
+]
+
+ALL_SCOPES = frozenset({"read", "write", "admin"})
+READ_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+ADMIN_PREFIX = "/api/admin/"
+
+API_KEY_REQUESTS = REGISTRY.counter("api_key_requests_total", "Authenticated requests per API key", ["key"])
+API_KEY_REJECTIONS = REGISTRY.counter("api_key_rejections_total", "Requests rejected by API key auth", ["reason"])
+
+
+class APIKey:
+    __slots__ = ("name", "secret", "scopes")
+
+    def __init__(self, name: str, secret: str, scopes: FrozenSet[str]):
+        self.name = name
+        self.secret = secret.encode()
+        self.scopes = scopes
+
+
+def parse_api_keys(spec: str) -> List[APIKey]:
+    """"name:key:read+write,..." -> [APIKey]; scopes default to read."""
+    keys = []
+    for item in (spec or "").split(","):
+        parts = item.strip().split(":")
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            continue
+        scopes = frozenset(s.strip() for s in parts[2].split("+")) & ALL_SCOPES if len(parts) > 2 else frozenset({"read"})
+        keys.append(APIKey(parts[0].strip(), parts[1].strip(), scopes))
+    return keys
+
+
+def load_api_keys() -> List[APIKey]:
+    keys = []
+    if settings.API_SECRET_KEY:
+        keys.append(APIKey("default", settings.API_SECRET_KEY, ALL_SCOPES))
+    keys.extend(parse_api_keys(settings.API_KEYS))
+    return keys
+
+
+def compile_public_matcher(paths: List[str], prefixes: List[str]):
+    """Return is_public(path): exact paths via a set, prefixes via one compiled regex."""
+    exact = frozenset(paths)
+    prefix_re = re.compile("|".join(re.escape(p) for p in prefixes)) if prefixes else None
+
+    def is_public(path: str) -> bool:
+        return path in exact or (prefix_re is not None and prefix_re.match(path) is not None)
+    return is_public
+
+
+def required_scope(method: str, path: str) -> str:
+    if path.startswith(ADMIN_PREFIX):
+        return "admin"
+    return "read" if method in READ_METHODS else "write"
+
+
+def _json_body(detail: str) -> bytes:
+    return json.dumps({"detail": detail}).encode()
+
+
+class APIKeyMiddleware:
+    def __init__(self, app, keys: Optional[List[APIKey]] = None):
+        self.app = app
+        self.keys = load_api_keys() if keys is None else keys
+        self.is_public = compile_public_matcher(PUBLIC_PATHS, PUBLIC_PREFIXES)
+
+    def authenticate(self, provided: str) -> Optional[APIKey]:
+        # Compare against every key so timing doesn't reveal which one matched
+        provided_bytes = provided.encode()
+        match = None
+        for key in self.keys:
+            if hmac.compare_digest(provided_bytes, key.secret):
+                match = key
+        return match
+
+    @staticmethod
+    def _extract_key(scope) -> Optional[str]:
+        for name, value in scope["headers"]:
+            if name == b"x-api-key":
+                return value.decode("latin-1")
         # Fallback: Check query param (useful for OTA/legacy devices)
+        query = scope.get("query_string", b"")
+        if b"api_key=" in query:
+            for name, value in parse_qsl(query.decode("latin-1")):
+                if name == "api_key":
+                    return value
+        return None
+
+    async def _reject(self, send, status: int, detail: str, reason: str):
+        API_KEY_REJECTIONS.inc(labels=(reason,))
+        body = _json_body(detail)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        # Skip auth if no API key is configured, and for non-HTTP scopes
+        if scope["type"] != "http" or not self.keys or self.is_public(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        api_key = self._extract_key(scope)
         if not api_key:
-            api_key = request.query_params.get("api_key")
-        
-        if not api_key:
-            return JSONResponse(
-                status_code=401,
-                content={"detail": "Missing API key. Include X-API-Key header."}
-            )
-        
-        if api_key != settings.API_SECRET_KEY:
-            return JSONResponse(
-                status_code=403,
-                content={"detail": "Invalid API key"}
-            )
-        
-        return await call_next(request)
+            await self._reject(send, 401, "Missing API key. Include X-API-Key header.", "missing")
+            return
+
+        key = self.authenticate(api_key)
+        if key is None:
+            await self._reject(send, 403, "Invalid API key", "invalid")
+            return
+
+        scope_needed = required_scope(scope["method"], scope["path"])
+        if scope_needed not in key.scopes:
+            await self._reject(send, 403, f"API key lacks '{scope_needed}' scope", "scope")
+            return
+
+        API_KEY_REQUESTS.inc(labels=(key.name,))
+        scope.setdefault("state", {})["api_key"] = key.name
+        await self.app(scope, receive, send)
+
+
+def key_summary(keys: List[APIKey]) -> List[Dict[str, object]]:
+    """Key names and scopes (never the secrets) with request counts."""
+    counts: Dict[Tuple, float] = API_KEY_REQUESTS.collect()
+    return [
+        {"name": k.name, "scopes": sorted(k.scopes), "requests": int(counts.get((k.name,), 0))}
+        for k in keys
+    ]
@@ -5,6 +5,15 @@ from typing import Optional
 class Settings(BaseSettings):
     MONGODB_URL: MongoDsn = "mongodb://localhost:27017/sut_smart_bus"
     
+    # MongoDB client pool and timeouts (see core/mongo.py; 0 = no limit)
+    MONGO_MAX_POOL_SIZE: int = 20
+    MONGO_MIN_POOL_SIZE: int = 0
+    MONGO_MAX_IDLE_MS: int = 60000               # Close pooled connections idle this long
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 5000
+    MONGO_CONNECT_TIMEOUT_MS: int = 5000
+    MONGO_SOCKET_TIMEOUT_MS: int = 30000         # Per operation socket read/write
+    MONGO_WRITE_CONCERNS: str = ""               # Per collection, e.g. "hardware_locations=1,pm_zones=majority:j"
+    
     MQTT_BROKER_HOST: str = "localhost"
     MQTT_BROKER_PORT: int = 1883
     
@@ -17,15 +26,79 @@ class Settings(BaseSettings):
     # Security Settings
     # If set, all API requests must include X-API-Key header
     API_SECRET_KEY: Optional[str] = None
+    # Additional named keys with scopes: "name:key:read+write+admin,..." (see core/auth.py)
+    API_KEYS: str = ""
     
     # Maximum firmware file size (2MB default - ESP32 typically < 1.5MB)
     MAX_UPLOAD_SIZE: int = 2 * 1024 * 1024  # 2MB in bytes
     
+    # Host devices use to download firmware (auto-detected if unset)
+    OTA_SERVER_HOST: Optional[str] = None
+    
+    # Maximum simultaneous firmware downloads (0 = unlimited)
+    OTA_MAX_CONCURRENT_DOWNLOADS: int = 20
+    
     # CORS allowed origins (comma-separated, or "*" for all)
     CORS_ORIGINS: str = "*"
     
-    # Rate limiting (requests per minute)
+    # Seconds without any MQTT message before a device is reported offline
+    DEVICE_STALE_SECONDS: int = 60
+    DEVICE_FORGET_SECONDS: int = 86400   # Offline devices are dropped from the registry after this
+    DEVICE_MAX_TRACKED: int = 10000      # Beyond this, the longest-offline devices are dropped early
+    
+    # PM anomaly detection on ingest (see app/anomaly.py)
+    ANOMALY_MODE: str = "flag"        # "off", "flag" (stored with an anomaly field) or "quarantine" (separate collection)
+    ANOMALY_ALPHA: float = 0.1        # EWMA weight of each new reading
+    ANOMALY_THRESHOLD: float = 4.0    # Outlier distance in standard deviations
+    ANOMALY_MIN_DELTA: float = 25.0   # ...and at least this far from the mean (ug/m3)
+    
+    # Spill buffer for readings while MongoDB is down (see app/spill.py)
+    SPILL_PATH: str = "data/ingest_spill.db"
+    SPILL_MAX_MB: int = 256                  # Readings beyond this are dropped (and counted)
+    SPILL_WRITE_TIMEOUT_SECONDS: float = 2.0 # Slower direct inserts switch ingest to the buffer
+    SPILL_REPLAY_BATCH: int = 1000           # Readings per insert_many when replaying
+    
+    # MQTT -> event loop hand-off (see core/executor.py)
+    INGEST_MAX_IN_FLIGHT: int = 200          # Database jobs running at once
+    INGEST_MAX_QUEUE: int = 5000             # Jobs waiting beyond that
+    INGEST_OVERFLOW: str = "drop_oldest"     # "drop_oldest", "coalesce" (latest bus update wins) or "block"
+    
+    # Duplicate / out-of-order GPS fixes (see app/ordering.py)
+    DEDUPE_WINDOW_SIZE: int = 4096        # Recent payload hashes remembered per process
+    DEDUPE_WINDOW_SECONDS: float = 60.0   # A repeated payload within this time is dropped
+    
+    # GPS smoothing (see app/tracking.py)
+    GPS_SMOOTHING: bool = True    # Kalman-filtered live positions; fast fixes are not stored in history
+    GPS_NOISE_M: float = 10.0     # GPS position error (1 std, metres)
+    GPS_ACCEL_NOISE: float = 1.5  # Bus acceleration allowed by the filter (1 std, m/s^2)
+    
+    # PM zone statistics (see app/zones.py)
+    ZONE_STATS_FLUSH_SECONDS: float = 10.0  # Batch interval for pm_zones updates and zone history
+    ZONE_HISTORY_DIR: str = "data"          # Zone history files (Arrow IPC with pyarrow, else CSV)
+    
+    # Logging
+    LOG_LEVEL: str = "INFO"
+    LOG_LEVELS: str = ""          # Per-module overrides, e.g. "app.mqtt=DEBUG,app.crud=WARNING"
+    LOG_FORMAT: str = "text"      # "text" or "json"
+    LOG_SAMPLE_EVERY: int = 100   # Emit 1 in N high-rate (per-message) log records
+    LOG_QUEUE_SIZE: int = 10000   # Records buffered before new ones are dropped
+    
+    # Profiling (fractions 0.0 - 1.0 of requests/messages traced; adjustable at runtime)
+    PROFILE_HTTP_SAMPLE_RATE: float = 0.0
+    PROFILE_MQTT_SAMPLE_RATE: float = 0.0
+    PROFILE_DIR: str = "profiles"  # Stack sampler output (.folded)
+    
+    # Heatmap tiles (/api/heatmap/tiles/{z}/{x}/{y})
+    HEATMAP_TILE_CACHE_SIZE: int = 2048  # Rendered tiles kept in memory (LRU)
+    INTERPOLATION_CACHE_SIZE: int = 64   # Interpolated surfaces kept in memory (mode=interpolated)
+    ANALYTICS_CACHE_SECONDS: int = 60    # /api/analytics/summary reuse period (0 = no cache)
+    
+    # Rate limiting (tokens per minute per API key + client IP; 0 = disabled)
+    # Heavy endpoints cost more than 1 token, see core/ratelimit.py
     RATE_LIMIT_PER_MINUTE: int = 60
+    RATE_LIMIT_BURST: int = 0              # Bucket size (0 = same as RATE_LIMIT_PER_MINUTE)
+    RATE_LIMIT_BACKEND: str = "memory"     # "memory" (per worker) or "mongo" (shared between workers)
+    RATE_LIMIT_TRUST_PROXY: bool = False   # Use X-Forwarded-For for the client IP (behind a reverse proxy)
 
     class Config:
         env_file = ".env"
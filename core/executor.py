@@ -0,0 +1,170 @@
+"""
+Ingest Executor Module
+Bounded hand-off of coroutines from the MQTT thread to the event loop.
+
+`asyncio.run_coroutine_threadsafe` per message has no limit: when MongoDB
+slows down, scheduled coroutines pile up until the container runs out of
+memory. The executor runs at most `max_in_flight` jobs at once and holds
+up to `max_queue` more; a job is a zero-argument callable returning a
+coroutine, so nothing is created for a job that never runs. When the
+queue is full the overflow policy decides:
+
+    drop_oldest  the oldest queued job is discarded
+    coalesce     a queued job with the same key (e.g. the live position
+                 of one bus) is replaced in place by the new one; when
+                 the queue is still full the oldest job is discarded
+    block        the submitting thread waits for room (backpressure to
+                 the broker connection); never on the loop thread itself
+
+Job failures are logged (sampled) and counted per job name instead of
+vanishing in an unread future. Jobs keep the contextvars of the thread
+that submitted them (profiling traces).
+"""
+
+import asyncio
+import contextvars
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, Optional
+
+from core.logger import SampledLogger
+from core.metrics import REGISTRY
+
+POLICIES = ("drop_oldest", "coalesce", "block")
+
+JOBS_REJECTED = REGISTRY.counter("ingest_jobs_rejected_total", "Ingest jobs discarded by the overflow policy", ["reason"])
+JOB_ERRORS = REGISTRY.counter("ingest_job_errors_total", "Ingest jobs that raised", ["job"])
+
+error_logger = SampledLogger(__name__)  # Failing jobs during an outage: 1 in LOG_SAMPLE_EVERY
+
+Job = Callable[[], Awaitable]
+
+
+class IngestExecutor:
+    """
+    Args:
+        max_in_flight: Jobs running on the loop at once
+        max_queue: Jobs waiting beyond that
+        policy: One of POLICIES, applied when the queue is full
+    """
+
+    def __init__(self, max_in_flight: int = 200, max_queue: int = 5000, policy: str = "drop_oldest"):
+        if policy not in POLICIES:
+            raise ValueError(f"Invalid overflow policy {policy!r}. Must be one of: {list(POLICIES)}")
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(1, max_queue)
+        self.policy = policy
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.in_flight = 0
+        self.queue: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (job, name, context)
+        self.rejected = {"dropped": 0, "coalesced": 0, "no_loop": 0}
+        self.errors = 0
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+
+    def set_loop(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def submit(self, job: Job, key: Optional[Hashable] = None, name: Optional[str] = None) -> bool:
+        """
+        Run `job()` on the loop; thread-safe. `key` marks jobs that supersede
+        each other under the coalesce policy. Returns False if the job was
+        discarded straight away (no loop).
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            self._reject("no_loop")
+            return False
+        entry = (job, name or getattr(job, "__name__", "job"), contextvars.copy_context())
+
+        with self._cond:
+            if self.in_flight < self.max_in_flight and not self.queue:
+                self.in_flight += 1
+                loop.call_soon_threadsafe(self._start, entry)
+                return True
+
+            if self.policy == "coalesce" and key is not None:
+                queue_key = ("key", key)
+                if queue_key in self.queue:
+                    self.queue[queue_key] = entry  # Keeps its place in line
+                    self._reject("coalesced")
+                    return True
+            else:
+                queue_key = ("job", next(self._ids))
+
+            if len(self.queue) >= self.max_queue and self.policy == "block" and not self._on_loop_thread(loop):
+                while len(self.queue) >= self.max_queue:
+                    self._cond.wait()
+            while len(self.queue) >= self.max_queue:
+                self.queue.popitem(last=False)
+                self._reject("dropped")
+            self.queue[queue_key] = entry
+        return True
+
+    def _reject(self, reason: str):
+        self.rejected[reason] += 1
+        JOBS_REJECTED.inc(labels=(reason,))
+
+    @staticmethod
+    def _on_loop_thread(loop: asyncio.AbstractEventLoop) -> bool:
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+
+    def _start(self, entry: tuple):
+        job, name, context = entry
+        try:
+            coro = context.run(job)
+        except Exception as e:
+            self._failed(name, e)
+            self._finished()
+            return
+        self.loop.create_task(self._run(coro, name), context=context)
+
+    async def _run(self, coro: Awaitable, name: str):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._failed(name, e)
+        finally:
+            self._finished()
+
+    def _failed(self, name: str, error: Exception):
+        self.errors += 1
+        JOB_ERRORS.inc(labels=(name,))
+        error_logger.warning("Ingest job %s failed: %s: %s", name, type(error).__name__, error)
+
+    def _finished(self):
+        """A job ended: start the next queued one in its slot, or free the slot."""
+        with self._cond:
+            if self.queue:
+                _, entry = self.queue.popitem(last=False)
+                self.loop.call_soon(self._start, entry)
+            else:
+                self.in_flight -= 1
+            self._cond.notify_all()
+
+    async def drain(self, timeout: float = 5.0):
+        """Wait (up to `timeout` seconds) for running and queued jobs to finish."""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while (self.in_flight or self.queue) and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self.queue),
+            "rejected": dict(self.rejected),
+            "errors": self.errors,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "policy": self.policy,
+        }
+
+    def register_metrics(self, prefix: str = "ingest"):
+        REGISTRY.gauge(f"{prefix}_jobs_in_flight", "Ingest jobs running on the event loop", lambda: self.in_flight)
+        REGISTRY.gauge(f"{prefix}_jobs_queued", "Ingest jobs waiting for a slot", lambda: len(self.queue))
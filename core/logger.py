@@ -0,0 +1,193 @@
+"""
+Logging Module
+Non-blocking logging for the ingest hot path.
+
+Records are put on a bounded queue by a QueueHandler (never blocks the MQTT
+thread or the event loop; when the queue is full the record is dropped and
+counted) and a background writer thread drains the queue in batches,
+formats them as text or JSON and writes each batch with a single flush.
+
+Per-message logging goes through a SampledLogger, which lets 1 in
+LOG_SAMPLE_EVERY calls through before a LogRecord is even built. Levels are
+configured per module with LOG_LEVEL and LOG_LEVELS
+(e.g. "app.mqtt=DEBUG,app.crud=WARNING").
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional, TextIO
+
+from core.metrics import REGISTRY
+
+LOG_RECORDS_DROPPED = REGISTRY.counter("log_records_dropped_total", "Log records dropped because the queue was full")
+LOG_RECORDS_SAMPLED_OUT = REGISTRY.counter("log_records_sampled_out_total", "High-rate log records skipped by sampling")
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, message plus any `extra` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class SampledLogger:
+    """
+    Wrapper for per-message log lines: only 1 in `every` calls reaches the
+    underlying logger, and skipped calls cost a counter increment (no
+    LogRecord, no caller lookup). `every` defaults to LOG_SAMPLE_EVERY as
+    configured by setup_logging().
+    """
+
+    def __init__(self, name: str, every: Optional[int] = None):
+        self.logger = logging.getLogger(name)
+        self.every = every
+        self._count = 0
+
+    def _log(self, level: int, msg: str, args: tuple):
+        if not self.logger.isEnabledFor(level):
+            return
+        every = self.every or _state["sample_every"]
+        self._count += 1
+        if every > 1 and self._count % every != 1:
+            LOG_RECORDS_SAMPLED_OUT.inc()
+            return
+        self.logger._log(level, msg, args, extra={"sample_rate": every} if every > 1 else None, stacklevel=3)
+
+    def debug(self, msg: str, *args):
+        self._log(logging.DEBUG, msg, args)
+
+    def info(self, msg: str, *args):
+        self._log(logging.INFO, msg, args)
+
+    def warning(self, msg: str, *args):
+        self._log(logging.WARNING, msg, args)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) instead of erroring when full."""
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave formatting to the writer thread; callers pass immutable args
+        return record
+
+
+class BackgroundWriter(threading.Thread):
+    """Drains the log queue in batches and writes each batch with one flush."""
+
+    BATCH_SIZE = 256
+
+    def __init__(self, log_queue: queue.Queue, formatter: logging.Formatter, stream: TextIO):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = log_queue
+        self.formatter = formatter
+        self.stream = stream
+        self._stop_token = object()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            batch = [record]
+            try:
+                while len(batch) < self.BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            lines = []
+            stop = False
+            for item in batch:
+                if item is self._stop_token:
+                    stop = True
+                    continue
+                try:
+                    lines.append(self.formatter.format(item))
+                except Exception as e:
+                    lines.append(f"<unformattable log record: {e}>")
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except Exception:
+                    pass
+            if stop:
+                return
+
+    def stop(self, timeout: float = 2.0):
+        self.queue.put(self._stop_token)
+        self.join(timeout)
+
+
+_state = {"writer": None, "handler": None, "sample_every": 1}
+
+
+def parse_module_levels(spec: str) -> Dict[str, str]:
+    """"app.mqtt=DEBUG,app.crud=WARNING" -> {"app.mqtt": "DEBUG", "app.crud": "WARNING"}"""
+    levels = {}
+    for item in (spec or "").split(","):
+        name, sep, level = item.partition("=")
+        if sep and name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level: str = "INFO", module_levels: str = "", fmt: str = "text",
+                  sample_every: int = 100, queue_size: int = 10000,
+                  stream: Optional[TextIO] = None) -> BackgroundWriter:
+    """Install the queue handler on the root logger (idempotent: reconfigures if called again)."""
+    shutdown_logging()
+
+    formatter = JSONFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    writer = BackgroundWriter(log_queue, formatter, stream or sys.stdout)
+    writer.start()
+
+    handler = DroppingQueueHandler(log_queue)
+    _state["sample_every"] = max(1, sample_every)
+
+    root = logging.getLogger()
+    root.handlers = [h for h in root.handlers if not isinstance(h, DroppingQueueHandler)]
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name, module_level in parse_module_levels(module_levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _state["writer"] = writer
+    _state["handler"] = handler
+    return writer
+
+
+def shutdown_logging():
+    """Flush pending records and stop the writer thread."""
+    handler, writer = _state["handler"], _state["writer"]
+    if handler is not None:
+        logging.getLogger().removeHandler(handler)
+    if writer is not None:
+        writer.stop()
+    _state["handler"] = _state["writer"] = None
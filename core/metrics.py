@@ -0,0 +1,318 @@
+"""
+Metrics Module
+Prometheus-style counters, gauges and histograms with a text /metrics export.
+
+Hot paths record into per-thread shards: each thread only ever writes to
+its own dict, so increments need no lock (the MQTT thread and the event
+loop never contend). A scrape sums the shards; a value that is mid-update
+is simply picked up by the next scrape.
+"""
+
+import asyncio
+import functools
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Default latency buckets in seconds (1ms .. 10s)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Sharded:
+    """Per-thread storage; shards are registered once per thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._register_lock = threading.Lock()
+
+    def shard(self) -> dict:
+        try:
+            return self._local.data
+        except AttributeError:
+            data = self._local.data = {}
+            with self._register_lock:
+                self._shards.append(data)
+            return data
+
+    def shards(self) -> List[dict]:
+        with self._register_lock:
+            return list(self._shards)
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def inc(self, amount: float = 1.0, labels: Tuple = ()):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0.0) + amount
+
+    def collect(self) -> Dict[Tuple, float]:
+        totals: Dict[Tuple, float] = {}
+        for shard in self.shards():
+            for labels, value in list(shard.items()):
+                totals[labels] = totals.get(labels, 0.0) + value
+        return totals
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: Tuple = ()):
+        shard = self.shard()
+        series = shard.get(labels)
+        if series is None:
+            # [bucket counts..., +Inf count, sum]
+            series = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, labels: Tuple = ()):
+        return _Timer(self, labels)
+
+    def collect(self) -> Dict[Tuple, list]:
+        totals: Dict[Tuple, list] = {}
+        for shard in self.shards():
+            for labels, series in list(shard.items()):
+                total = totals.get(labels)
+                if total is None:
+                    totals[labels] = list(series)
+                else:
+                    for i, v in enumerate(series):
+                        total[i] += v
+        return totals
+
+
+class Gauge:
+    """Value computed at scrape time from a callback (returns a number or {labels: value})."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, fn: Callable, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def collect(self) -> Dict[Tuple, float]:
+        value = self.fn()
+        if isinstance(value, dict):
+            return value
+        return {(): value}
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: Tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.metrics.get(name) or self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.get(name) or self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, fn: Callable, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, fn, labelnames))
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                samples = metric.collect()
+            except Exception as e:
+                lines.append(f"# error collecting {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, value in sorted(samples.items(), key=lambda item: item[0]):
+                if metric.kind == "histogram":
+                    lines.extend(_render_histogram(metric, labels, value))
+                else:
+                    lines.append(f"{metric.name}{_format_labels(metric.labelnames, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value is None:
+        return "NaN"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _render_histogram(metric: Histogram, labels: Tuple, series: list) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(metric.buckets, series):
+        cumulative += count
+        lines.append(f"{metric.name}_bucket{_format_labels(metric.labelnames, labels, ('le', repr(bound)))} {cumulative}")
+    cumulative += series[len(metric.buckets)]
+    lines.append(f"{metric.name}_bucket{_format_labels(metric.labelnames, labels, ('le', '+Inf'))} {cumulative}")
+    lines.append(f"{metric.name}_sum{_format_labels(metric.labelnames, labels)} {_format_value(series[-1])}")
+    lines.append(f"{metric.name}_count{_format_labels(metric.labelnames, labels)} {cumulative}")
+    return lines
+
+
+REGISTRY = Registry()
+
+# --- Shared instruments ---
+
+MQTT_MESSAGES = REGISTRY.counter("mqtt_messages_total", "MQTT messages received", ["topic"])
+MQTT_ERRORS = REGISTRY.counter("mqtt_message_errors_total", "MQTT messages rejected or failed", ["topic", "reason"])
+MQTT_PARSE_SECONDS = REGISTRY.histogram(
+    "mqtt_parse_seconds", "Time to decode and validate an MQTT payload", ["topic"],
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+)
+MONGO_OPERATION_SECONDS = REGISTRY.histogram("mongo_operation_seconds", "MongoDB operation latency", ["operation"])
+MONGO_OPERATION_ERRORS = REGISTRY.counter("mongo_operation_errors_total", "MongoDB operations that raised", ["operation"])
+ANALYTICS_PIPELINE_SECONDS = REGISTRY.histogram(
+    "analytics_pipeline_seconds", "Aggregation pipeline duration", ["pipeline"]
+)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram("http_request_seconds", "HTTP request latency", ["method", "route", "status"])
+EVENT_LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "event_loop_lag_seconds", "Scheduling delay of the asyncio event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+
+_loop_lag = {"last": 0.0}
+REGISTRY.gauge("event_loop_lag_last_seconds", "Most recent event loop lag sample", lambda: _loop_lag["last"])
+
+
+# Optional callback(stage, seconds) fed by `timed` (installed by core.profiling)
+_stage_hook: Optional[Callable[[str, float], None]] = None
+
+
+def set_stage_hook(hook: Optional[Callable[[str, float], None]]):
+    global _stage_hook
+    _stage_hook = hook
+
+
+def timed(histogram: Histogram, label: Optional[str] = None, errors: Optional[Counter] = None,
+          stage: Optional[str] = None):
+    """
+    Decorator timing an async function into `histogram` (label defaults to the
+    function name). With `stage`, the duration is also reported to the stage
+    hook as "<stage>.<label>".
+    """
+    def decorator(func):
+        labels = (label or func.__name__,)
+        stage_name = f"{stage}.{labels[0]}" if stage else None
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(labels=labels)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                histogram.observe(elapsed, labels)
+                if stage_name is not None and _stage_hook is not None:
+                    _stage_hook(stage_name, elapsed)
+        return wrapper
+    return decorator
+
+
+def track_mongo(func):
+    """Time a CRUD coroutine as mongo_operation_seconds{operation=<function name>}."""
+    return timed(MONGO_OPERATION_SECONDS, errors=MONGO_OPERATION_ERRORS, stage="mongo")(func)
+
+
+def track_pipeline(func):
+    """Time an analytics coroutine as analytics_pipeline_seconds{pipeline=<function name>}."""
+    return timed(ANALYTICS_PIPELINE_SECONDS, stage="pipeline")(func)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Measure how late the loop wakes up from a fixed sleep."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        _loop_lag["last"] = lag
+        EVENT_LOOP_LAG_SECONDS.observe(lag)
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording http_request_seconds per route.
+    The route label is the endpoint function name (bounded cardinality,
+    unlike raw paths with IDs in them).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            endpoint = scope.get("endpoint")
+            route = getattr(endpoint, "__name__", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                (scope.get("method", ""), route, str(status["code"]))
+            )
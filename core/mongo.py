@@ -0,0 +1,186 @@
+"""
+MongoDB Client Module
+One shared, lazily connecting Motor client per URL, with pool limits,
+timeouts and per-collection write concerns from settings.
+
+The server and the scripts all get their client from `get_client()`, so
+they share the same pool sizing (bounded for the 512M container), fail
+fast when MongoDB is down (server selection and connect timeouts instead
+of pymongo's 30s default) and never hang on a dead socket. The telemetry
+service is deployed on its own and reads the same MONGO_* variables.
+Clients are created with connect=False: nothing touches the network
+until the first operation.
+
+Pool activity is tracked with a pymongo connection pool listener and
+exported as mongo_pool_* metrics and by `pool_stats()`.
+"""
+
+import threading
+from collections import defaultdict
+from typing import Dict, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import WriteConcern, monitoring
+
+from core.config import settings
+from core.metrics import REGISTRY
+
+POOL_CHECKOUT_SECONDS = REGISTRY.histogram(
+    "mongo_pool_checkout_seconds", "Time to check a connection out of the MongoDB pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+POOL_CHECKOUT_FAILURES = REGISTRY.counter(
+    "mongo_pool_checkout_failures_total", "Failed MongoDB pool checkouts", ["reason"]
+)
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Per-server connection counts, updated from pymongo's pool events (any thread)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.servers: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"open": 0, "in_use": 0, "waiting": 0, "created": 0, "cleared": 0}
+        )
+
+    def _add(self, address, field: str, amount: int = 1):
+        with self._lock:
+            self.servers[f"{address[0]}:{address[1]}"][field] += amount
+
+    def pool_created(self, event):
+        with self._lock:
+            self.servers[f"{event.address[0]}:{event.address[1]}"]  # Listed before the first connection
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add(event.address, "cleared")
+
+    def pool_closed(self, event):
+        with self._lock:
+            self.servers.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event):
+        self._add(event.address, "open")
+        self._add(event.address, "created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(event.address, "open", -1)
+
+    def connection_check_out_started(self, event):
+        self._add(event.address, "waiting")
+
+    def connection_check_out_failed(self, event):
+        self._add(event.address, "waiting", -1)
+        POOL_CHECKOUT_FAILURES.inc(labels=(str(event.reason),))
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            server = self.servers[f"{event.address[0]}:{event.address[1]}"]
+            server["waiting"] -= 1
+            server["in_use"] += 1
+        if event.duration is not None:
+            POOL_CHECKOUT_SECONDS.observe(event.duration)
+
+    def connection_checked_in(self, event):
+        self._add(event.address, "in_use", -1)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {address: dict(counts) for address, counts in self.servers.items()}
+
+
+pool_monitor = PoolMonitor()
+_clients: Dict[str, AsyncIOMotorClient] = {}
+_clients_lock = threading.Lock()
+
+
+def client_options() -> dict:
+    """Pool and timeout options for AsyncIOMotorClient (0 = pymongo default / no timeout)."""
+    options = {
+        "maxPoolSize": settings.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": settings.MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": settings.MONGO_MAX_IDLE_MS or None,
+        "serverSelectionTimeoutMS": settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": settings.MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": settings.MONGO_SOCKET_TIMEOUT_MS or None,
+        "connect": False,
+        "event_listeners": [pool_monitor],
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+
+def get_client(url: Optional[str] = None) -> AsyncIOMotorClient:
+    """The shared client for `url` (default MONGODB_URL), created on first use."""
+    url = str(url or settings.MONGODB_URL)
+    with _clients_lock:
+        client = _clients.get(url)
+        if client is None:
+            client = _clients[url] = AsyncIOMotorClient(url, **client_options())
+        return client
+
+
+def get_database(name: Optional[str] = None, url: Optional[str] = None):
+    """Database `name`, or the one named in the URL."""
+    client = get_client(url)
+    return client.get_database(name) if name else client.get_database()
+
+
+def parse_write_concerns(spec: str) -> Dict[str, WriteConcern]:
+    """
+    "hardware_locations=1,rate_limits=0,pm_zones=majority:j" ->
+    {collection: WriteConcern}; ":j" adds journal acknowledgement.
+    """
+    concerns = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, sep, value = item.partition("=")
+        if not sep or not name.strip():
+            raise ValueError(f"Invalid MONGO_WRITE_CONCERNS entry: {item!r}")
+        w, _, journal = value.strip().partition(":")
+        concerns[name.strip()] = WriteConcern(
+            w=int(w) if w.isdigit() else w,
+            j=True if journal == "j" else None,
+        )
+    return concerns
+
+
+WRITE_CONCERNS = parse_write_concerns(settings.MONGO_WRITE_CONCERNS)
+
+
+def get_collection(name: str, db=None):
+    """Collection with its configured write concern (MONGO_WRITE_CONCERNS), else the client default."""
+    db = db if db is not None else get_database()
+    concern = WRITE_CONCERNS.get(name)
+    return db.get_collection(name, write_concern=concern) if concern else db.get_collection(name)
+
+
+async def ping(url: Optional[str] = None) -> bool:
+    """True if MongoDB answers within the server selection timeout."""
+    try:
+        await get_client(url).admin.command("ping")
+        return True
+    except Exception:
+        return False
+
+
+def pool_stats() -> dict:
+    return {
+        "servers": pool_monitor.snapshot(),
+        "options": {key: value for key, value in client_options().items() if key != "event_listeners"},
+        "write_concerns": {name: concern.document for name, concern in WRITE_CONCERNS.items()},
+    }
+
+
+def _pool_gauge(field: str):
+    def collect():
+        return {(address,): counts[field] for address, counts in pool_monitor.snapshot().items()}
+    return collect
+
+
+REGISTRY.gauge("mongo_pool_connections", "Open MongoDB connections", _pool_gauge("open"), ["server"])
+REGISTRY.gauge("mongo_pool_connections_in_use", "MongoDB connections checked out", _pool_gauge("in_use"), ["server"])
+REGISTRY.gauge("mongo_pool_waiting", "Operations waiting for a MongoDB connection", _pool_gauge("waiting"), ["server"])
@@ -0,0 +1,286 @@
+"""
+Profiling Module
+Opt-in, sampled per-stage timings for HTTP requests and MQTT messages, plus
+an on-demand stack sampler that writes flamegraph-compatible output.
+
+Tracing is off by default (sample rates 0.0) and costs one random() call
+per request/message when off. A sampled request or message gets a Trace
+bound to a ContextVar; stages are recorded explicitly (decode, validate,
+republish) or automatically by the metrics `timed` decorators (every
+MongoDB call and analytics pipeline run inside the trace's context, which
+includes coroutines handed to the loop with run_coroutine_threadsafe).
+
+The stack sampler polls sys._current_frames() from a thread for a fixed
+window and writes "folded" stacks (one "frame;frame;frame count" line per
+unique stack), the input format of flamegraph.pl, speedscope and inferno.
+"""
+
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter as StackCounter, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+
+from core import metrics
+from core.config import settings
+from core.metrics import REGISTRY
+
+PROFILE_STAGE_SECONDS = REGISTRY.histogram(
+    "profile_stage_seconds", "Per-stage timings of sampled requests and messages", ["kind", "stage"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+
+MAX_TRACES = 500
+MAX_SAMPLER_SECONDS = 120
+MAX_STACK_DEPTH = 64
+
+current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    __slots__ = ("kind", "name", "started", "timestamp", "stages")
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.started = time.perf_counter()
+        self.timestamp = time.time()
+        self.stages: List[tuple] = []
+
+    def add(self, stage: str, seconds: float):
+        self.stages.append((stage, seconds))
+        PROFILE_STAGE_SECONDS.observe(seconds, (self.kind, stage))
+
+    def stage(self, stage: str):
+        return _StageTimer(self, stage)
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "stages": [{"stage": s, "ms": round(sec * 1000, 3)} for s, sec in list(self.stages)],
+        }
+
+
+class _StageTimer:
+    __slots__ = ("trace", "stage", "started")
+
+    def __init__(self, trace: Trace, stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class _NullStage:
+    """Stand-in for stage() when the current message is not sampled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+def stage(trace: Optional[Trace], name: str):
+    """`with stage(trace, "decode"):` -- a no-op when `trace` is None."""
+    return trace.stage(name) if trace is not None else NULL_STAGE
+
+
+def _record_stage(stage_name: str, seconds: float):
+    # Called by metrics.timed for every Mongo/pipeline call
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(stage_name, seconds)
+
+
+class StackSampler:
+    """Samples every thread's stack for a window and writes folded stacks."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._thread: Optional[threading.Thread] = None
+        self.status: dict = {"running": False}
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, interval: float) -> dict:
+        if self.running:
+            raise RuntimeError("Sampler already running")
+        os.makedirs(self.directory, exist_ok=True)
+        filename = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+        self.status = {
+            "running": True,
+            "file": filename,
+            "seconds": seconds,
+            "interval_ms": interval * 1000,
+            "started": time.time(),
+            "samples": 0,
+        }
+        self._thread = threading.Thread(
+            target=self._run, args=(seconds, interval, os.path.join(self.directory, filename)),
+            name="stack-sampler", daemon=True
+        )
+        self._thread.start()
+        return dict(self.status)
+
+    def _run(self, seconds: float, interval: float, path: str):
+        own_id = threading.get_ident()
+        names = {}
+        stacks: StackCounter = StackCounter()
+        deadline = time.monotonic() + seconds
+        samples = 0
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None and len(frames) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                stacks[";".join(reversed(frames))] += 1
+            samples += 1
+            self.status["samples"] = samples
+            time.sleep(interval)
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(tmp_path, path)
+        self.status.update(running=False, finished=time.time(), unique_stacks=len(stacks))
+
+    def list_files(self) -> List[dict]:
+        if not os.path.isdir(self.directory):
+            return []
+        files = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if name.endswith(".folded"):
+                path = os.path.join(self.directory, name)
+                files.append({"file": name, "size_bytes": os.path.getsize(path), "created": os.path.getmtime(path)})
+        return files
+
+    def path_for(self, filename: str) -> Optional[str]:
+        if os.path.basename(filename) != filename or not filename.endswith(".folded"):
+            return None
+        path = os.path.join(self.directory, filename)
+        return path if os.path.isfile(path) else None
+
+
+class Profiler:
+    """
+    Args:
+        http_rate: Fraction of HTTP requests to trace (0.0 - 1.0)
+        mqtt_rate: Fraction of MQTT messages to trace (0.0 - 1.0)
+        directory: Where stack sampler output is written
+    """
+
+    def __init__(self, http_rate: float = 0.0, mqtt_rate: float = 0.0, directory: str = "profiles"):
+        self.rates = {"http": http_rate, "mqtt": mqtt_rate}
+        self.traces: Deque[Trace] = deque(maxlen=MAX_TRACES)
+        self.sampler = StackSampler(directory)
+        metrics.set_stage_hook(_record_stage)
+
+    def configure(self, http_rate: Optional[float] = None, mqtt_rate: Optional[float] = None):
+        if http_rate is not None:
+            self.rates["http"] = http_rate
+        if mqtt_rate is not None:
+            self.rates["mqtt"] = mqtt_rate
+
+    def maybe_trace(self, kind: str, name: str) -> Optional[Trace]:
+        """Return a Trace for 1 in 1/rate calls, else None."""
+        rate = self.rates.get(kind, 0.0)
+        if rate <= 0.0 or (rate < 1.0 and random.random() >= rate):
+            return None
+        trace = Trace(kind, name)
+        self.traces.append(trace)
+        return trace
+
+    def recent(self, kind: Optional[str] = None, limit: int = 50) -> List[dict]:
+        traces = [t for t in list(self.traces) if kind is None or t.kind == kind]
+        return [t.to_dict() for t in traces[-limit:][::-1]]
+
+    def summary(self) -> Dict[str, Dict[str, dict]]:
+        """Per kind and stage: count, mean, p50, p95 and max (ms) over the retained traces."""
+        samples: Dict[tuple, List[float]] = {}
+        for trace in list(self.traces):
+            for stage_name, seconds in list(trace.stages):
+                samples.setdefault((trace.kind, stage_name), []).append(seconds * 1000)
+
+        result: Dict[str, Dict[str, dict]] = {}
+        for (kind, stage_name), values in sorted(samples.items()):
+            values.sort()
+            result.setdefault(kind, {})[stage_name] = {
+                "count": len(values),
+                "mean_ms": round(sum(values) / len(values), 3),
+                "p50_ms": round(values[len(values) // 2], 3),
+                "p95_ms": round(values[min(len(values) - 1, int(len(values) * 0.95))], 3),
+                "max_ms": round(values[-1], 3),
+            }
+        return result
+
+
+class ProfilingMiddleware:
+    """
+    Pure ASGI middleware tracing a sample of HTTP requests: "handler" is the
+    time to the response start, "total" the time to the last body chunk;
+    Mongo/pipeline stages are added by the metrics decorators.
+    """
+
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = self.profiler.maybe_trace("http", f"{scope.get('method', '')} {scope.get('path', '')}")
+        if trace is None:
+            await self.app(scope, receive, send)
+            return
+
+        token = current_trace.set(trace)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                trace.add("handler", time.perf_counter() - trace.started)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            trace.add("total", time.perf_counter() - trace.started)
+            endpoint = scope.get("endpoint")
+            if endpoint is not None:
+                trace.name = f"{scope.get('method', '')} {endpoint.__name__}"
+            current_trace.reset(token)
+
+
+# Shared profiler (rates adjustable at runtime via /api/admin/profiling)
+profiler = Profiler(
+    http_rate=settings.PROFILE_HTTP_SAMPLE_RATE,
+    mqtt_rate=settings.PROFILE_MQTT_SAMPLE_RATE,
+    directory=settings.PROFILE_DIR,
+)
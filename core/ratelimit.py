@@ -0,0 +1,232 @@
+"""
+Rate Limiting Middleware
+Token buckets per API key and client IP (or per client IP when unauthenticated).
+
+Each client may spend RATE_LIMIT_PER_MINUTE tokens per minute with bursts
+up to RATE_LIMIT_BURST. Requests cost different amounts: cheap polling
+endpoints cost 1 token, aggregation-heavy ones (analytics, heatmap) cost
+more, so a dashboard hammering /api/heatmap?range=all runs out long before
+one polling /api/buses. Rejected requests get 429 with Retry-After.
+Buckets are per key *and* IP: dashboards, scripts and devices sharing
+API_SECRET_KEY don't drain one common bucket.
+
+Buckets live in an OrderedDict kept in last-used order: a bucket idle for
+longer than a full refill is indistinguishable from a new one, so idle
+buckets are evicted from the front as requests come in (no timer, memory
+bounded by the clients active in the last refill period).
+
+With RATE_LIMIT_BACKEND=mongo the buckets are shared through a MongoDB
+collection (one atomic pipeline update per request, TTL-expired), for
+deployments running several workers.
+"""
+
+import json
+import math
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+from core.metrics import REGISTRY
+
+# Path prefix -> token cost (first match wins; everything else costs 1)
+ROUTE_COSTS: List[Tuple[str, float]] = [
+    ("/api/heatmap/tiles", 1.0),  # Cached, and a map view loads a dozen at once
+    ("/api/heatmap", 10.0),
+    ("/api/analytics", 5.0),
+    ("/api/export", 10.0),
+    ("/api/firmware/upload", 5.0),
+    ("/api/admin/profiling/sampler", 5.0),
+]
+
+# Never limited (health checks, scrapes, docs)
+EXEMPT_PATHS = frozenset({"/health", "/health/ready", "/metrics", "/docs", "/openapi.json", "/redoc"})
+# Firmware downloads have their own cap (OTA_MAX_CONCURRENT_DOWNLOADS); a rollout
+# wave must not be turned away by the per-client budget
+EXEMPT_PREFIXES = ("/firmware/",)
+
+RATE_LIMITED = REGISTRY.counter("rate_limited_requests_total", "Requests rejected by the rate limiter", ["route_class"])
+
+
+def compile_costs(costs: List[Tuple[str, float]]):
+    """Return cost_for(path) backed by one compiled alternation regex."""
+    if not costs:
+        return lambda path: 1.0
+    pattern = re.compile("|".join(f"({re.escape(prefix)})" for prefix, _ in costs))
+    weights = [cost for _, cost in costs]
+
+    def cost_for(path: str) -> float:
+        match = pattern.match(path)
+        return weights[match.lastindex - 1] if match else 1.0
+    return cost_for
+
+
+class MemoryBucketStore:
+    """
+    In-process buckets: key -> [tokens, last_refill]. Not shared between
+    workers; use MongoBucketStore for that.
+    """
+
+    def __init__(self, rate_per_second: float, burst: float):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.idle_expiry = burst / rate_per_second  # Time to refill from empty
+        self.buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    def _evict_idle(self, now: float):
+        buckets = self.buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket[1] < self.idle_expiry:
+                break
+            del buckets[key]
+
+    async def take(self, key: str, cost: float, now: Optional[float] = None) -> Tuple[bool, float, float]:
+        """Spend `cost` tokens; returns (allowed, tokens_left, retry_after_seconds)."""
+        now = time.monotonic() if now is None else now
+        cost = min(cost, self.burst)
+        self._evict_idle(now)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return True, bucket[0], 0.0
+        return False, bucket[0], (cost - bucket[0]) / self.rate
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class MongoBucketStore:
+    """
+    Buckets shared between workers: one document per key, refilled and
+    spent in a single atomic update pipeline. A TTL index on `expires_at`
+    removes idle buckets.
+    """
+
+    def __init__(self, collection, rate_per_second: float, burst: float):
+        self.collection = collection
+        self.rate = rate_per_second
+        self.burst = burst
+        self.idle_expiry = burst / rate_per_second
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def take(self, key: str, cost: float, now: Optional[float] = None) -> Tuple[bool, float, float]:
+        now = time.time() if now is None else now
+        cost = min(cost, self.burst)
+        expires_at = datetime.utcnow() + timedelta(seconds=self.idle_expiry)
+        refilled = {"$min": [
+            self.burst,
+            {"$add": [
+                {"$ifNull": ["$tokens", self.burst]},
+                {"$multiply": [{"$max": [0, {"$subtract": [now, {"$ifNull": ["$ts", now]}]}]}, self.rate]},
+            ]},
+        ]}
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "ts": now, "expires_at": expires_at}},
+                {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        tokens = doc["tokens"]
+        if doc["allowed"]:
+            return True, tokens, 0.0
+        return False, tokens, (cost - tokens) / self.rate
+
+    def __len__(self):
+        return 0  # Not tracked locally
+
+
+def client_ip(scope, trust_proxy: bool = False) -> str:
+    if trust_proxy:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def client_id(scope, trust_proxy: bool = False) -> str:
+    """API key name set by APIKeyMiddleware plus the client IP, else the client IP alone."""
+    ip = client_ip(scope, trust_proxy)
+    api_key = scope.get("state", {}).get("api_key")
+    if api_key:
+        return f"key:{api_key}:{ip}"
+    return f"ip:{ip}"
+
+
+class RateLimitMiddleware:
+    """
+    Pure ASGI middleware; must run inside APIKeyMiddleware so the key name
+    is known (added before it with app.add_middleware).
+    """
+
+    def __init__(self, app, store, limit_per_minute: int, costs: List[Tuple[str, float]] = ROUTE_COSTS,
+                 trust_proxy: bool = False):
+        self.app = app
+        self.store = store
+        self.limit = str(limit_per_minute).encode()
+        self.cost_for = compile_costs(costs)
+        self.trust_proxy = trust_proxy
+
+    async def _reject(self, send, retry_after: float, remaining: float):
+        body = json.dumps({"detail": "Rate limit exceeded", "retry_after": math.ceil(retry_after)}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+                (b"x-ratelimit-limit", self.limit),
+                (b"x-ratelimit-remaining", str(int(remaining)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["path"] in EXEMPT_PATHS
+                or scope["path"].startswith(EXEMPT_PREFIXES)):
+            await self.app(scope, receive, send)
+            return
+
+        cost = self.cost_for(scope["path"])
+        try:
+            allowed, remaining, retry_after = await self.store.take(client_id(scope, self.trust_proxy), cost)
+        except Exception:
+            # Shared backend unavailable: fail open rather than take the API down
+            await self.app(scope, receive, send)
+            return
+
+        if not allowed:
+            RATE_LIMITED.inc(labels=("weighted" if cost > 1 else "default",))
+            await self._reject(send, retry_after, remaining)
+            return
+
+        remaining_header = str(int(remaining)).encode()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-ratelimit-limit", self.limit),
+                    (b"x-ratelimit-remaining", remaining_header),
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
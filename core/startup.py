@@ -0,0 +1,192 @@
+"""
+Startup Module
+Concurrent startup phases, lazily built subsystems, and readiness.
+
+The server starts in three steps:
+
+    import     module import until the lifespan runs (timed from the
+               import of this module, the first one app/main.py makes)
+    phases     independent steps (SQLite, spill buffer, MongoDB indexes,
+               zone cache, MQTT connect) run concurrently in a background
+               task; a phase waits only for the phases listed in `after`,
+               and is skipped if one of them did not succeed
+    lazy       optional subsystems (analytics, interpolation, OTA, route
+               catalog) are built on first use and timed then
+
+The lifespan returns before the phases finish, so /health (liveness)
+answers at once. /health/ready answers 503 until every required phase
+has succeeded; optional phases (MongoDB, MQTT) never block readiness,
+the server runs degraded without them as before, and their status is
+reported alongside.
+
+Stdlib only: it is imported before FastAPI to time the whole import.
+"""
+
+import asyncio
+import importlib
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+IMPORT_STARTED = time.perf_counter()
+
+PENDING = "pending"
+RUNNING = "running"
+OK = "ok"
+FAILED = "failed"
+SKIPPED = "skipped"  # A phase it runs `after` did not succeed
+
+
+class Phase:
+    __slots__ = ("name", "fn", "after", "required", "status", "seconds", "error", "done")
+
+    def __init__(self, name: str, fn: Callable[[], Any], after: Iterable[str], required: bool):
+        self.name = name
+        self.fn = fn
+        self.after = tuple(after)
+        self.required = required
+        self.status = PENDING
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+        self.done: Optional[asyncio.Event] = None
+
+    def summary(self) -> dict:
+        return {
+            "status": self.status,
+            "ms": round(self.seconds * 1000, 1) if self.seconds is not None else None,
+            "required": self.required,
+            "error": self.error,
+        }
+
+
+class Startup:
+    """Startup phases of one process and their timings."""
+
+    def __init__(self):
+        self.phases: Dict[str, Phase] = {}
+        self.lazy: Dict[str, float] = {}  # Subsystem -> seconds to build on first use
+        self.import_seconds: Optional[float] = None
+        self.ready_seconds: Optional[float] = None
+        self._started: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, name: str, fn: Callable[[], Any], after: Iterable[str] = (), required: bool = True):
+        """
+        Register a phase. `fn` may return an awaitable; blocking work should
+        be wrapped in asyncio.to_thread by the caller. A failed required phase
+        keeps the process unready; a failed optional one is only reported.
+        """
+        self.phases[name] = Phase(name, fn, after, required)
+
+    async def _run_phase(self, phase: Phase):
+        for name in phase.after:
+            await self.phases[name].done.wait()
+        missing = [name for name in phase.after if self.phases[name].status != OK]
+        if missing:
+            phase.status = SKIPPED
+            phase.error = f"needs {', '.join(missing)}"
+            phase.done.set()
+            print(f"[WARN] Startup {phase.name} skipped: {phase.error}")
+            return
+        phase.status = RUNNING
+        started = time.perf_counter()
+        try:
+            result = phase.fn()
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                await result
+            phase.status = OK
+        except Exception as e:
+            phase.status = FAILED
+            phase.error = str(e) or type(e).__name__
+        finally:
+            phase.seconds = time.perf_counter() - started
+            phase.done.set()
+        if phase.status == OK:
+            print(f"[OK] Startup {phase.name}: {phase.seconds * 1000:.0f} ms")
+        else:
+            print(f"[WARN] Startup {phase.name} failed after {phase.seconds * 1000:.0f} ms: {phase.error}")
+
+    async def run(self):
+        """Run all phases concurrently (respecting `after`); returns when all have finished."""
+        if self.import_seconds is None:
+            self.import_seconds = time.perf_counter() - IMPORT_STARTED
+        self._started = time.perf_counter()
+        for phase in self.phases.values():
+            phase.done = asyncio.Event()
+        await asyncio.gather(*(self._run_phase(phase) for phase in self.phases.values()))
+        self.ready_seconds = time.perf_counter() - self._started
+        state = "ready" if self.ready else "NOT ready"
+        print(f"[OK] Startup finished in {self.ready_seconds * 1000:.0f} ms "
+              f"(import {self.import_seconds * 1000:.0f} ms); {state}")
+
+    def start(self) -> asyncio.Task:
+        """Run the phases in the background (call from the lifespan)."""
+        self.import_seconds = time.perf_counter() - IMPORT_STARTED
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.phases) and all(
+            phase.status == OK for phase in self.phases.values() if phase.required
+        )
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "import_ms": round(self.import_seconds * 1000, 1) if self.import_seconds is not None else None,
+            "startup_ms": round(self.ready_seconds * 1000, 1) if self.ready_seconds is not None else None,
+            "phases": {name: phase.summary() for name, phase in self.phases.items()},
+            "degraded": [name for name, phase in self.phases.items() if phase.status in (FAILED, SKIPPED)],
+            "lazy": {name: round(seconds * 1000, 1) for name, seconds in self.lazy.items()},
+        }
+
+
+class Lazy:
+    """
+    A subsystem built by `factory` on first attribute access (any thread),
+    standing in for the object itself; build time goes to `startup.lazy`.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        self._name = name
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._value is not None
+
+    def instance(self):
+        """The subsystem, built now if this is the first use."""
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    started = time.perf_counter()
+                    value = self._factory()
+                    startup.lazy[self._name] = time.perf_counter() - started
+                    self._value = value
+        return self._value
+
+    def __getattr__(self, attr: str):
+        return getattr(self.instance(), attr)
+
+
+def lazy_module(name: str, module: str, attr: Optional[str] = None) -> Lazy:
+    """Lazy(name) importing `module` (or `module.attr`) on first use."""
+    if attr is None:
+        return Lazy(name, lambda: importlib.import_module(module))
+    return Lazy(name, lambda: getattr(importlib.import_module(module), attr))
+
+
+# Shared instance (phases registered by the app's lifespan)
+startup = Startup()
@@ -1,9 +1,9 @@
 import asyncio
-from motor.motor_asyncio import AsyncIOMotorClient
+from core.mongo import get_client
 
 async def delete_all_zones():
     uri = "mongodb://localhost:27017"
-    client = AsyncIOMotorClient(uri)
+    client = get_client(uri)
     db = client.sut_smart_bus
     collection = db.pm_zones
     
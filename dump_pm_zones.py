@@ -1,11 +1,11 @@
 import asyncio
-from motor.motor_asyncio import AsyncIOMotorClient
+from core.mongo import get_client
 import os
 
 async def dump_zones():
     # Updated URI from .env (no auth)
     uri = "mongodb://localhost:27017"
-    client = AsyncIOMotorClient(uri)
+    client = get_client(uri)
     db = client.sut_smart_bus
     collection = db.pm_zones
     
@@ -0,0 +1,139 @@
+"""
+Benchmark per-request overhead of the API key middleware.
+
+Compares the previous BaseHTTPMiddleware implementation (reproduced below)
+with the pure ASGI APIKeyMiddleware on a minimal Starlette app, calling the
+ASGI app directly (no network, no HTTP client) so only middleware cost is
+measured. Also times a streamed 1MB response to show the body-forwarding
+overhead that matters for firmware downloads.
+
+Usage:
+    python scripts/bench_auth_middleware.py [--requests 20000]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from starlette.applications import Starlette  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse  # noqa: E402
+from starlette.routing import Route  # noqa: E402
+
+from core.auth import PUBLIC_PATHS, APIKey, APIKeyMiddleware, ALL_SCOPES  # noqa: E402
+
+SECRET = "24f014a62c09a3e55af2d56f2bbe9d950800822a2e737d30210456160451158e8"
+STREAM_CHUNKS = 16
+STREAM_CHUNK = b"\0" * 65536
+
+
+class LegacyAPIKeyMiddleware(BaseHTTPMiddleware):
+    """The BaseHTTPMiddleware version this module replaced."""
+
+    async def dispatch(self, request: Request, call_next):
+        path = request.url.path
+        if path in PUBLIC_PATHS or path.startswith("/api/debug/location/"):
+            return await call_next(request)
+        api_key = request.headers.get("X-API-Key")
+        if not api_key:
+            api_key = request.query_params.get("api_key")
+        if not api_key:
+            return JSONResponse(status_code=401, content={"detail": "Missing API key. Include X-API-Key header."})
+        if api_key != SECRET:
+            return JSONResponse(status_code=403, content={"detail": "Invalid API key"})
+        return await call_next(request)
+
+
+async def hello(request):
+    return PlainTextResponse("ok")
+
+
+async def stream(request):
+    async def body():
+        for _ in range(STREAM_CHUNKS):
+            yield STREAM_CHUNK
+    return StreamingResponse(body(), media_type="application/octet-stream")
+
+
+def build(middleware=None, **options):
+    app = Starlette(routes=[Route("/api/buses", hello), Route("/health", hello), Route("/stream", stream)])
+    if middleware is not None:
+        app.add_middleware(middleware, **options)
+    return app
+
+
+def make_scope(path: str, key: bytes = None):
+    headers = [(b"host", b"bench")]
+    if key:
+        headers.append((b"x-api-key", key))
+    return {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "root_path": "", "headers": headers, "client": ("127.0.0.1", 1234), "server": ("bench", 80),
+    }
+
+
+async def call(app, scope) -> int:
+    sent = {"status": 0}
+    received = {"done": False}
+
+    async def receive():
+        # One empty body, then block like a connection that stays open
+        if received["done"]:
+            await asyncio.Event().wait()
+        received["done"] = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            sent["status"] = message["status"]
+
+    await app(dict(scope), receive, send)
+    return sent["status"]
+
+
+async def measure(app, scope, count: int) -> float:
+    status = await call(app, scope)  # Warm up (builds the middleware stack)
+    started = time.perf_counter()
+    for _ in range(count):
+        await call(app, scope)
+    return (time.perf_counter() - started) * 1e6 / count, status
+
+
+async def main_async(count: int):
+    apps = {
+        "no middleware": build(),
+        "BaseHTTPMiddleware (old)": build(LegacyAPIKeyMiddleware),
+        "pure ASGI (new)": build(APIKeyMiddleware, keys=[APIKey("default", SECRET, ALL_SCOPES)]),
+    }
+    cases = [
+        ("valid key", make_scope("/api/buses", SECRET.encode()), count),
+        ("public path", make_scope("/health"), count),
+        ("invalid key", make_scope("/api/buses", b"nope"), count),
+        ("1MB streamed", make_scope("/stream", SECRET.encode()), max(1, count // 20)),
+    ]
+    print(f"{'case':<16} {'middleware':<26} {'us/request':>12} {'overhead':>10} {'status':>7}")
+    for case, scope, n in cases:
+        baseline = None
+        for name, app in apps.items():
+            us, status = await measure(app, scope, n)
+            if baseline is None:
+                baseline = us
+            print(f"{case:<16} {name:<26} {us:>12.1f} {us - baseline:>+10.1f} {status:>7}")
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark API key middleware overhead")
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(main_async(args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark firmware delta patches (patch size and generation time).
+
+Usage:
+    python scripts/bench_firmware_delta.py
+    python scripts/bench_firmware_delta.py --base firmware/pm_1.0.0.bin --target firmware/pm_1.0.1.bin
+"""
+
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.delta import apply_patch, make_patch  # noqa: E402
+
+IMAGE_SIZE = 1_400_000  # Typical ESP32 app image
+
+
+def synth_firmware(size: int, seed: int = 1) -> bytes:
+    """Firmware-like bytes: instruction-ish words, 32-bit address literals and padding."""
+    rng = random.Random(seed)
+    out = bytearray()
+    opcodes = [rng.getrandbits(24) for _ in range(300)]
+    while len(out) < size:
+        kind = rng.random()
+        if kind < 0.75:
+            out += struct.pack("<I", opcodes[rng.randrange(len(opcodes))] | (rng.getrandbits(8) << 24))
+        elif kind < 0.95:
+            out += struct.pack("<I", 0x400D0000 + rng.randrange(0, size, 4))  # Address literal
+        else:
+            out += b"\xff" * rng.choice((16, 32, 64))
+    return bytes(out[:size])
+
+
+def relocate(image: bytes, at: int, inserted: bytes) -> bytes:
+    """Insert code at `at` and shift every address literal pointing past it."""
+    shift = len(inserted)
+    out = bytearray(image[:at] + inserted + image[at:])
+    for off in range(0, len(out) - 3, 4):
+        (word,) = struct.unpack_from("<I", out, off)
+        if 0x400D0000 + at <= word < 0x400D0000 + len(image):
+            struct.pack_into("<I", out, off, word + shift)
+    return bytes(out)
+
+
+def scenarios():
+    base = synth_firmware(IMAGE_SIZE)
+    rng = random.Random(2)
+
+    tweak = bytearray(base)
+    tweak[0x2000:0x2010] = os.urandom(16)  # Changed string constant
+    yield "constant change", base, bytes(tweak)
+
+    yield "4KB code insertion + relocation", base, relocate(base, IMAGE_SIZE // 3, synth_firmware(4096, seed=3))
+
+    multi = base
+    for _ in range(5):
+        multi = relocate(multi, rng.randrange(len(multi) // 4 * 4), synth_firmware(1024, seed=rng.randrange(100)))
+    yield "5 scattered insertions", base, multi
+
+    yield "unrelated image", base, synth_firmware(IMAGE_SIZE, seed=99)
+
+
+def run(name: str, base: bytes, target: bytes):
+    started = time.perf_counter()
+    patch = make_patch(base, target)
+    gen_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    assert apply_patch(base, patch) == target
+    apply_ms = (time.perf_counter() - started) * 1000
+
+    gz_size = len(zlib.compress(target, 9))
+    print(f"{name:<34} {len(target):>10,} {gz_size:>10,} {len(patch):>10,} "
+          f"{len(patch) / len(target):>7.2%} {gen_ms:>9.0f} {apply_ms:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark firmware delta patches")
+    parser.add_argument("--base", help="Base firmware .bin")
+    parser.add_argument("--target", help="Target firmware .bin")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<34} {'full':>10} {'full.gz':>10} {'patch':>10} {'ratio':>7} {'gen ms':>9} {'apply ms':>9}")
+    if args.base and args.target:
+        with open(args.base, "rb") as f:
+            base = f.read()
+        with open(args.target, "rb") as f:
+            target = f.read()
+        run(f"{os.path.basename(args.base)} -> {os.path.basename(args.target)}", base, target)
+    else:
+        for name, base, target in scenarios():
+            run(name, base, target)
+
+
+if __name__ == "__main__":
+    main()
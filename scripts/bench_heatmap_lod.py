@@ -0,0 +1,89 @@
+"""
+Benchmark heatmap level-of-detail decimation (payload size and encode time).
+
+Generates readings along the campus loop from populate_heatmap.py and
+compares the raw gradient payload with the LOD payload at several zoom
+levels. The binning below mirrors the $group stage of
+crud.get_heatmap_lod_data, so no MongoDB is needed.
+
+Usage:
+    python scripts/bench_heatmap_lod.py [--points 5000]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from app.heatmap import lod_cell_degrees  # noqa: E402
+from populate_heatmap import ROUTE_POINTS, interpolate_points  # noqa: E402
+
+
+def make_readings(count: int, seed: int = 1):
+    rng = random.Random(seed)
+    path = []
+    for i in range(len(ROUTE_POINTS) - 1):
+        path.extend(interpolate_points(ROUTE_POINTS[i], ROUTE_POINTS[i + 1], steps=200))
+    readings = []
+    for i in range(count):
+        lat, lon = path[i % len(path)]
+        readings.append({
+            "lat": lat + rng.uniform(-0.0001, 0.0001),
+            "lon": lon + rng.uniform(-0.0001, 0.0001),
+            "pm2_5": max(5.0, 15.0 + rng.uniform(-5, 30)),
+        })
+    return readings
+
+
+def raw_points(readings):
+    return [{"latitude": r["lat"], "longitude": r["lon"], "weight": r["pm2_5"]} for r in readings]
+
+
+def lod_points(readings, zoom: int):
+    cell = lod_cell_degrees(zoom)
+    cells = {}
+    for r in readings:
+        key = (math.floor(r["lon"] / cell), math.floor(r["lat"] / cell))
+        acc = cells.get(key)
+        if acc is None:
+            acc = cells[key] = [0.0, 0.0, 0.0, 0]
+        acc[0] += r["lat"]
+        acc[1] += r["lon"]
+        acc[2] += r["pm2_5"]
+        acc[3] += 1
+    return [
+        {"latitude": round(a[0] / a[3], 6), "longitude": round(a[1] / a[3], 6),
+         "weight": round(a[2] / a[3], 2), "count": a[3]}
+        for a in cells.values()
+    ]
+
+
+def report(name: str, points, baseline_bytes=None):
+    started = time.perf_counter()
+    body = json.dumps(points).encode()
+    encode_ms = (time.perf_counter() - started) * 1000
+    ratio = f"{baseline_bytes / len(body):>7.1f}x" if baseline_bytes else f"{'':>8}"
+    print(f"{name:<14} {len(points):>8,} {len(body):>12,} {ratio} {encode_ms:>10.2f}")
+    return len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark heatmap LOD decimation")
+    parser.add_argument("--points", type=int, default=5000)
+    args = parser.parse_args()
+
+    readings = make_readings(args.points)
+    print(f"{'payload':<14} {'points':>8} {'bytes':>12} {'smaller':>8} {'encode ms':>10}")
+    baseline = report("raw gradient", raw_points(readings))
+    for zoom in (14, 15, 16, 17, 18):
+        report(f"lod zoom {zoom}", lod_points(readings, zoom), baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark MQTT ingest throughput with logging off/on.
+
+Feeds synthetic GPS messages through app.mqtt.on_message on the calling
+thread (like the paho network thread does). Database writes are replaced
+by no-op coroutines on a background event loop so the numbers isolate the
+parse/validate/log cost of the handler itself.
+
+Usage:
+    python scripts/bench_ingest_logging.py [--messages 50000]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app import crud, mqtt  # noqa: E402
+from app.spill import ingest_writer  # noqa: E402
+from core.logger import setup_logging, shutdown_logging  # noqa: E402
+
+
+class FakeMessage:
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+class NullClient:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def make_messages(count: int):
+    messages = []
+    for i in range(count):
+        payload = {
+            "bus_mac": f"24:6F:28:00:00:{i % 50:02X}",
+            "lat": 14.88 + (i % 100) * 1e-5,
+            "lon": 102.02 + (i % 100) * 1e-5,
+            "pm2_5": 20.0 + i % 7,
+            "pm10": 30.0,
+            "temp": 29.5,
+            "hum": 61.0,
+            "seats_available": 10,
+            "seq": i,  # Unique payloads (repeats would be dropped as duplicates)
+        }
+        messages.append(FakeMessage(mqtt.TOPIC_ESP32_GPS, json.dumps(payload).encode()))
+    return messages
+
+
+def run_case(name: str, messages, configure):
+    log_file = tempfile.NamedTemporaryFile("w", suffix=".log", delete=False)
+    configure(log_file)
+    client = NullClient()
+
+    started = time.perf_counter()
+    for msg in messages:
+        mqtt.on_message(client, None, msg)
+    elapsed = time.perf_counter() - started
+
+    shutdown_logging()
+    log_file.close()
+    size = os.path.getsize(log_file.name)
+    os.remove(log_file.name)
+    print(f"{name:<32} {len(messages) / elapsed:>12,.0f} msg/s {elapsed * 1e6 / len(messages):>8.1f} us/msg {size / 1024:>10,.0f} KB logged")
+
+
+def sync_handler(level):
+    """The previous behaviour: every record written and flushed on the caller's thread."""
+    def configure(stream):
+        shutdown_logging()
+        root = logging.getLogger()
+        root.handlers = [logging.StreamHandler(stream)]
+        root.setLevel(level)
+    return configure
+
+
+def queued(level, fmt="text", sample_every=1):
+    def configure(stream):
+        logging.getLogger().handlers = []
+        setup_logging(level=level, fmt=fmt, sample_every=sample_every, stream=stream)
+    return configure
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest throughput with logging on/off")
+    parser.add_argument("--messages", type=int, default=50000)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    mqtt.set_main_loop(loop)
+    crud.update_bus_location = _noop
+    ingest_writer.insert = _noop
+
+    messages = make_messages(args.messages)
+    print(f"{args.messages:,} messages\n")
+    run_case("logging off (WARNING)", messages, queued("WARNING"))
+    run_case("sync DEBUG (per-record flush)", messages, sync_handler("DEBUG"))
+    run_case("queued DEBUG text", messages, queued("DEBUG"))
+    run_case("queued DEBUG json", messages, queued("DEBUG", fmt="json"))
+    run_case("queued DEBUG sampled 1/100", messages, queued("DEBUG", sample_every=100))
+
+    loop.call_soon_threadsafe(loop.stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Benchmark PM2.5 surface interpolation (app/interpolation.py).
+
+Builds ~111m zones along the campus loop from populate_heatmap.py (the
+same shape analytics.get_zone_bucket_sums returns) and times
+interpolate_grid for both methods at grid sizes up to 1000x1000. For the
+smaller grids it also times a brute-force NumPy version (every cell
+against every zone) to show what the KD-tree saves.
+
+Usage:
+    python scripts/bench_interpolation.py [--sizes 100,250,500,1000] [--zones 0]
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from app.interpolation import (  # noqa: E402
+    DEFAULT_RADIUS_M, IDW_POWER, METERS_PER_DEG_LAT, METERS_PER_DEG_LON, MIN_DISTANCE_M,
+    data_bounds, interpolate_grid,
+)
+from populate_heatmap import ROUTE_POINTS, interpolate_points  # noqa: E402
+
+GRID_SIZE = 0.001
+BRUTE_FORCE_MAX_CELLS = 250 * 250
+
+
+def make_zones(extra: int = 0, seed: int = 1):
+    """Zone centres along the route (plus `extra` scattered zones) with mean PM2.5 and counts."""
+    rng = random.Random(seed)
+    path = []
+    for i in range(len(ROUTE_POINTS) - 1):
+        path.extend(interpolate_points(ROUTE_POINTS[i], ROUTE_POINTS[i + 1], steps=200))
+    zones = {}
+    for lat, lon in path:
+        zones[(math.floor(lat / GRID_SIZE), math.floor(lon / GRID_SIZE))] = None
+    lats = [p[0] for p in path]
+    lons = [p[1] for p in path]
+    for _ in range(extra):
+        zones[(math.floor(rng.uniform(min(lats), max(lats)) / GRID_SIZE),
+               math.floor(rng.uniform(min(lons), max(lons)) / GRID_SIZE))] = None
+
+    keys = list(zones)
+    lat = np.array([(k[0] + 0.5) * GRID_SIZE for k in keys])
+    lon = np.array([(k[1] + 0.5) * GRID_SIZE for k in keys])
+    values = np.array([max(5.0, 15.0 + rng.uniform(-5, 30)) for _ in keys])
+    counts = np.array([float(rng.randint(1, 50)) for _ in keys])
+    return lat, lon, values, counts
+
+
+def brute_force_idw(lats, lons, values, weights, bounds, width, height, radius_m):
+    """Every cell against every zone: O(cells * zones) time and memory."""
+    min_lon, min_lat, max_lon, max_lat = bounds
+    lat0 = math.radians((min_lat + max_lat) / 2)
+    kx, ky = METERS_PER_DEG_LON * math.cos(lat0), METERS_PER_DEG_LAT
+    cell_lons = min_lon + (np.arange(width) + 0.5) * (max_lon - min_lon) / width
+    cell_lats = max_lat - (np.arange(height) + 0.5) * (max_lat - min_lat) / height
+    gx, gy = np.meshgrid(cell_lons * kx, cell_lats * ky)
+    d = np.hypot(gx.reshape(-1, 1) - lons * kx, gy.reshape(-1, 1) - lats * ky)
+    w = np.where(d <= radius_m, weights / np.maximum(d, MIN_DISTANCE_M) ** IDW_POWER, 0.0)
+    total = w.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(total > 0, (w * values).sum(axis=1) / total, np.nan).reshape(height, width)
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PM2.5 surface interpolation")
+    parser.add_argument("--sizes", default="100,250,500,1000", help="Grid sizes (N for NxN)")
+    parser.add_argument("--zones", type=int, default=0, help="Extra zones scattered off the route")
+    parser.add_argument("--radius", type=float, default=DEFAULT_RADIUS_M)
+    args = parser.parse_args()
+
+    lats, lons, values, counts = make_zones(args.zones)
+    bounds = data_bounds(lats, lons, args.radius)
+    print(f"{len(values)} zones, radius {args.radius:.0f}m\n")
+    print(f"{'grid':<10} {'method':<12} {'seconds':>9} {'Mcells/s':>9} {'covered':>8} {'vs brute':>9}")
+
+    for size in (int(s) for s in args.sizes.split(",")):
+        cells = size * size
+        label = f"{size}x{size}"
+        brute = None
+        if cells <= BRUTE_FORCE_MAX_CELLS:
+            expected, brute = timed(brute_force_idw, lats, lons, values, counts, bounds, size, size, args.radius)
+            print(f"{label:<10} {'brute idw':<12} {brute:>9.3f} {cells / brute / 1e6:>9.2f}")
+            # Same result as brute force when every zone in the radius is a neighbour
+            grid, seconds = timed(interpolate_grid, lats, lons, values, counts, bounds, size, size,
+                                  "idw", args.radius, len(values))
+            assert np.allclose(grid, expected, equal_nan=True), "KD-tree IDW differs from brute force"
+            print(f"{label:<10} {'idw k=all':<12} {seconds:>9.3f} {cells / seconds / 1e6:>9.2f} "
+                  f"{'':>8} {brute / seconds:>8.1f}x")
+        for method in ("idw", "gaussian"):
+            grid, seconds = timed(interpolate_grid, lats, lons, values, counts, bounds, size, size,
+                                  method, args.radius)
+            covered = np.count_nonzero(~np.isnan(grid)) / cells
+            speedup = f"{brute / seconds:>8.1f}x" if brute else ""
+            print(f"{label:<10} {method + ' k=8':<12} {seconds:>9.3f} {cells / seconds / 1e6:>9.2f} "
+                  f"{covered:>8.0%} {speedup}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
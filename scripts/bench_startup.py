@@ -0,0 +1,94 @@
+"""
+Benchmark server startup: time until /health (liveness) and /health/ready
+(readiness) answer, per run, with the per-phase timings of the last run.
+
+Starts `uvicorn app.main:app` in a subprocess from the repository root
+and polls both endpoints every few milliseconds. MongoDB and the MQTT
+broker are optional: without them the run shows the degraded phases,
+which must not delay readiness.
+
+Usage:
+    python scripts/bench_startup.py [--runs 5] [--port 8765]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+POLL_SECONDS = 0.005
+TIMEOUT_SECONDS = 30.0
+
+
+def status(url: str):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except OSError:
+        return None, None
+
+
+def run_once(port: int) -> dict:
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    live = ready = None
+    report = {}
+    try:
+        while time.perf_counter() - started < TIMEOUT_SECONDS:
+            if live is None and status(f"{base}/health")[0] == 200:
+                live = time.perf_counter() - started
+            if live is not None:
+                code, body = status(f"{base}/health/ready")
+                if code == 200:
+                    ready = time.perf_counter() - started
+                    report = json.loads(body)
+                    break
+            time.sleep(POLL_SECONDS)
+    finally:
+        server.terminate()
+        server.wait(timeout=15)
+    return {"live": live, "ready": ready, "report": report}
+
+
+def ms(seconds) -> str:
+    return f"{seconds * 1000:8.0f} ms" if seconds is not None else "   (none)"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure time to liveness and readiness")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    results = []
+    for i in range(args.runs):
+        result = run_once(args.port)
+        results.append(result)
+        print(f"run {i + 1}: live {ms(result['live'])}   ready {ms(result['ready'])}")
+
+    ready = sorted(r["ready"] for r in results if r["ready"] is not None)
+    if ready:
+        print(f"\nready median {ms(ready[len(ready) // 2])}")
+
+    report = results[-1]["report"]
+    if report:
+        print(f"\nlast run: import {report['import_ms']} ms, degraded: {', '.join(report['degraded']) or 'none'}")
+        for name, phase in report["phases"].items():
+            print(f"  {name:15s} {phase['status']:8s} {phase['ms'] if phase['ms'] is not None else '-':>8} ms")
+    if len(ready) < len(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Check the ingest anomaly detector (app/anomaly.py) against synthetic spikes.
+
+Generates per-bus PM2.5 streams the way populate_heatmap.py does (the
+campus loop with its polluted stretch), injects known faults and reports
+how many the detector catches and how many clean readings it flags:
+
+    spike      single reading +60..+400 ug/m3 above the local level
+    drop       single reading falling to ~0 from a high level
+    saturated  sensor pegged at the 1000 ug/m3 ingest ceiling
+    shift      sustained +40 ug/m3 step (must be flagged briefly, then accepted)
+
+Exits non-zero if the recall of any fault class or the false positive
+rate misses its target.
+
+Usage:
+    python scripts/check_anomaly_detection.py [--readings 5000] [--seed 1]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from app.anomaly import AnomalyDetector, SATURATION_PM25  # noqa: E402
+from populate_heatmap import BUSES, ROUTE_POINTS, interpolate_points  # noqa: E402
+
+MIN_RECALL = 0.95
+MAX_FALSE_POSITIVE_RATE = 0.01
+SHIFT_LENGTH = 60
+
+
+def route_path():
+    path = []
+    for i in range(len(ROUTE_POINTS) - 1):
+        path.extend(interpolate_points(ROUTE_POINTS[i], ROUTE_POINTS[i + 1], steps=20))
+    return path
+
+
+def clean_pm(path_index: int, rng: random.Random) -> float:
+    """PM2.5 model of populate_heatmap.py: a polluted stretch between indices 15 and 45."""
+    base_pm = 15.0
+    if 15 <= path_index <= 45:
+        base_pm += rng.uniform(10, 30)
+    else:
+        base_pm += rng.uniform(-5, 5)
+    return max(5.0, base_pm)
+
+
+def make_stream(count: int, rng: random.Random, fault_rate: float = 0.02):
+    """[(pm2_5, fault kind or None)] for one bus."""
+    path_length = len(route_path())
+    stream = []
+    shift_left = 0
+    for i in range(count):
+        value = clean_pm(i % path_length, rng)
+        if shift_left:
+            shift_left -= 1
+            stream.append((value + 40.0, "shift"))
+            continue
+        roll = rng.random()
+        if i < 50 or roll >= fault_rate:
+            stream.append((value, None))
+        elif roll < fault_rate * 0.6:
+            stream.append((value + rng.uniform(60, 400), "spike"))
+        elif roll < fault_rate * 0.8:
+            stream.append((SATURATION_PM25, "saturated"))
+        elif roll < fault_rate * 0.95 and value > 30:
+            stream.append((rng.choice((0.0, rng.uniform(0.1, 1.0))), "drop"))
+        elif roll >= fault_rate * 0.95:
+            shift_left = SHIFT_LENGTH - 1
+            stream.append((value + 40.0, "shift"))
+        else:
+            stream.append((value, None))
+    return stream
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check PM anomaly detection against synthetic faults")
+    parser.add_argument("--readings", type=int, default=5000, help="Readings per bus")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    detector = AnomalyDetector()
+    streams = {bus["mac"]: make_stream(args.readings, rng) for bus in BUSES}
+
+    injected = {"spike": 0, "drop": 0, "saturated": 0}
+    caught = {"spike": 0, "drop": 0, "saturated": 0}
+    clean = false_positives = 0
+    shift_flagged = shift_total = 0
+    elapsed = 0.0
+
+    for i in range(args.readings):
+        for mac, stream in streams.items():
+            value, fault = stream[i]
+            started = time.perf_counter()
+            kind = detector.check(mac, value)
+            elapsed += time.perf_counter() - started
+            if fault in injected:
+                injected[fault] += 1
+                caught[fault] += kind is not None
+            elif fault == "shift":
+                shift_total += 1
+                shift_flagged += kind is not None
+            else:
+                clean += 1
+                false_positives += kind is not None
+
+    total = sum(injected.values())
+    recall = sum(caught.values()) / total if total else 1.0
+    fp_rate = false_positives / clean if clean else 0.0
+    readings = args.readings * len(streams)
+
+    print(f"{readings:,} readings from {len(streams)} buses, {elapsed / readings * 1e6:.2f} us/reading\n")
+    print(f"{'fault':<10} {'injected':>9} {'caught':>8} {'recall':>8}")
+    for fault, n in injected.items():
+        print(f"{fault:<10} {n:>9} {caught[fault]:>8} {caught[fault] / n if n else 1:>8.1%}")
+    print(f"{'all':<10} {total:>9} {sum(caught.values()):>8} {recall:>8.1%}\n")
+    print(f"clean readings flagged: {false_positives} / {clean} ({fp_rate:.2%})")
+    print(f"level shifts: {shift_flagged} of {shift_total} shifted readings flagged before the new level was accepted")
+
+    missed = [fault for fault, n in injected.items() if n and caught[fault] / n < MIN_RECALL]
+    if missed:
+        print(f"recall below {MIN_RECALL:.0%}: {', '.join(missed)}")
+    failed = bool(missed) or fp_rate > MAX_FALSE_POSITIVE_RATE
+    print("\nFAIL" if failed else "\nOK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
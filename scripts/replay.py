@@ -0,0 +1,444 @@
+"""
+Replay recorded fleet traffic against a running build.
+
+Reads hardware_locations (from MongoDB or an NDJSON file written by
+/api/export/hardware-locations) and re-sends the readings in timestamp order, at the
+recorded pace scaled by --speed (1 = real time, 10 = ten times faster,
+max = no delays):
+
+    mqtt    publish to sut/bus/gps on a broker, like the buses do; ingest
+            lag is the time until the server republishes the reading on
+            sut/app/bus/location
+    direct  call app.mqtt.on_message in this process (writes go to
+            MONGODB_URL); ingest lag is the time until the reading is
+            stored
+
+Afterwards the readings stored by the replay (timestamp >= replay start,
+same buses) are aggregated per bus and per ~111m zone and compared with
+the same aggregates computed from the source, so dropped or mangled
+messages show up as mismatches. The server stamps readings on arrival,
+so point MONGODB_URL at a scratch database and don't replay buses that
+are live on the same broker.
+
+Usage:
+    python scripts/replay.py --file export.ndjson.gz --target direct --speed max
+    python scripts/replay.py --source-url mongodb://prod/sut_smart_bus --start 2025-01-31 \\
+        --end 2025-02-01 --target mqtt --host localhost --speed 10
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from core.config import settings  # noqa: E402
+from core.mongo import get_database  # noqa: E402
+
+GRID_SIZE = 0.001
+SOURCE_BATCH_SIZE = 2000
+PROGRESS_EVERY = 5.0  # Seconds
+TOPIC_GPS = "sut/bus/gps"
+TOPIC_APP_LOCATION = "sut/app/bus/location"
+
+
+# --- Sources (rows in timestamp order, shaped like app/export.py rows) ---
+
+def _parse_time(value) -> Optional[datetime]:
+    if isinstance(value, datetime) or value is None:
+        return value
+    return datetime.fromisoformat(value)
+
+
+async def read_file(path: str) -> AsyncIterator[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                row = json.loads(line)
+                row["timestamp"] = _parse_time(row.get("timestamp"))
+                yield row
+            if i % SOURCE_BATCH_SIZE == 0:
+                await asyncio.sleep(0)
+
+
+async def read_mongo(url: str, start: Optional[datetime], end: datetime,
+                     bus_mac: Optional[str] = None) -> AsyncIterator[dict]:
+    """hardware_locations in (timestamp, _id) keyset pages, like app/export.py."""
+    collection = get_database(url=url).get_collection("hardware_locations")
+    query: dict = {"timestamp": {"$lt": end}}
+    if start:
+        query["timestamp"]["$gte"] = start
+    if bus_mac:
+        query["bus_mac"] = bus_mac
+    projection = {"timestamp": 1, "bus_mac": 1, "lat": 1, "lon": 1, "pm2_5": 1, "pm10": 1}
+    after = None
+    while True:
+        page_query = query
+        if after:
+            page_query = {"$and": [query, {"$or": [
+                {"timestamp": {"$gt": after[0]}},
+                {"timestamp": after[0], "_id": {"$gt": after[1]}},
+            ]}]}
+        docs = await collection.find(page_query, projection).sort(
+            [("timestamp", 1), ("_id", 1)]).limit(SOURCE_BATCH_SIZE).to_list(SOURCE_BATCH_SIZE)
+        for doc in docs:
+            yield doc
+        if len(docs) < SOURCE_BATCH_SIZE:
+            return
+        after = (docs[-1]["timestamp"], docs[-1]["_id"])
+
+
+def to_payload(row: dict) -> Optional[dict]:
+    """sut/bus/gps payload for a stored reading; None if ingest would not store it as-is."""
+    if not row.get("bus_mac") or row.get("lat") is None or row.get("lon") is None or not row.get("timestamp"):
+        return None
+    return {
+        "bus_mac": row["bus_mac"],
+        "lat": float(row["lat"]),
+        "lon": float(row["lon"]),
+        "pm2_5": float(row.get("pm2_5") or 0.0),
+        "pm10": float(row.get("pm10") or 0.0),
+    }
+
+
+# --- Aggregates ---
+
+class Aggregates:
+    """Per-bus and per-zone count / PM sums, as the server should have stored them."""
+
+    def __init__(self):
+        self.buses: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0, 0.0])
+        self.zones: Dict[tuple, List[float]] = defaultdict(lambda: [0, 0.0])
+        self.anomalies = 0
+
+    def add(self, payload: dict):
+        # Same clamping as ingest (app/mqtt.py)
+        pm2_5 = max(0.0, min(payload["pm2_5"], 1000.0))
+        pm10 = max(0.0, min(payload["pm10"], 1000.0))
+        bus = self.buses[payload["bus_mac"]]
+        bus[0] += 1
+        bus[1] += pm2_5
+        bus[2] += pm10
+        zone = self.zones[(math.floor(payload["lat"] / GRID_SIZE), math.floor(payload["lon"] / GRID_SIZE))]
+        zone[0] += 1
+        zone[1] += pm2_5
+
+    @property
+    def count(self) -> int:
+        return int(sum(bus[0] for bus in self.buses.values()))
+
+
+async def stored_aggregates(collection, since: datetime, buses: List[str]) -> Aggregates:
+    match = {"timestamp": {"$gte": since}, "bus_mac": {"$in": buses}}
+    pipeline = [
+        {"$match": match},
+        {"$facet": {
+            "buses": [{"$group": {"_id": "$bus_mac", "count": {"$sum": 1},
+                                  "pm25": {"$sum": "$pm2_5"}, "pm10": {"$sum": "$pm10"}}}],
+            "zones": [{"$group": {"_id": {"lat": {"$floor": {"$divide": ["$lat", GRID_SIZE]}},
+                                          "lon": {"$floor": {"$divide": ["$lon", GRID_SIZE]}}},
+                                  "count": {"$sum": 1}, "pm25": {"$sum": "$pm2_5"}}}],
+            "anomalies": [{"$match": {"anomaly": {"$ne": None}}}, {"$count": "n"}],
+        }},
+    ]
+    result = (await collection.aggregate(pipeline).to_list(1))[0]
+    stored = Aggregates()
+    for row in result["buses"]:
+        stored.buses[row["_id"]] = [row["count"], row["pm25"], row["pm10"]]
+    for row in result["zones"]:
+        stored.zones[(int(row["_id"]["lat"]), int(row["_id"]["lon"]))] = [row["count"], row["pm25"]]
+    stored.anomalies = result["anomalies"][0]["n"] if result["anomalies"] else 0
+    return stored
+
+
+def compare(expected: Aggregates, stored: Aggregates) -> List[str]:
+    """Mismatch descriptions (empty when every bus and zone agrees)."""
+    problems = []
+
+    def close(a, b):
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6)
+
+    for name, want, got in (("bus", expected.buses, stored.buses), ("zone", expected.zones, stored.zones)):
+        for key in sorted(set(want) | set(got), key=str):
+            w, g = want.get(key), got.get(key)
+            if w is None or g is None:
+                problems.append(f"{name} {key}: expected {w[0] if w else 0} readings, stored {g[0] if g else 0}")
+            elif w[0] != g[0] or not all(close(a, b) for a, b in zip(w[1:], g[1:])):
+                problems.append(f"{name} {key}: expected {w}, stored {g}")
+    return problems
+
+
+# --- Targets ---
+
+class LagTracker:
+    def __init__(self):
+        self.lags: List[float] = []
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.lags.append(seconds)
+
+    def summary(self) -> str:
+        with self._lock:
+            lags = sorted(self.lags)
+        if not lags:
+            return "no readings matched"
+
+        def q(p):
+            return lags[min(len(lags) - 1, int(p * len(lags)))] * 1000
+        return (f"p50 {q(0.5):.1f} ms, p90 {q(0.9):.1f} ms, p99 {q(0.99):.1f} ms, "
+                f"max {lags[-1] * 1000:.1f} ms ({len(lags):,} readings)")
+
+
+class MqttTarget:
+    """Publish to a broker; lag = publish until the server's republish on sut/app/bus/location."""
+
+    def __init__(self, host: str, port: int, qos: int, lag: LagTracker):
+        import paho.mqtt.client as mqtt
+
+        self.qos = qos
+        self.lag = lag
+        self.pending: Dict[str, deque] = defaultdict(deque)  # bus_mac -> publish times, in order
+        self._lock = threading.Lock()
+        self._subscribed = threading.Event()
+        self.client = mqtt.Client(client_id=f"sut-replay-{os.getpid()}", clean_session=True)
+        self.client.on_connect = lambda client, *_: client.subscribe(TOPIC_APP_LOCATION)
+        self.client.on_subscribe = lambda *_: self._subscribed.set()
+        self.client.on_message = self._on_republish
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+        if not self._subscribed.wait(10):
+            raise RuntimeError(f"Could not subscribe on {host}:{port}")
+
+    def _on_republish(self, client, userdata, msg):
+        received = time.perf_counter()
+        try:
+            # The server republishes each full fix once, in order per bus
+            # (with a smoothed position, so match on the bus alone)
+            key = json.loads(msg.payload)["bus_mac"]
+        except (ValueError, KeyError, TypeError):
+            return
+        with self._lock:
+            sent = self.pending.get(key)
+            if not sent:
+                return  # Not ours (a live bus)
+            started = sent.popleft()
+            if not sent:
+                del self.pending[key]
+        self.lag.observe(received - started)
+
+    async def send(self, payload: dict):
+        with self._lock:
+            self.pending[payload["bus_mac"]].append(time.perf_counter())
+        self.client.publish(TOPIC_GPS, json.dumps(payload), qos=self.qos)
+
+    async def drain(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class _Message:
+    def __init__(self, payload: dict):
+        self.topic = TOPIC_GPS
+        self.payload = json.dumps(payload).encode()
+
+
+class _NullClient:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+class DirectTarget:
+    """app.mqtt.on_message in-process; lag = handler start until the reading is stored."""
+
+    def __init__(self, lag: LagTracker):
+        from app import mqtt
+
+        self.mqtt = mqtt
+        self.lag = lag
+        self.in_flight = 0
+        self.failed = 0
+        self.client = _NullClient()
+        mqtt.set_main_loop(asyncio.get_running_loop())
+        store_reading = mqtt.store_reading
+
+        def timed_store(location):
+            started = self._started
+            self.in_flight += 1
+
+            async def store():
+                try:
+                    return await store_reading(location)
+                except Exception:
+                    self.failed += 1
+                    raise
+                finally:
+                    self.in_flight -= 1
+                    self.lag.observe(time.perf_counter() - started)
+            return store()
+
+        mqtt.store_reading = timed_store
+
+    async def send(self, payload: dict):
+        self._started = time.perf_counter()
+        self.mqtt.on_message(self.client, None, _Message(payload))
+        # Let the scheduled writes start; at max speed wait for a free ingest slot
+        # so nothing is queued (or dropped by INGEST_OVERFLOW)
+        await asyncio.sleep(0)
+        executor = self.mqtt.ingest_executor
+        while executor.queue or executor.in_flight >= executor.max_in_flight:
+            await asyncio.sleep(0.005)
+
+    async def drain(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        executor = self.mqtt.ingest_executor
+        while (self.in_flight or executor.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def close(self):
+        pass
+
+
+# --- Replay ---
+
+async def replay(rows: AsyncIterator[dict], target, speed: float, expected: Aggregates) -> dict:
+    """Send rows on the recorded schedule (speed 0 = as fast as possible)."""
+    sent = skipped = 0
+    max_behind = 0.0
+    first_ts = wall_start = None
+    started = last_progress = time.perf_counter()
+
+    async for row in rows:
+        payload = to_payload(row)
+        if payload is None:
+            skipped += 1
+            continue
+        ts = row["timestamp"].timestamp()
+        if first_ts is None:
+            first_ts, wall_start = ts, time.perf_counter()
+        if speed:
+            due = wall_start + (ts - first_ts) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                max_behind = max(max_behind, -delay)
+
+        await target.send(payload)
+        expected.add(payload)
+        sent += 1
+
+        now = time.perf_counter()
+        if now - last_progress >= PROGRESS_EVERY:
+            last_progress = now
+            print(f"  {sent:,} sent, {sent / (now - started):,.0f} msg/s, "
+                  f"replay clock {datetime.utcfromtimestamp(ts).isoformat(timespec='seconds')}")
+
+    elapsed = time.perf_counter() - started
+    return {"sent": sent, "skipped": skipped, "seconds": elapsed, "max_behind": max_behind,
+            "span": (ts - first_ts) if first_ts is not None else 0.0}
+
+
+async def wait_until_stored(collection, since: datetime, buses: List[str], expected: int, settle: float) -> int:
+    """Poll until every reading is stored or the count stops growing for `settle` seconds."""
+    count, last_change = -1, time.monotonic()
+    while True:
+        current = await collection.count_documents({"timestamp": {"$gte": since}, "bus_mac": {"$in": buses}})
+        if current != count:
+            count, last_change = current, time.monotonic()
+        if count >= expected or time.monotonic() - last_change >= settle:
+            return count
+        await asyncio.sleep(0.5)
+
+
+async def main_async(args) -> int:
+    since = datetime.utcnow()
+    lag = LagTracker()
+    if args.target == "mqtt":
+        target = MqttTarget(args.host, args.port, args.qos, lag)
+    else:
+        target = DirectTarget(lag)
+
+    if args.file:
+        rows = read_file(args.file)
+        source = args.file
+    else:
+        # Never read past the replay start (replaying into the source database)
+        end = min(_parse_time(args.end), since) if args.end else since
+        rows = read_mongo(args.source_url, _parse_time(args.start), end, args.bus)
+        source = "hardware_locations"
+
+    speed = 0.0 if args.speed == "max" else float(args.speed)
+    print(f"Replaying {source} -> {args.target} at {'max speed' if not speed else f'{speed:g}x'}")
+    expected = Aggregates()
+    try:
+        result = await replay(rows, target, speed, expected)
+        await target.drain(args.settle)
+    finally:
+        target.close()
+
+    sent, seconds = result["sent"], result["seconds"]
+    print(f"\n{sent:,} readings sent ({result['skipped']:,} skipped: no bus_mac, position or timestamp)")
+    print(f"{result['span'] / 3600:.2f} h of traffic in {seconds:.1f} s "
+          f"({sent / seconds if seconds else 0:,.0f} msg/s), at most {result['max_behind']:.2f} s behind schedule")
+    print(f"ingest lag: {lag.summary()}")
+
+    if args.no_verify or not sent:
+        return 0
+
+    collection = get_database().get_collection("hardware_locations")
+    buses = sorted(expected.buses)
+    stored_count = await wait_until_stored(collection, since, buses, expected.count, args.settle)
+    stored = await stored_aggregates(collection, since, buses)
+    problems = compare(expected, stored)
+    print(f"\nstored {stored_count:,} of {expected.count:,} readings "
+          f"({len(expected.buses)} buses, {len(expected.zones)} zones, {stored.anomalies:,} flagged as anomalies)")
+    for problem in problems[:20]:
+        print(f"  {problem}")
+    if len(problems) > 20:
+        print(f"  ... {len(problems) - 20} more")
+    print("\nFAIL" if problems else "\nOK: per-bus and per-zone aggregates match the source")
+    return 1 if problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded hardware_locations against the ingest path")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--file", help="NDJSON export (/api/export/hardware-locations?format=ndjson, .gz ok)")
+    source.add_argument("--source-url", default=str(settings.MONGODB_URL),
+                        help="MongoDB to read hardware_locations from (default MONGODB_URL)")
+    parser.add_argument("--start", help="First timestamp to replay (ISO, MongoDB source)")
+    parser.add_argument("--end", help="Replay up to this timestamp (ISO, MongoDB source)")
+    parser.add_argument("--bus", help="Only this bus_mac (MongoDB source)")
+    parser.add_argument("--target", choices=("mqtt", "direct"), default="mqtt")
+    parser.add_argument("--host", default=settings.MQTT_BROKER_HOST, help="Broker for --target mqtt")
+    parser.add_argument("--port", type=int, default=settings.MQTT_BROKER_PORT)
+    parser.add_argument("--qos", type=int, choices=(0, 1), default=0)
+    parser.add_argument("--speed", default="1", help="Replay speed factor (1, 10, ...) or max")
+    parser.add_argument("--settle", type=float, default=10.0,
+                        help="Seconds to wait for the server to catch up before verifying")
+    parser.add_argument("--no-verify", action="store_true", help="Skip the aggregate check")
+    args = parser.parse_args()
+    if args.speed != "max" and float(args.speed) <= 0:
+        parser.error("--speed must be positive or max")
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import asyncio
 import random
 from datetime import datetime, timedelta
-from motor.motor_asyncio import AsyncIOMotorClient
+from core.mongo import get_client
 
 # SUT Coordinates
 CENTER_LAT = 14.8820
@@ -9,7 +9,7 @@ CENTER_LON = 102.0207
 
 async def seed_heatmap():
     uri = "mongodb://localhost:27017"
-    client = AsyncIOMotorClient(uri)
+    client = get_client(uri)
     db = client.sut_smart_bus
     collection = db.hardware_locations
     
@@ -1,14 +1,14 @@
 import asyncio
 import json
 import os
-from motor.motor_asyncio import AsyncIOMotorClient
+from core.mongo import get_client
 
 # Path to the shared JSON source of truth
 JSON_PATH = "../sut-smart-bus-app/routes/pm_zones.json"
 
 async def seed_zones():
     uri = "mongodb://localhost:27017"
-    client = AsyncIOMotorClient(uri)
+    client = get_client(uri)
     db = client.sut_smart_bus
     collection = db.pm_zones
     
@@ -0,0 +1,121 @@
+"""
+Bounded hand-off of DB updates from the MQTT thread to the event loop.
+
+Standalone copy of the server's core/executor.py (the telemetry service
+is deployed on its own and does not ship core/): at most `max_in_flight`
+jobs run at once and up to `max_queue` more wait; when the queue is full
+the overflow policy decides:
+
+    drop_oldest  the oldest queued job is discarded
+    coalesce     a queued job with the same key is replaced in place by
+                 the new one; when the queue is still full the oldest job
+                 is discarded
+    block        the submitting thread waits for room (backpressure to
+                 the broker connection); never on the loop thread itself
+
+A job is a zero-argument callable returning a coroutine, so nothing is
+created for a job that never runs. Failures are logged instead of
+vanishing in an unread future.
+"""
+
+import asyncio
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, Optional
+
+POLICIES = ("drop_oldest", "coalesce", "block")
+
+logger = logging.getLogger("TelemetryService")
+
+Job = Callable[[], Awaitable]
+
+
+class IngestExecutor:
+    def __init__(self, max_in_flight: int = 200, max_queue: int = 5000, policy: str = "drop_oldest"):
+        if policy not in POLICIES:
+            raise ValueError(f"Invalid overflow policy {policy!r}. Must be one of: {list(POLICIES)}")
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(1, max_queue)
+        self.policy = policy
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.in_flight = 0
+        self.queue: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (job, name)
+        self.rejected = {"dropped": 0, "coalesced": 0, "no_loop": 0}
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+
+    def set_loop(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def submit(self, job: Job, key: Optional[Hashable] = None, name: Optional[str] = None) -> bool:
+        """Run `job()` on the loop; thread-safe. False if discarded straight away (no loop)."""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            self.rejected["no_loop"] += 1
+            return False
+        entry = (job, name or getattr(job, "__name__", "job"))
+
+        with self._cond:
+            if self.in_flight < self.max_in_flight and not self.queue:
+                self.in_flight += 1
+                loop.call_soon_threadsafe(self._start, entry)
+                return True
+
+            if self.policy == "coalesce" and key is not None:
+                queue_key = ("key", key)
+                if queue_key in self.queue:
+                    self.queue[queue_key] = entry  # Keeps its place in line
+                    self.rejected["coalesced"] += 1
+                    return True
+            else:
+                queue_key = ("job", next(self._ids))
+
+            if len(self.queue) >= self.max_queue and self.policy == "block" and not self._on_loop_thread(loop):
+                while len(self.queue) >= self.max_queue:
+                    self._cond.wait()
+            while len(self.queue) >= self.max_queue:
+                self.queue.popitem(last=False)
+                self.rejected["dropped"] += 1
+                if self.rejected["dropped"] % 1000 == 1:
+                    logger.warning(f"Ingest queue full: {self.rejected['dropped']} jobs dropped so far")
+            self.queue[queue_key] = entry
+        return True
+
+    @staticmethod
+    def _on_loop_thread(loop: asyncio.AbstractEventLoop) -> bool:
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+
+    def _start(self, entry: tuple):
+        job, name = entry
+        try:
+            coro = job()
+        except Exception as e:
+            logger.error(f"Ingest job {name} failed: {type(e).__name__}: {e}")
+            self._finished()
+            return
+        self.loop.create_task(self._run(coro, name))
+
+    async def _run(self, coro: Awaitable, name: str):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ingest job {name} failed: {type(e).__name__}: {e}")
+        finally:
+            self._finished()
+
+    def _finished(self):
+        """A job ended: start the next queued one in its slot, or free the slot."""
+        with self._cond:
+            if self.queue:
+                _, entry = self.queue.popitem(last=False)
+                self.loop.call_soon(self._start, entry)
+            else:
+                self.in_flight -= 1
+            self._cond.notify_all()
@@ -3,9 +3,12 @@ import os
 import json
 import logging
 from datetime import datetime
+from functools import partial
 from motor.motor_asyncio import AsyncIOMotorClient
 import paho.mqtt.client as mqtt
 
+from executor import IngestExecutor
+
 # Configure Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("TelemetryService")
@@ -14,17 +17,37 @@ logger = logging.getLogger("TelemetryService")
 MQTT_BROKER_HOST = os.getenv("MQTT_BROKER_HOST", "localhost")
 MQTT_BROKER_PORT = int(os.getenv("MQTT_BROKER_PORT", "1883"))
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017/sut_smart_bus")
+INGEST_MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "200"))
+INGEST_MAX_QUEUE = int(os.getenv("INGEST_MAX_QUEUE", "5000"))
+INGEST_OVERFLOW = os.getenv("INGEST_OVERFLOW", "drop_oldest")
+
+# MongoDB pool limits and timeouts (same variables and defaults as the server's core/config.py;
+# 0 = pymongo default / no timeout)
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "20")),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+    "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_MS", "60000")) or None,
+    "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+    "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000")) or None,
+}
 
 # Topics
 TOPIC_ESP32_GPS = "sut/bus/gps"
 TOPIC_BUS_STATUS = "sut/bus/+/status"
 
 # Database Init
-client = AsyncIOMotorClient(MONGODB_URL)
+client = AsyncIOMotorClient(
+    MONGODB_URL, connect=False,
+    **{key: value for key, value in MONGO_CLIENT_OPTIONS.items() if value is not None},
+)
 db = client.get_database()
 bus_collection = db.get_collection("buses")
 hardware_location_collection = db.get_collection("hardware_locations")
 
+# Bounded hand-off of DB updates from the MQTT thread to the event loop
+executor = IngestExecutor(INGEST_MAX_IN_FLIGHT, INGEST_MAX_QUEUE, INGEST_OVERFLOW)
+
 # Async DB Operations
 async def update_bus_location(data):
     try:
@@ -65,6 +88,20 @@ async def update_bus_location(data):
     except Exception as e:
         logger.error(f"DB Update Error: {e}")
 
+async def update_bus_heartbeat(bus_mac, data):
+    try:
+        update_data = {"last_heartbeat": datetime.utcnow()}
+        fw_version = data.get("fw_version") or data.get("version")
+        if fw_version:
+            update_data["firmware_version"] = str(fw_version)[:32]
+        # Known buses only: a heartbeat alone does not register a device
+        await bus_collection.update_one(
+            {"mac_address": bus_mac},
+            {"$set": update_data}
+        )
+    except Exception as e:
+        logger.error(f"Heartbeat Update Error: {e}")
+
 # MQTT Handlers
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
@@ -78,10 +115,17 @@ def on_message(client, userdata, msg):
     try:
         payload = msg.payload.decode()
         # logger.info(f"Received: {msg.topic}") # Debug
-        data = json.loads(payload)
+        data = json.loads(payload) if payload else {}
+        
+        # sut/bus/<mac>/status is a heartbeat, not a location update
+        if msg.topic.startswith("sut/bus/") and msg.topic.endswith("/status"):
+            bus_mac = data.get("bus_mac") or msg.topic.split("/")[2]
+            executor.submit(partial(update_bus_heartbeat, bus_mac, data), key=("heartbeat", bus_mac),
+                            name="update_bus_heartbeat")
+            return
         
-        # Run async update
-        asyncio.run_coroutine_threadsafe(update_bus_location(data), loop)
+        # Run async update (not coalesced: each one also stores a history point)
+        executor.submit(partial(update_bus_location, data), name="update_bus_location")
         
     except Exception as e:
         logger.error(f"Message Error: {e}")
@@ -93,6 +137,7 @@ if __name__ == "__main__":
     # Event Loop for Motor
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    executor.set_loop(loop)
     
     # MQTT Client
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)